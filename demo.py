@@ -21,31 +21,37 @@ import cv2
 import time
 import torch
 import joblib
+import trimesh
 import shutil
 import colorsys
 import argparse
 import numpy as np
 from tqdm import tqdm
 from multi_person_tracker import MPT
-from torch.utils.data import DataLoader
 
-from lib.models.vibe import VIBE_Demo
-from lib.utils.renderer import Renderer
-from lib.dataset.inference import Inference
-from lib.utils.smooth_pose import smooth_pose
+from lib.core.tracklet_inference import MultiTrackletInference
+from lib.utils.smooth_pose import smooth_vibe_results, SMOOTH_METHODS
 from lib.data_utils.kp_utils import convert_kps
 from lib.utils.pose_tracker import run_posetracker
 
 from lib.utils.demo_utils import (
     download_youtube_clip,
-    smplify_runner,
+    batch_smplify_runner,
     convert_crop_coords_to_orig_img,
     convert_crop_cam_to_orig_img,
     prepare_rendering_results,
-    video_to_images,
-    images_to_video,
-    download_ckpt,
+    get_frame_source,
+    get_demo_model,
+    DEMO_OUTPUTS,
+    run_tracker,
 )
+from lib.utils.frame_source import ImageFolderSource
+from lib.utils.results_store import save_results, VERTS_FORMATS
+from lib.models.smpl_lod import get_smpl_lod, SMPL_LOD_LEVELS
+from lib.utils.mesh_reconstruction import MeshReconstructor, LazyMeshes
+from lib.utils.parallel_render import ParallelRenderer
+from lib.utils.skeleton_renderer import SkeletonRenderer
+from lib.utils.video_writer import VideoWriter
 
 # [VIBE-Object]
 import math
@@ -54,6 +60,94 @@ from lib.vibe_obj.utils import *
 MIN_NUM_FRAMES = 25
 
 
+def render_frame(renderer, img, frame_idx, frame_results, lazy_meshes, mesh_color, mesh_folder=None):
+    '''
+    Render the persons of one frame over the frame.
+    :param frame_results (dict): person_id -> results of this frame, see prepare_rendering_results
+    :param lazy_meshes (dict): person_id -> LazyMeshes, used for the meshes that were not computed
+    :param mesh_folder (str): save the mesh of every person to mesh_folder/<person_id>/<frame_idx>.obj
+    :return: rendered frame
+    '''
+    # if args.sideview:
+    #     side_img = np.zeros_like(img)
+
+    # the skeleton overlay only needs the joints
+    need_verts = getattr(renderer, 'mode', None) != 'skeleton' or mesh_folder is not None
+
+    for person_id, person_data in frame_results.items():
+        frame_verts = person_data['verts']
+        frame_cam = person_data['cam']
+        # [VIBE-Object Start]
+        frame_joints3d = person_data['joints3d']
+        frame_pose = person_data['pose']
+        # [VIBE-Object End]
+        if (need_verts and frame_verts is None) or frame_joints3d is None:
+            verts, joints3d = lazy_meshes[person_id][person_data['idx']]
+            frame_verts = verts if frame_verts is None else frame_verts
+            frame_joints3d = joints3d if frame_joints3d is None else frame_joints3d
+
+        mc = mesh_color[person_id]
+
+        mesh_filename = None
+
+        if mesh_folder is not None:
+            person_mesh_folder = os.path.join(mesh_folder, f'{person_id:04d}')
+            os.makedirs(person_mesh_folder, exist_ok=True)
+            mesh_filename = os.path.join(person_mesh_folder, f'{frame_idx:06d}.obj')
+            trimesh.Trimesh(vertices=renderer.lod_verts(frame_verts), faces=renderer.faces, process=False) \
+                .export(mesh_filename)
+
+        # img = renderer.render(
+        #     img,
+        #     verts=frame_verts,
+        #     cam=frame_cam,
+        #     color=mc,
+        #     mesh_filename=mesh_filename,
+        # )
+            
+        # if args.sideview:
+        #     side_img = renderer.render(
+        #         side_img,
+        #         frame_verts,
+        #         cam=frame_cam,
+        #         color=mc,
+        #         angle=270,
+        #         axis=[0,1,0],
+        #     )
+            
+        # if args.sideview:
+        # img = np.concatenate([img, side_img], axis=1)
+
+        # [VIBE-Object Start]
+        # Add camera to scene.
+        renderer.push_weak_cam(frame_cam)
+
+        # Add human to scene.
+        renderer.push_human(verts=frame_verts, color=mc, track_id=person_id, joints3d=frame_joints3d)
+        
+        # Add object to scene.
+        axis_angle = get_left_hand_rotation(frame_pose).to_axis_angle()
+        axis = axis_angle[0]
+        angle = axis_angle[1] * (180.0/math.pi)
+        renderer.push_obj(
+            'assets/monkey.obj',
+            translation=get_left_wrist_translation(frame_joints3d), # Render at the wrist of the person.
+            angle=angle,
+            axis=[axis.x, axis.y, axis.z],
+            scale=[0.2, 0.2, 0.2],
+            color=[1.0, 0.0, 0.0],
+        )
+
+        # Render scene.
+        img = renderer.pop_and_render(img, inplace=True)
+        # [VIBE-Object End]
+
+        if person_data['idx'] == len(lazy_meshes[person_id]) - 1:
+            renderer.remove_track(person_id)
+
+    return img
+
+
 def main(args):
     device = torch.device('cuda') if torch.cuda.is_available() else torch.device('cpu')
 
@@ -75,9 +169,18 @@ def main(args):
     output_path = os.path.join(args.output_folder, os.path.basename(video_file).replace('.mp4', ''))
     os.makedirs(output_path, exist_ok=True)
 
-    image_folder, num_frames, img_shape = video_to_images(video_file, return_info=True)
+    # the decimated mesh is built (or loaded) before inference, a mesh that fails validation stops the run here
+    lod = get_smpl_lod(args.lod) if args.lod is not None else None
+
+    frame_source = get_frame_source(
+        video_file,
+        dump_frames=args.dump_frames,
+        frame_store=args.frame_store,
+        store_dir=args.frame_store_dir,
+    )
+    img_shape = frame_source.img_shape
 
-    print(f'Input video number of frames {num_frames}')
+    print(f'Input video number of frames {len(frame_source)}')
     orig_height, orig_width = img_shape[:2]
 
     total_time = time.time()
@@ -98,7 +201,10 @@ def main(args):
             output_format='dict',
             yolo_img_size=args.yolo_img_size,
         )
-        tracking_results = mot(image_folder)
+        tracking_results = run_tracker(mot, frame_source, batch_size=args.tracker_batch_size)
+
+    # the decoded frame count replaces the container estimate after the tracking pass
+    num_frames = len(frame_source)
 
     # remove tracklets if num_frames is less than MIN_NUM_FRAMES
     for person_id in list(tracking_results.keys()):
@@ -106,111 +212,86 @@ def main(args):
             del tracking_results[person_id]
 
     # ========= Define VIBE model ========= #
-    model = VIBE_Demo(
-        seqlen=16,
-        n_layers=2,
-        hidden_size=1024,
-        add_linear=True,
-        use_residual=True,
-    ).to(device)
-
-    # ========= Load pretrained weights ========= #
-    pretrained_file = download_ckpt(use_3dpw=False)
-    ckpt = torch.load(pretrained_file, map_location='cpu')
-    print(f'Performance of pretrained model on 3DPW: {ckpt["performance"]}')
-    ckpt = ckpt['gen_state_dict']
-    model.load_state_dict(ckpt, strict=False)
-    model.eval()
-    print(f'Loaded pretrained weights from \"{pretrained_file}\"')
-
-    # ========= Run VIBE on each person ========= #
-    print(f'Running VIBE on each tracklet...')
+    model = get_demo_model(
+        device,
+        bundle_file=args.model_bundle,
+        compile_mode=args.compile_mode,
+        backend=args.backend,
+        onnx_dir=args.onnx_dir,
+    )
+
+    # ========= Run VIBE on all persons ========= #
+    print(f'Running VIBE on {len(tracking_results)} tracklets...')
     vibe_time = time.time()
-    vibe_results = {}
-    for person_id in tqdm(list(tracking_results.keys())):
-        bboxes = joints2d = None
-
-        if args.tracking_method == 'bbox':
-            bboxes = tracking_results[person_id]['bbox']
-        elif args.tracking_method == 'pose':
-            joints2d = tracking_results[person_id]['joints2d']
-
-        frames = tracking_results[person_id]['frames']
-
-        dataset = Inference(
-            image_folder=image_folder,
-            frames=frames,
-            bboxes=bboxes,
-            joints2d=joints2d,
-            scale=bbox_scale,
-        )
-
-        bboxes = dataset.bboxes
-        frames = dataset.frames
-        has_keypoints = True if joints2d is not None else False
-
-        dataloader = DataLoader(dataset, batch_size=args.vibe_batch_size, num_workers=16)
-
-        with torch.no_grad():
-
-            pred_cam, pred_verts, pred_pose, pred_betas, pred_joints3d, smpl_joints2d, norm_joints2d = [], [], [], [], [], [], []
-
-            for batch in dataloader:
-                if has_keypoints:
-                    batch, nj2d = batch
-                    norm_joints2d.append(nj2d.numpy().reshape(-1, 21, 3))
-
-                batch = batch.unsqueeze(0)
-                batch = batch.to(device)
-
-                batch_size, seqlen = batch.shape[:2]
-                output = model(batch)[-1]
-
-                pred_cam.append(output['theta'][:, :, :3].reshape(batch_size * seqlen, -1))
-                pred_verts.append(output['verts'].reshape(batch_size * seqlen, -1, 3))
-                pred_pose.append(output['theta'][:,:,3:75].reshape(batch_size * seqlen, -1))
-                pred_betas.append(output['theta'][:, :,75:].reshape(batch_size * seqlen, -1))
-                pred_joints3d.append(output['kp_3d'].reshape(batch_size * seqlen, -1, 3))
-                smpl_joints2d.append(output['kp_2d'].reshape(batch_size * seqlen, -1, 2))
-
-            pred_cam = torch.cat(pred_cam, dim=0)
-            pred_verts = torch.cat(pred_verts, dim=0)
-            pred_pose = torch.cat(pred_pose, dim=0)
-            pred_betas = torch.cat(pred_betas, dim=0)
-            pred_joints3d = torch.cat(pred_joints3d, dim=0)
-            smpl_joints2d = torch.cat(smpl_joints2d, dim=0)
-            del batch
+    engine = MultiTrackletInference(
+        model=model,
+        device=torch.device('cpu') if args.backend == 'onnx' else device,
+        batch_size=args.vibe_batch_size,
+        num_workers=16,
+        bbox_scale=bbox_scale,
+        carry_gru_state=args.carry_gru_state,
+        outputs=DEMO_OUTPUTS[args.outputs],
+    )
+    if args.quantize:
+        engine.quantize(frame_source, tracking_results)
+    predictions = engine(frame_source, tracking_results)
+
+    # ========= [Optional] run Temporal SMPLify on all persons at once to refine the results ========= #
+    smplify_results = {}
+    if args.run_smplify and args.tracking_method == 'pose':
+        person_ids = list(predictions.keys())
+        print(f'Running Temporal SMPLify on {len(person_ids)} persons...')
+        smplify_results = dict(zip(person_ids, batch_smplify_runner(
+            pred_rotmats=[predictions[person_id]['pose'].to(device) for person_id in person_ids],
+            pred_betas=[predictions[person_id]['betas'].to(device) for person_id in person_ids],
+            pred_cams=[predictions[person_id]['pred_cam'].to(device) for person_id in person_ids],
+            j2ds=[
+                torch.from_numpy(
+                    convert_kps(predictions[person_id]['norm_joints2d'], src='staf', dst='spin')
+                ).float().to(device)
+                for person_id in person_ids
+            ],
+            device=device,
+            pose2aa=False,
+            window_size=args.smplify_window,
+            overlap=args.smplify_overlap,
+            num_workers=args.smplify_workers,
+        )))
 
-        # ========= [Optional] run Temporal SMPLify to refine the results ========= #
+    vibe_results = {}
+    for person_id, person_preds in predictions.items():
+        joints2d = tracking_results[person_id]['joints2d'] if args.tracking_method == 'pose' else None
+
+        bboxes = person_preds['bboxes']
+        frames = person_preds['frames']
+        pred_cam = person_preds['pred_cam']
+        pred_pose = person_preds['pose']
+        pred_betas = person_preds['betas']
+        # None if not selected by --outputs
+        pred_verts = person_preds.get('verts')
+        pred_joints3d = person_preds.get('joints3d')
+        smpl_joints2d = person_preds.get('smpl_joints2d')
+
+        # ========= [Optional] Temporal SMPLify results ========= #
         if args.run_smplify and args.tracking_method == 'pose':
-            norm_joints2d = np.concatenate(norm_joints2d, axis=0)
-            norm_joints2d = convert_kps(norm_joints2d, src='staf', dst='spin')
-            norm_joints2d = torch.from_numpy(norm_joints2d).float().to(device)
-
-            # Run Temporal SMPLify
             update, new_opt_vertices, new_opt_cam, new_opt_pose, new_opt_betas, \
-            new_opt_joints3d, new_opt_joint_loss, opt_joint_loss = smplify_runner(
-                pred_rotmat=pred_pose,
-                pred_betas=pred_betas,
-                pred_cam=pred_cam,
-                j2d=norm_joints2d,
-                device=device,
-                batch_size=norm_joints2d.shape[0],
-                pose2aa=False,
-            )
+            new_opt_joints3d, new_opt_joint_loss, opt_joint_loss = smplify_results[person_id]
 
             # update the parameters after refinement
-            print(f'Update ratio after Temporal SMPLify: {update.sum()} / {norm_joints2d.shape[0]}')
-            pred_verts = pred_verts.cpu()
+            print(f'Update ratio after Temporal SMPLify: {update.sum()} / {update.shape[0]}')
+            update = update.cpu()
             pred_cam = pred_cam.cpu()
             pred_pose = pred_pose.cpu()
             pred_betas = pred_betas.cpu()
-            pred_joints3d = pred_joints3d.cpu()
-            pred_verts[update] = new_opt_vertices[update]
             pred_cam[update] = new_opt_cam[update]
             pred_pose[update] = new_opt_pose[update]
             pred_betas[update] = new_opt_betas[update]
-            pred_joints3d[update] = new_opt_joints3d[update]
+            if pred_verts is not None:
+                pred_verts = pred_verts.cpu()
+                pred_verts[update] = new_opt_vertices[update]
+            if pred_joints3d is not None:
+                pred_joints3d = pred_joints3d.cpu()
+                pred_joints3d[update] = new_opt_joints3d[update]
 
         elif args.run_smplify and args.tracking_method == 'bbox':
             print('[WARNING] You need to enable pose tracking to run Temporal SMPLify algorithm!')
@@ -218,22 +299,14 @@ def main(args):
 
         # ========= Save results to a pickle file ========= #
         pred_cam = pred_cam.cpu().numpy()
-        pred_verts = pred_verts.cpu().numpy()
         pred_pose = pred_pose.cpu().numpy()
         pred_betas = pred_betas.cpu().numpy()
-        pred_joints3d = pred_joints3d.cpu().numpy() # 300 frames, 49 bones, 3 floats each. Uses spin_joint_names.
-        smpl_joints2d = smpl_joints2d.cpu().numpy()
-
-        # Runs 1 Euro Filter to smooth out the results
-        if args.smooth:
-            min_cutoff = args.smooth_min_cutoff # 0.004
-            beta = args.smooth_beta # 1.5
-            print(f'Running smoothing on person {person_id}, min_cutoff: {min_cutoff}, beta: {beta}')
-
-            # [VIBE-Object]
-            # Over here, the joints are smoothed out.
-            pred_verts, pred_pose, pred_joints3d = smooth_pose(pred_pose, pred_betas,
-                                                               min_cutoff=min_cutoff, beta=beta)
+        if pred_verts is not None:
+            pred_verts = pred_verts.cpu().numpy()
+        if pred_joints3d is not None:
+            pred_joints3d = pred_joints3d.cpu().numpy() # 300 frames, 49 bones, 3 floats each. Uses spin_joint_names.
+        if smpl_joints2d is not None:
+            smpl_joints2d = smpl_joints2d.cpu().numpy()
 
         orig_cam = convert_crop_cam_to_orig_img(
             cam=pred_cam,
@@ -246,7 +319,7 @@ def main(args):
             bbox=bboxes,
             keypoints=smpl_joints2d,
             crop_size=224,
-        )
+        ) if smpl_joints2d is not None else None
 
         output_dict = {
             'pred_cam': pred_cam,
@@ -277,6 +350,29 @@ def main(args):
         # The 3 floats represent the axis, and the magnitude of the axis is the angle of rotation in radians.
         # The 24 bones are specified in fbx_output.bone_name_from_index.
 
+    # Runs 1 Euro Filter (or a zero-phase rotation filter) to smooth out the results, of all persons at once
+    if args.smooth:
+        min_cutoff = args.smooth_min_cutoff # 0.004
+        beta = args.smooth_beta # 1.5
+        if args.smooth_method == 'one_euro':
+            print(f'Running smoothing on {len(vibe_results)} persons, min_cutoff: {min_cutoff}, beta: {beta}')
+        else:
+            print(f'Running {args.smooth_method} smoothing on {len(vibe_results)} persons in {args.smooth_rotation} '
+                  f'rotation space, sigma: {args.smooth_sigma}, window: {args.smooth_window}')
+
+        # [VIBE-Object]
+        # Over here, the joints are smoothed out.
+        smooth_vibe_results(
+            vibe_results,
+            min_cutoff=min_cutoff,
+            beta=beta,
+            device=device,
+            method=args.smooth_method,
+            **({} if args.smooth_method == 'one_euro' else dict(
+                rotation=args.smooth_rotation, sigma=args.smooth_sigma, window=args.smooth_window,
+            )),
+        )
+
     del model
 
     end = time.time()
@@ -287,117 +383,74 @@ def main(args):
     print(f'Total time spent: {total_time:.2f} seconds (including model loading time).')
     print(f'Total FPS (including model loading time): {num_frames / total_time:.2f}.')
 
-    print(f'Saving output results to \"{os.path.join(output_path, "vibe_output.pkl")}\".')
+    if args.results_format == 'h5':
+        save_results(os.path.join(output_path, "vibe_output.h5"), vibe_results, verts_format=args.verts_format,
+                     lod=lod)
+    else:
+        print(f'Saving output results to \"{os.path.join(output_path, "vibe_output.pkl")}\".')
 
-    joblib.dump(vibe_results, os.path.join(output_path, "vibe_output.pkl"))
+        joblib.dump(vibe_results, os.path.join(output_path, "vibe_output.pkl"))
 
     if not args.no_render:
         # ========= Render results as a single video ========= #
-        renderer = Renderer(resolution=(orig_width, orig_height), orig_img=True, wireframe=args.wireframe)
-
-        output_img_folder = f'{image_folder}_output'
-        os.makedirs(output_img_folder, exist_ok=True)
-
-        print(f'Rendering output video, writing frames to {output_img_folder}')
+        vid_name = os.path.basename(video_file)
+        save_name = f'{vid_name.replace(".mp4", "")}_vibe_result.mp4'
+        save_name = os.path.join(output_path, save_name)
+        print(f'Rendering output video to {save_name}')
 
         # prepare results for rendering
         frame_results = prepare_rendering_results(vibe_results, num_frames)
         mesh_color = {k: colorsys.hsv_to_rgb(np.random.rand(), 0.5, 1.0) for k in vibe_results.keys()}
+        mesh_folder = os.path.join(output_path, 'meshes') if args.save_obj else None
+
+        # render workers are forked after CUDA was initialized, they reconstruct meshes on the cpu
+        render_device = device if args.render_workers <= 1 else torch.device('cpu')
+
+        def setup_renderer():
+            if args.skeleton:
+                renderer = SkeletonRenderer(resolution=(orig_width, orig_height),
+                                            mode='mesh' if args.wireframe else 'skeleton', lod=args.lod)
+            else:
+                # pyrender needs EGL, it is only imported when meshes are rendered
+                from lib.utils.renderer import Renderer
+                renderer = Renderer(resolution=(orig_width, orig_height), orig_img=True, wireframe=args.wireframe,
+                                    persistent=True, scissor=True, lod=args.lod)
+
+            # meshes that were not computed by VIBE (--outputs joints or theta) are reconstructed chunk by chunk
+            mesh_reconstructor = MeshReconstructor(device=render_device)
+            lazy_meshes = {
+                person_id: LazyMeshes(mesh_reconstructor, person_data['pose'], person_data['betas'])
+                for person_id, person_data in vibe_results.items()
+            }
+            return lambda img, frame_idx: render_frame(
+                renderer, img, frame_idx, frame_results[frame_idx], lazy_meshes, mesh_color, mesh_folder
+            )
 
-        image_file_names = sorted([
-            os.path.join(image_folder, x)
-            for x in os.listdir(image_folder)
-            if x.endswith('.png') or x.endswith('.jpg')
-        ])
-
-        for frame_idx in tqdm(range(len(image_file_names))):
-            img_fname = image_file_names[frame_idx]
-            img = cv2.imread(img_fname)
-
-            # if args.sideview:
-            #     side_img = np.zeros_like(img)
-
-            for person_id, person_data in frame_results[frame_idx].items():
-                frame_verts = person_data['verts']
-                frame_cam = person_data['cam']
-                # [VIBE-Object Start]
-                frame_joints3d = person_data['joints3d']
-                frame_pose = person_data['pose']
-                # [VIBE-Object End]
-
-                mc = mesh_color[person_id]
-
-                mesh_filename = None
-
-                if args.save_obj:
-                    mesh_folder = os.path.join(output_path, 'meshes', f'{person_id:04d}')
-                    os.makedirs(mesh_folder, exist_ok=True)
-                    mesh_filename = os.path.join(mesh_folder, f'{frame_idx:06d}.obj')
-
-                # img = renderer.render(
-                #     img,
-                #     verts=frame_verts,
-                #     cam=frame_cam,
-                #     color=mc,
-                #     mesh_filename=mesh_filename,
-                # )
-                    
-                # if args.sideview:
-                #     side_img = renderer.render(
-                #         side_img,
-                #         frame_verts,
-                #         cam=frame_cam,
-                #         color=mc,
-                #         angle=270,
-                #         axis=[0,1,0],
-                #     )
-                    
-                # if args.sideview:
-                # img = np.concatenate([img, side_img], axis=1)
-
-                # [VIBE-Object Start]
-                # Add camera to scene.
-                renderer.push_cam(frame_cam)
-
-                # Add human to scene.
-                renderer.push_human(verts=frame_verts, color=mc)
-                
-                # Add object to scene.
-                axis_angle = get_left_hand_rotation(frame_pose).to_axis_angle()
-                axis = axis_angle[0]
-                angle = axis_angle[1] * (180.0/math.pi)
-                renderer.push_obj(
-                    'assets/monkey.obj',
-                    translation=get_left_wrist_translation(frame_joints3d), # Render at the wrist of the person.
-                    angle=angle,
-                    axis=[axis.x, axis.y, axis.z],
-                    scale=[0.2, 0.2, 0.2],
-                    color=[1.0, 0.0, 0.0],
-                )
-
-                # Render scene.
-                img = renderer.pop_and_render(img)
-                # [VIBE-Object End]
-
-            cv2.imwrite(os.path.join(output_img_folder, f'{frame_idx:06d}.png'), img)
-
-            if args.display:
-                cv2.imshow('Video', img)
-                if cv2.waitKey(1) & 0xFF == ord('q'):
-                    break
+        # rendered frames are streamed to the encoder in frame order
+        parallel_renderer = ParallelRenderer(frame_source, setup_renderer, num_workers=args.render_workers)
+        video_writer = VideoWriter(
+            save_name,
+            img_shape,
+            fps=frame_source.fps,
+            codec=args.video_codec,
+            crf=args.video_crf,
+            threads=args.video_threads,
+        )
+        with video_writer:
+            for frame_idx, img in tqdm(parallel_renderer(num_frames), total=num_frames):
+                video_writer.write(img)
+
+                if args.display:
+                    cv2.imshow('Video', img)
+                    if cv2.waitKey(1) & 0xFF == ord('q'):
+                        break
 
         if args.display:
             cv2.destroyAllWindows()
 
-        # ========= Save rendered video ========= #
-        vid_name = os.path.basename(video_file)
-        save_name = f'{vid_name.replace(".mp4", "")}_vibe_result.mp4'
-        save_name = os.path.join(output_path, save_name)
-        print(f'Saving result video to {save_name}')
-        images_to_video(img_folder=output_img_folder, output_vid_file=save_name)
-        shutil.rmtree(output_img_folder)
-
-    shutil.rmtree(image_folder)
+    frame_source.release()
+    if isinstance(frame_source, ImageFolderSource):
+        shutil.rmtree(frame_source.img_folder)
     print('================= END =================')
 
 
@@ -425,8 +478,51 @@ if __name__ == '__main__':
     parser.add_argument('--staf_dir', type=str, default='/home/mkocabas/developments/openposetrack',
                         help='path to directory STAF pose tracking method installed.')
 
+    parser.add_argument('--model_bundle', type=str, default=None,
+                        help='VIBE deployment bundle, created from the checkpoints on the first run')
+
+    parser.add_argument('--compile_mode', type=str, default=None, choices=['script', 'compile'],
+                        help='compile the VIBE backbone with TorchScript or torch.compile, cached in data/vibe_data/compiled')
+
+    parser.add_argument('--quantize', action='store_true',
+                        help='run VIBE in int8 on the CPU, the backbone is calibrated on crops of the input video')
+
+    parser.add_argument('--backend', type=str, default='torch', choices=['torch', 'onnx'],
+                        help='run VIBE with PyTorch or with onnxruntime on the CPU')
+
+    parser.add_argument('--onnx_dir', type=str, default='data/vibe_data/onnx',
+                        help='ONNX graphs of the onnx backend, exported from the checkpoints on the first run')
+
+    parser.add_argument('--outputs', type=str, default='mesh', choices=list(DEMO_OUTPUTS.keys()),
+                        help='compute the full SMPL mesh, only the joints or only the SMPL parameters (theta), '
+                             'meshes that are not computed are reconstructed on demand for rendering')
+
+    parser.add_argument('--results_format', type=str, default='pkl', choices=['pkl', 'h5'],
+                        help='save the results to the vibe_output.pkl joblib dump, '
+                             'or to vibe_output.h5, readable by person and frame range')
+
+    parser.add_argument('--verts_format', type=str, default='float32', choices=VERTS_FORMATS,
+                        help='storage of the vertices in vibe_output.h5, int16 stores quantized offsets from the '
+                             'mean mesh of each person, none drops them')
+
+    parser.add_argument('--lod', type=int, default=None, choices=SMPL_LOD_LEVELS,
+                        help='use a decimated SMPL mesh with this many vertices for rendering, obj files and the '
+                             'vertices in vibe_output.h5')
+
     parser.add_argument('--vibe_batch_size', type=int, default=450,
-                        help='batch size of VIBE')
+                        help='batch size of VIBE, shared by all tracklets')
+
+    parser.add_argument('--carry_gru_state', action='store_true',
+                        help='carry the GRU state across vibe_batch_size chunks instead of resetting it')
+
+    parser.add_argument('--dump_frames', action='store_true',
+                        help='extract the video to a folder of PNG frames with ffmpeg instead of decoding it in process')
+
+    parser.add_argument('--frame_store', action='store_true',
+                        help='decode the video once into a memory mapped frame store shared by tracking, VIBE and rendering')
+
+    parser.add_argument('--frame_store_dir', type=str, default=None,
+                        help='directory of the frame store file, defaults to /dev/shm if the video fits, else temp/')
 
     parser.add_argument('--display', action='store_true',
                         help='visualize the results of each step during demo')
@@ -434,12 +530,37 @@ if __name__ == '__main__':
     parser.add_argument('--run_smplify', action='store_true',
                         help='run smplify for refining the results, you need pose tracking to enable it')
 
+    parser.add_argument('--smplify_window', type=int, default=None,
+                        help='run smplify on overlapping windows of this many frames instead of whole tracklets')
+
+    parser.add_argument('--smplify_overlap', type=int, default=20,
+                        help='minimum number of frames shared by neighbouring smplify windows, blended in the result')
+
+    parser.add_argument('--smplify_workers', type=int, default=4,
+                        help='number of smplify windows optimized concurrently')
+
     parser.add_argument('--no_render', action='store_true',
                         help='disable final rendering of output video.')
 
     parser.add_argument('--wireframe', action='store_true',
                         help='render all meshes as wireframes.')
 
+    parser.add_argument('--skeleton', action='store_true',
+                        help='draw the skeleton (or with --wireframe a decimated mesh wireframe) with OpenCV '
+                             'instead of rendering meshes, needs no OpenGL')
+
+    parser.add_argument('--render_workers', type=int, default=1,
+                        help='number of processes rendering the output video, each with an EGL context of its own')
+
+    parser.add_argument('--video_codec', type=str, default='libx264',
+                        help='ffmpeg encoder of the output video')
+
+    parser.add_argument('--video_crf', type=int, default=23,
+                        help='constant rate factor of the output video, lower is better quality')
+
+    parser.add_argument('--video_threads', type=int, default=0,
+                        help='threads of the output video encoder, 0 lets ffmpeg decide')
+
     # Remove side view because I don't feel like supporting it.
     # parser.add_argument('--sideview', action='store_true',
     #                     help='render meshes from alternate viewpoint.')
@@ -458,6 +579,28 @@ if __name__ == '__main__':
                         help='one euro filter beta. '
                              'Increasing the speed coefficient(beta) decreases speed lag.')
 
+    parser.add_argument('--smooth_method', type=str, default='one_euro', choices=SMOOTH_METHODS,
+                        help='causal one euro filter on the axis-angle poses, or an offline zero-phase '
+                             'gaussian / Savitzky-Golay filter in rotation space')
+
+    parser.add_argument('--smooth_rotation', type=str, default='6d', choices=['6d', 'quat'],
+                        help='rotation representation filtered by the gaussian and savgol methods')
+
+    parser.add_argument('--smooth_sigma', type=float, default=2.0,
+                        help='standard deviation of the gaussian smoothing kernel in frames')
+
+    parser.add_argument('--smooth_window', type=int, default=9,
+                        help='window length of the Savitzky-Golay smoothing filter in frames, odd')
+
     args = parser.parse_args()
 
+    if args.quantize and args.compile_mode is not None:
+        parser.error('--quantize and --compile_mode cannot be combined')
+
+    if args.backend == 'onnx' and (args.quantize or args.compile_mode is not None):
+        parser.error('--quantize and --compile_mode only apply to the torch backend')
+
+    if args.smplify_window is not None and not 0 <= args.smplify_overlap < args.smplify_window:
+        parser.error('--smplify_overlap must be smaller than --smplify_window')
+
     main(args)
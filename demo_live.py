@@ -0,0 +1,203 @@
+# -*- coding: utf-8 -*-
+
+# Max-Planck-Gesellschaft zur Förderung der Wissenschaften e.V. (MPG) is
+# holder of all proprietary rights on this computer program.
+# You can only use this computer program if you have closed
+# a license agreement with MPG or you get the right to use the computer
+# program from someone who is authorized to grant you that right.
+# Any use of the computer program without a valid license is prohibited and
+# liable to prosecution.
+#
+# Copyright©2019 Max-Planck-Gesellschaft zur Förderung
+# der Wissenschaften e.V. (MPG). acting on behalf of its Max Planck Institute
+# for Intelligent Systems. All rights reserved.
+#
+# Contact: ps-license@tuebingen.mpg.de
+
+import os
+os.environ['PYOPENGL_PLATFORM'] = 'egl'
+
+import cv2
+import time
+import torch
+import argparse
+import numpy as np
+from multi_person_tracker import MPT
+from torchvision.transforms.functional import to_tensor
+
+from lib.utils.renderer import Renderer
+from lib.core.online_inference import OnlineInference
+from lib.utils.demo_utils import get_demo_model, convert_crop_cam_to_orig_img, require_mpt_internals
+
+
+def track_frame(mot, img):
+    '''
+    Detect and track the persons of a single frame with the multi person tracker.
+    :param mot (MPT): tracker, its SORT state is kept between calls
+    :param img (ndarray, HxWx3): BGR frame
+    :return: bboxes (ndarray, Nx4) as (c_x, c_y, w, h) and their track ids
+    '''
+    batch = to_tensor(cv2.cvtColor(img, cv2.COLOR_BGR2RGB))[None].to(mot.device)
+    pred = mot.detector(batch)[0]
+
+    bb = pred['boxes'].cpu().numpy()
+    sc = pred['scores'].cpu().numpy()[..., None]
+    dets = np.hstack([bb, sc])
+    dets = dets[sc[:, 0] > mot.detection_threshold]
+
+    tracks = mot.tracker.update(dets) if dets.shape[0] > 0 else np.empty((0, 5))
+
+    # same square bboxes as MPT.prepare_output_tracks
+    w, h = tracks[:, 2] - tracks[:, 0], tracks[:, 3] - tracks[:, 1]
+    size = np.maximum(w, h)
+    bboxes = np.stack([(tracks[:, 0] + tracks[:, 2]) / 2, (tracks[:, 1] + tracks[:, 3]) / 2, size, size], axis=1)
+    return bboxes, tracks[:, 4].astype(int).tolist()
+
+
+def main(args):
+    device = torch.device('cuda') if torch.cuda.is_available() else torch.device('cpu')
+
+    source = int(args.vid_file) if args.vid_file.isdigit() else args.vid_file
+    cap = cv2.VideoCapture(source)
+    if not cap.isOpened():
+        exit(f'Could not open \"{args.vid_file}\"')
+
+    mot = MPT(
+        device=device,
+        batch_size=1,
+        display=False,
+        detector_type=args.detector,
+        output_format='dict',
+        yolo_img_size=args.yolo_img_size,
+    )
+    # track_frame runs the detector and the SORT tracker of MPT one frame at a time
+    require_mpt_internals(mot, ['device', 'detector', 'tracker.update', 'detection_threshold'])
+
+    model = get_demo_model(device, bundle_file=args.model_bundle, compile_mode=args.compile_mode)
+    engine = OnlineInference(
+        model=model,
+        device=device,
+        bbox_scale=1.1,
+        max_tracks=args.max_tracks,
+        max_age=args.max_age,
+        smooth=args.smooth,
+        min_cutoff=args.smooth_min_cutoff,
+        beta=args.smooth_beta,
+    )
+
+    renderer = None
+    frame_idx = 0
+    tracking_time = 0.
+    while args.max_frames is None or frame_idx < args.max_frames:
+        ret, img = cap.read()
+        if not ret:
+            if args.loop and not isinstance(source, int):
+                cap.set(cv2.CAP_PROP_POS_FRAMES, 0)
+                continue
+            break
+
+        start = time.perf_counter()
+        bboxes, track_ids = track_frame(mot, img)
+        tracking_time += time.perf_counter() - start
+
+        results = engine(img, bboxes, track_ids, frame_idx=frame_idx)
+
+        if args.display:
+            orig_height, orig_width = img.shape[:2]
+            if renderer is None:
+                renderer = Renderer(
+                    resolution=(orig_width, orig_height), orig_img=True, wireframe=args.wireframe, persistent=True,
+                    scissor=True,
+                )
+
+            for track_id, result in results.items():
+                orig_cam = convert_crop_cam_to_orig_img(
+                    cam=result['pred_cam'][None],
+                    bbox=result['bbox'][None],
+                    img_width=orig_width,
+                    img_height=orig_height
+                )[0]
+                renderer.push_weak_cam(orig_cam)
+                renderer.push_human(verts=result['verts'], track_id=track_id)
+                img = renderer.pop_and_render(img, inplace=True)
+
+            # drop the meshes of the tracks the engine expired
+            for track_id in set(renderer.track_nodes.keys()) - set(engine.tracks.keys()):
+                renderer.remove_track(track_id)
+
+            cv2.imshow('Video', img)
+            if cv2.waitKey(1) & 0xFF == ord('q'):
+                break
+
+        frame_idx += 1
+        if frame_idx % args.report_interval == 0:
+            stats = engine.latency_stats()
+            print(f'Frame {frame_idx}: VIBE latency mean {stats["mean"]:.1f} ms, p50 {stats["p50"]:.1f} ms, '
+                  f'p95 {stats["p95"]:.1f} ms, max {stats["max"]:.1f} ms, '
+                  f'tracking {tracking_time / frame_idx * 1000:.1f} ms/frame')
+
+    cap.release()
+    if args.display:
+        cv2.destroyAllWindows()
+
+    stats = engine.latency_stats()
+    if len(stats) > 0:
+        print(f'Processed {frame_idx} frames, VIBE latency over the last {stats["num_frames"]} frames: '
+              f'mean {stats["mean"]:.1f} ms, p50 {stats["p50"]:.1f} ms, p95 {stats["p95"]:.1f} ms, '
+              f'max {stats["max"]:.1f} ms')
+    print('================= END =================')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument('--vid_file', type=str, default='0',
+                        help='input video path or capture device index')
+
+    parser.add_argument('--loop', action='store_true',
+                        help='restart the video file when it ends, stands in for a live feed')
+
+    parser.add_argument('--max_frames', type=int, default=None,
+                        help='stop after this many frames')
+
+    parser.add_argument('--detector', type=str, default='yolo', choices=['yolo', 'maskrcnn'],
+                        help='object detector to be used for bbox tracking')
+
+    parser.add_argument('--yolo_img_size', type=int, default=416,
+                        help='input image size for yolo detector')
+
+    parser.add_argument('--model_bundle', type=str, default=None,
+                        help='VIBE deployment bundle, created from the checkpoints on the first run')
+
+    parser.add_argument('--compile_mode', type=str, default=None, choices=['script', 'compile'],
+                        help='compile the VIBE backbone with TorchScript or torch.compile, cached in data/vibe_data/compiled')
+
+    parser.add_argument('--max_tracks', type=int, default=8,
+                        help='maximum number of persons processed per frame, bounds the per frame latency')
+
+    parser.add_argument('--max_age', type=int, default=30,
+                        help='frames after which the GRU and filter state of a lost track is dropped')
+
+    parser.add_argument('--report_interval', type=int, default=100,
+                        help='print latency statistics every this many frames')
+
+    parser.add_argument('--display', action='store_true',
+                        help='render and show the results of every frame')
+
+    parser.add_argument('--wireframe', action='store_true',
+                        help='render all meshes as wireframes.')
+
+    parser.add_argument('--smooth', action='store_true',
+                        help='smooth the pose of every track with a causal one euro filter')
+
+    parser.add_argument('--smooth_min_cutoff', type=float, default=0.004,
+                        help='one euro filter min cutoff. '
+                             'Decreasing the minimum cutoff frequency decreases slow speed jitter')
+
+    parser.add_argument('--smooth_beta', type=float, default=0.7,
+                        help='one euro filter beta. '
+                             'Increasing the speed coefficient(beta) decreases speed lag.')
+
+    args = parser.parse_args()
+
+    main(args)
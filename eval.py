@@ -1,10 +1,15 @@
 import os
+import time
 import torch
+import os.path as osp
 
 from lib.dataset import ThreeDPW
 from lib.models import VIBE
+from lib.models.spin import hmr
+from lib.models.jit import FeatureExtractor
+from lib.models.quantize import quantize_backbone, quantize_temporal
 from lib.core.evaluate import Evaluator
-from lib.core.config import parse_args
+from lib.core.config import parse_args, VIBE_DATA_DIR
 from torch.utils.data import DataLoader
 
 
@@ -32,6 +37,10 @@ def main(cfg):
         print(f'{cfg.TRAIN.PRETRAINED} is not a pretrained model!!!!')
         exit()
 
+    if cfg.EVAL.QUANTIZE:
+        evaluate_quantized(cfg, model)
+        return
+
     test_db = ThreeDPW(set='test', seqlen=cfg.DATASET.SEQLEN, debug=cfg.DEBUG)
 
     test_loader = DataLoader(
@@ -48,6 +57,57 @@ def main(cfg):
     ).run()
 
 
+def evaluate_quantized(cfg, model):
+    # the stored 3DPW features come from the float SPIN backbone, so both the float and the int8 model
+    # compute their features from the cropped test images here
+    print('...Comparing the int8 and the float model on CPU...')
+
+    hmr_model = hmr(pretrained=False, feature_only=True)
+    checkpoint = torch.load(osp.join(VIBE_DATA_DIR, 'spin_model_checkpoint.pth.tar'), map_location='cpu')
+    hmr_model.load_state_dict(checkpoint['model'], strict=False)
+    hmr_model.eval()
+
+    # calibrate on the validation set, not on the images we evaluate on
+    calib_loader = DataLoader(
+        dataset=ThreeDPW(set='val', seqlen=cfg.DATASET.SEQLEN, return_video=True),
+        batch_size=cfg.TRAIN.BATCH_SIZE,
+        shuffle=True,
+        num_workers=cfg.NUM_WORKERS,
+    )
+    calibration_batches = (
+        target['video'].reshape(-1, 3, 224, 224)
+        for _, target in zip(range(cfg.EVAL.NUM_CALIBRATION_BATCHES), calib_loader)
+    )
+
+    test_loader = DataLoader(
+        dataset=ThreeDPW(set='test', seqlen=cfg.DATASET.SEQLEN, debug=cfg.DEBUG, return_video=True),
+        batch_size=cfg.TRAIN.BATCH_SIZE,
+        shuffle=False,
+        num_workers=cfg.NUM_WORKERS,
+    )
+
+    q_backbone = quantize_backbone(hmr_model, calibration_batches)
+    q_model = quantize_temporal(model)
+
+    float_results = Evaluator(
+        model=model,
+        device='cpu',
+        test_loader=test_loader,
+        backbone=FeatureExtractor(hmr_model),
+    ).run()
+
+    start = time.time()
+    int8_results = Evaluator(
+        model=q_model,
+        device='cpu',
+        test_loader=test_loader,
+        backbone=q_backbone,
+    ).run()
+    print(f'int8 evaluation took {time.time() - start:.2f}s')
+
+    print(' '.join([f'{k.upper()} (int8 - float): {int8_results[k] - v:+.4f},' for k, v in float_results.items()]))
+
+
 if __name__ == '__main__':
     cfg, cfg_file = parse_args()
 
@@ -93,6 +93,11 @@ cfg.LOSS.SHAPE_W = 0.001
 cfg.LOSS.POSE_W = 1.0
 cfg.LOSS.D_MOTION_LOSS_W = 1.
 
+cfg.EVAL = CN()
+# evaluate the int8 model (static backbone, dynamic GRU/regressor) against the float model on cropped images
+cfg.EVAL.QUANTIZE = False
+cfg.EVAL.NUM_CALIBRATION_BATCHES = 8
+
 cfg.MODEL = CN()
 
 cfg.MODEL.TEMPORAL_TYPE = 'gru'
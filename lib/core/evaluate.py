@@ -40,10 +40,13 @@ class Evaluator():
             test_loader,
             model,
             device=None,
+            backbone=None,
     ):
         self.test_loader = test_loader
         self.model = model
         self.device = device
+        # backbone: compute the features from the cropped images (target['video']) instead of using the stored ones
+        self.backbone = backbone
 
         self.evaluation_accumulators = dict.fromkeys(['pred_j3d', 'target_j3d', 'target_theta', 'pred_verts'])
 
@@ -72,7 +75,11 @@ class Evaluator():
 
             # <=============
             with torch.no_grad():
-                inp = target['features']
+                if self.backbone is not None:
+                    video = target['video']
+                    inp = self.backbone(video.reshape(-1, *video.shape[2:])).reshape(*video.shape[:2], -1)
+                else:
+                    inp = target['features']
 
                 preds = self.model(inp, J_regressor=J_regressor)
 
@@ -149,6 +156,8 @@ class Evaluator():
         log_str = ' '.join([f'{k.upper()}: {v:.4f},'for k,v in eval_dict.items()])
         print(log_str)
 
+        return eval_dict
+
     def run(self):
         self.validate()
-        self.evaluate()
\ No newline at end of file
+        return self.evaluate()
\ No newline at end of file
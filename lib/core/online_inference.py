@@ -0,0 +1,182 @@
+# -*- coding: utf-8 -*-
+
+# Max-Planck-Gesellschaft zur Förderung der Wissenschaften e.V. (MPG) is
+# holder of all proprietary rights on this computer program.
+# You can only use this computer program if you have closed
+# a license agreement with MPG or you get the right to use the computer
+# program from someone who is authorized to grant you that right.
+# Any use of the computer program without a valid license is prohibited and
+# liable to prosecution.
+#
+# Copyright©2019 Max-Planck-Gesellschaft zur Förderung
+# der Wissenschaften e.V. (MPG). acting on behalf of its Max Planck Institute
+# for Intelligent Systems. All rights reserved.
+#
+# Contact: ps-license@tuebingen.mpg.de
+
+import time
+import torch
+import numpy as np
+from collections import deque
+
+from lib.utils.one_euro_filter import OneEuroFilter
+from lib.data_utils.img_utils import get_batch_image_crop_demo
+
+
+class OnlineInference():
+    """
+    Per frame VIBE_Demo inference for live feeds.
+
+    Every call takes one frame and the tracked bboxes in it and returns the
+    SMPL parameters of that frame right away. The GRU state and a causal
+    OneEuroFilter on the pose are kept per track id between calls, tracks
+    that were not seen for `max_age` frames are dropped. At most `max_tracks`
+    bboxes (the largest ones) are processed per frame, which bounds the work,
+    and so the latency, of a single call.
+    """
+    def __init__(
+            self,
+            model,
+            device,
+            bbox_scale=1.1,
+            crop_size=224,
+            max_tracks=8,
+            max_age=30,
+            smooth=True,
+            min_cutoff=0.004,
+            beta=0.7,
+            num_latencies=1000,
+    ):
+        if model.encoder.gru.bidirectional:
+            raise ValueError('online inference needs a unidirectional temporal encoder')
+
+        self.model = model
+        self.device = device
+        self.bbox_scale = bbox_scale
+        self.crop_size = crop_size
+        self.max_tracks = max_tracks
+        self.max_age = max_age
+        self.smooth = smooth
+        self.min_cutoff = min_cutoff
+        self.beta = beta
+        self.latencies = deque(maxlen=num_latencies)
+        self.reset()
+
+    def reset(self):
+        self.tracks = {}
+        self.frame_idx = 0
+        self.latencies.clear()
+
+    def expire(self, frame_idx):
+        for track_id in list(self.tracks.keys()):
+            if frame_idx - self.tracks[track_id]['last_seen'] > self.max_age:
+                del self.tracks[track_id]
+
+    @torch.no_grad()
+    def __call__(self, frame, bboxes, track_ids, frame_idx=None):
+        '''
+        :param frame (ndarray, HxWx3): BGR uint8 frame
+        :param bboxes (ndarray, Nx4): tracked bboxes (c_x, c_y, w, h)
+        :param track_ids (list): track id of every bbox
+        :param frame_idx (int): frame index, the time of the pose filter. Defaults to a running counter. A track
+            whose frame index does not increase restarts its pose filter
+        :return: track_id -> {'pred_cam', 'pose', 'betas', 'verts', 'joints3d', 'bbox'} of this frame
+        '''
+        start = time.perf_counter()
+
+        if frame_idx is None:
+            frame_idx = self.frame_idx
+        self.frame_idx = frame_idx + 1
+        self.expire(frame_idx)
+
+        bboxes = np.asarray(bboxes, dtype=np.float64).reshape(-1, 4)
+        track_ids = list(track_ids)
+        if len(track_ids) > self.max_tracks:
+            keep = np.argsort(-bboxes[:, 2] * bboxes[:, 3], kind='stable')[:self.max_tracks]
+            bboxes, track_ids = bboxes[keep], [track_ids[i] for i in keep]
+
+        output = {}
+        if len(track_ids) > 0:
+            norm_imgs, _, _ = get_batch_image_crop_demo(
+                [frame] * len(track_ids),
+                bboxes,
+                scale=self.bbox_scale,
+                crop_size=self.crop_size,
+                bgr=True,
+                normalize=not self.model.raw_input,
+            )
+            feature = self.model.extract_features(norm_imgs.to(self.device))
+
+            # continue the GRU of every known track, new tracks start from zeros
+            gru = self.model.encoder.gru
+            zeros = feature.new_zeros(gru.num_layers, gru.hidden_size)
+            hidden = torch.stack([
+                self.tracks[track_id]['hidden'] if track_id in self.tracks else zeros
+                for track_id in track_ids
+            ], dim=1)
+            feature, hidden = self.model.encode(
+                feature[:, None], [1] * len(track_ids), hidden=hidden, return_hidden=True
+            )
+
+            pred = self.model.regressor(feature)[-1]
+            theta = pred['theta']
+            verts, joints3d = pred['verts'], pred['kp_3d']
+            pose = theta[:, 3:75].cpu().numpy()
+
+            for i, track_id in enumerate(track_ids):
+                track = self.tracks.setdefault(track_id, {'filter': None, 'last_seen': frame_idx})
+                # the filter divides by the time since the previous frame of the track, it restarts when the
+                # frame index does not increase (the same frame passed twice or a reset counter)
+                restart = track['filter'] is None or frame_idx <= track['last_seen']
+                track['hidden'] = hidden[:, i]
+                track['last_seen'] = frame_idx
+
+                if not self.smooth:
+                    continue
+                if restart:
+                    track['filter'] = OneEuroFilter(
+                        frame_idx, pose[i], min_cutoff=self.min_cutoff, beta=self.beta
+                    )
+                else:
+                    pose[i] = track['filter'](frame_idx, pose[i])
+
+            if self.smooth:
+                smpl_pose = torch.from_numpy(pose).to(theta.device)
+                smpl_output = self.model.regressor.smpl(
+                    betas=theta[:, 75:],
+                    body_pose=smpl_pose[:, 3:],
+                    global_orient=smpl_pose[:, :3],
+                )
+                verts, joints3d = smpl_output.vertices, smpl_output.joints
+
+            theta = theta.cpu().numpy()
+            verts = verts.cpu().numpy()
+            joints3d = joints3d.cpu().numpy()
+            for i, track_id in enumerate(track_ids):
+                output[track_id] = {
+                    'pred_cam': theta[i, :3],
+                    'pose': pose[i],
+                    'betas': theta[i, 75:],
+                    'verts': verts[i],
+                    'joints3d': joints3d[i],
+                    'bbox': bboxes[i],
+                }
+
+        self.latencies.append(time.perf_counter() - start)
+        return output
+
+    def latency_stats(self):
+        '''
+        :return: per frame latency statistics in milliseconds over the last `num_latencies` calls
+        '''
+        if len(self.latencies) == 0:
+            return {}
+
+        latencies = np.array(self.latencies) * 1000.
+        return {
+            'num_frames': len(latencies),
+            'mean': float(latencies.mean()),
+            'p50': float(np.percentile(latencies, 50)),
+            'p95': float(np.percentile(latencies, 95)),
+            'max': float(latencies.max()),
+        }
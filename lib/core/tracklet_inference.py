@@ -0,0 +1,261 @@
+# -*- coding: utf-8 -*-
+
+# Max-Planck-Gesellschaft zur Förderung der Wissenschaften e.V. (MPG) is
+# holder of all proprietary rights on this computer program.
+# You can only use this computer program if you have closed
+# a license agreement with MPG or you get the right to use the computer
+# program from someone who is authorized to grant you that right.
+# Any use of the computer program without a valid license is prohibited and
+# liable to prosecution.
+#
+# Copyright©2019 Max-Planck-Gesellschaft zur Förderung
+# der Wissenschaften e.V. (MPG). acting on behalf of its Max Planck Institute
+# for Intelligent Systems. All rights reserved.
+#
+# Contact: ps-license@tuebingen.mpg.de
+
+import torch
+import numpy as np
+from tqdm import tqdm
+from torch.nn.utils.rnn import pad_sequence
+from torch.utils.data import DataLoader
+
+from lib.models.quantize import quantize_vibe_demo
+from lib.dataset.inference import Inference, TrackletBatches
+
+
+class MultiTrackletInference():
+    """
+    Runs VIBE_Demo on all tracklets of a video at once.
+
+    Crops of every person go through one DataLoader and share the backbone
+    batches, every batch is cropped with one batched crop call per tracklet.
+    Each tracklet is split into sequences of `seqlen` frames (the demo used
+    to run one sequence per `vibe_batch_size` chunk), the temporal
+    encoder runs over a packed batch of all completed sequences and the
+    regressor outputs are scattered back to the persons they belong to.
+
+    With `carry_gru_state` the GRU state of every tracklet is carried from
+    one sequence to the next, the output equals running each tracklet as one
+    long sequence while memory stays bounded by `batch_size` and `seqlen`.
+
+    `outputs` selects the regressor outputs (see Regressor.forward), the
+    per person results only hold the keys of the selected ones.
+    """
+    RESULT_KEYS = {
+        'theta': ['pred_cam', 'pose', 'betas'],
+        'verts': ['verts'],
+        'kp_3d': ['joints3d'],
+        'kp_2d': ['smpl_joints2d'],
+    }
+
+    def __init__(
+            self,
+            model,
+            device,
+            batch_size=450,
+            seqlen=None,
+            num_workers=16,
+            bbox_scale=1.1,
+            crop_size=224,
+            carry_gru_state=False,
+            outputs=('theta', 'verts', 'kp_3d', 'kp_2d'),
+    ):
+        if carry_gru_state and model.encoder.gru.bidirectional:
+            raise ValueError('carry_gru_state needs a unidirectional temporal encoder')
+
+        self.model = model
+        self.device = device
+        self.batch_size = batch_size
+        self.seqlen = seqlen if seqlen is not None else batch_size
+        self.num_workers = num_workers
+        self.bbox_scale = bbox_scale
+        self.crop_size = crop_size
+        self.carry_gru_state = carry_gru_state
+        self.outputs = list(outputs)
+
+    def build_datasets(self, frame_source, tracking_results):
+        datasets = []
+        for person_id, tracklet in tracking_results.items():
+            datasets.append(Inference(
+                image_folder=frame_source,
+                frames=tracklet['frames'],
+                bboxes=tracklet.get('bbox'),
+                joints2d=tracklet.get('joints2d'),
+                scale=self.bbox_scale,
+                crop_size=self.crop_size,
+                normalize=not self.model.raw_input,
+            ))
+        return datasets
+
+    @staticmethod
+    def group_by_keypoints(datasets):
+        '''
+        Tracklets with and without 2D keypoints yield different batches, they are run separately.
+        :return: list of dataset index lists, one per value of has_keypoints
+        '''
+        groups = {}
+        for idx, dataset in enumerate(datasets):
+            groups.setdefault(dataset.has_keypoints, []).append(idx)
+        return list(groups.values())
+
+    def quantize(self, frame_source, tracking_results, num_batches=8, batch_size=16):
+        '''
+        Replace the model by its int8 variant (CPU only), see lib.models.quantize.
+        The backbone is calibrated on crops spread evenly over the tracklets of this video.
+        :param num_batches (int): number of calibration batches
+        :param batch_size (int): crops per calibration batch
+        '''
+        datasets = self.build_datasets(frame_source, tracking_results)
+        groups = [TrackletBatches([datasets[i] for i in ids], batch_size) for ids in self.group_by_keypoints(datasets)]
+        batches = [(group, i) for group in groups for i in range(len(group))]
+        batch_ids = np.unique(np.linspace(0, len(batches) - 1, num_batches).astype(int)) if len(batches) > 0 else []
+        calibration_batches = (
+            group[i][0] if group.has_keypoints else group[i]
+            for group, i in (batches[j] for j in batch_ids)
+        )
+
+        self.model = quantize_vibe_demo(self.model, calibration_batches)
+        self.device = torch.device('cpu')
+
+    @torch.no_grad()
+    def __call__(self, frame_source, tracking_results):
+        '''
+        :param frame_source: frame source of the video, see lib.utils.frame_source
+        :param tracking_results (dict): person_id -> {'frames', 'bbox'} for bbox tracking
+            or person_id -> {'frames', 'joints2d'} for pose tracking
+        :return: person_id -> dict of per frame predictions (torch.Tensor on cpu) and
+            the bboxes and frames used for cropping
+        '''
+        person_ids = list(tracking_results.keys())
+        datasets = self.build_datasets(frame_source, tracking_results)
+
+        output = {}
+        for ids in self.group_by_keypoints(datasets):
+            results = self.run_datasets([datasets[i] for i in ids])
+            for i, result in zip(ids, results):
+                output[person_ids[i]] = result
+
+        return {person_id: output[person_id] for person_id in person_ids}
+
+    def run_datasets(self, datasets):
+        '''
+        Runs tracklets that all have 2D keypoints or all have none.
+        :return: list of per person predictions, in the order of datasets
+        '''
+        has_keypoints = datasets[0].has_keypoints
+
+        # sequence boundaries of every person, as positions in the concatenated dataset
+        offsets = np.cumsum([0] + [len(d) for d in datasets])
+        sequences = []
+        for person_idx, dataset in enumerate(datasets):
+            for start in range(0, len(dataset), self.seqlen):
+                end = min(start + self.seqlen, len(dataset))
+                sequences.append((person_idx, offsets[person_idx] + start, offsets[person_idx] + end))
+
+        result_keys = [k for output in self.outputs for k in self.RESULT_KEYS[output]] + ['norm_joints2d']
+        results = [{k: [] for k in result_keys} for _ in datasets]
+        hidden_states = [None for _ in datasets]
+
+        dataloader = DataLoader(
+            TrackletBatches(datasets, self.batch_size),
+            batch_size=None,
+            num_workers=self.num_workers,
+        )
+
+        features, keypoints = [], []
+        num_seen, next_seq = 0, 0
+        for batch in tqdm(dataloader):
+            if has_keypoints:
+                batch, nj2d = batch
+                keypoints.append(nj2d.numpy().reshape(-1, 21, 3))
+
+            features.append(self.model.extract_features(batch.to(self.device)))
+            num_seen += batch.shape[0]
+
+            # run the temporal part on every sequence whose features are complete
+            num_complete = next_seq
+            while num_complete < len(sequences) and sequences[num_complete][2] <= num_seen:
+                num_complete += 1
+
+            if num_complete > next_seq:
+                features, keypoints = self.run_sequences(
+                    sequences[next_seq:num_complete], features, keypoints, results, hidden_states
+                )
+                next_seq = num_complete
+
+        output = []
+        for dataset, result in zip(datasets, results):
+            person_output = {k: torch.cat(v, dim=0) for k, v in result.items() if k != 'norm_joints2d'}
+            person_output['norm_joints2d'] = np.concatenate(result['norm_joints2d'], axis=0) \
+                if has_keypoints else None
+            person_output['bboxes'] = dataset.bboxes
+            person_output['frames'] = dataset.frames
+            output.append(person_output)
+
+        return output
+
+    def run_sequences(self, sequences, features, keypoints, results, hidden_states):
+        features = torch.cat(features, dim=0)
+        keypoints = np.concatenate(keypoints, axis=0) if len(keypoints) > 0 else None
+
+        # the sequences are contiguous, features[0] is the first frame of sequences[0]
+        base = sequences[0][1]
+        num_frames = sequences[-1][2] - base
+
+        if self.carry_gru_state:
+            # a sequence needs the final state of the previous one of its tracklet,
+            # every GRU batch takes at most one pending sequence per tracklet
+            pending = sequences
+            while len(pending) > 0:
+                batch, rest, seen = [], [], set()
+                for seq in pending:
+                    (rest if seq[0] in seen else batch).append(seq)
+                    seen.add(seq[0])
+                self.run_batch(batch, base, features, keypoints, results, hidden_states)
+                pending = rest
+        else:
+            self.run_batch(sequences, base, features, keypoints, results)
+
+        # keep the features of the sequences that are not complete yet
+        features = [features[num_frames:]]
+        keypoints = [keypoints[num_frames:]] if keypoints is not None else []
+        return features, keypoints
+
+    def run_batch(self, sequences, base, features, keypoints, results, hidden_states=None):
+        lengths = [end - start for _, start, end in sequences]
+
+        feature = pad_sequence([features[start - base:end - base] for _, start, end in sequences], batch_first=True)
+        if hidden_states is not None:
+            gru = self.model.encoder.gru
+            zeros = feature.new_zeros(gru.num_layers, gru.hidden_size)
+            hidden = torch.stack([
+                hidden_states[person_idx] if hidden_states[person_idx] is not None else zeros
+                for person_idx, _, _ in sequences
+            ], dim=1)
+            feature, hidden = self.model.encode(feature, lengths, hidden=hidden, return_hidden=True)
+            for i, (person_idx, _, _) in enumerate(sequences):
+                hidden_states[person_idx] = hidden[:, i]
+        else:
+            feature = self.model.encode(feature, lengths)
+
+        outputs = [self.model.regressor(f, outputs=self.outputs)[-1] for f in torch.split(feature, self.batch_size)]
+        pred = {k: torch.cat([o[k] for o in outputs], dim=0).cpu() for k in self.outputs}
+
+        # scatter back to the persons
+        offset = 0
+        for (person_idx, start, end), length in zip(sequences, lengths):
+            result, sl = results[person_idx], slice(offset, offset + length)
+            if 'theta' in pred:
+                result['pred_cam'].append(pred['theta'][sl, :3])
+                result['pose'].append(pred['theta'][sl, 3:75])
+                result['betas'].append(pred['theta'][sl, 75:])
+            if 'verts' in pred:
+                result['verts'].append(pred['verts'][sl])
+            if 'kp_3d' in pred:
+                result['joints3d'].append(pred['kp_3d'][sl])
+            if 'kp_2d' in pred:
+                result['smpl_joints2d'].append(pred['kp_2d'][sl])
+            if keypoints is not None:
+                result['norm_joints2d'].append(keypoints[start - base:end - base])
+            offset += length
@@ -67,14 +67,17 @@ def extract_features(model, video, bbox, debug=False, batch_size=200, kp_2d=None
         plt.imshow(frame)
         plt.show()
 
+    # a fused model takes raw [0, 1] crops, see HMR.fuse_for_inference
+    normalize = not model.raw_input
     if dataset == 'insta':
         video = torch.cat(
-            [convert_cvimg_to_tensor(image).unsqueeze(0) for image in video], dim=0
+            [convert_cvimg_to_tensor(image, normalize=normalize).unsqueeze(0) for image in video], dim=0
         ).to(device)
     else:
         # crop bbox locations
         video = torch.cat(
-            [get_single_image_crop(image, bbox, scale=scale).unsqueeze(0) for image, bbox in zip(video, bbox)], dim=0
+            [get_single_image_crop(image, bbox, scale=scale, normalize=normalize).unsqueeze(0)
+             for image, bbox in zip(video, bbox)], dim=0
         ).to(device)
 
     features = []
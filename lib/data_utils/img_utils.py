@@ -23,6 +23,10 @@ import numpy as np
 import torchvision.transforms as transforms
 from skimage.util.shape import view_as_windows
 
+# ImageNet statistics the crops are normalized with
+IMG_NORM_MEAN = [0.485, 0.456, 0.406]
+IMG_NORM_STD = [0.229, 0.224, 0.225]
+
 def get_image(filename):
     image = cv2.imread(filename)
     return cv2.cvtColor(image, cv2.COLOR_RGB2BGR)
@@ -85,6 +89,33 @@ def gen_trans_from_patch_cv(c_x, c_y, src_width, src_height, dst_width, dst_heig
 
     return trans
 
+def gen_trans_from_patch_cv_batch(c_x, c_y, src_width, src_height, dst_width, dst_height, scale, rot=0., inv=False):
+    '''
+    Vectorized gen_trans_from_patch_cv, computes the affine matrices of N patches at once.
+    :param c_x, c_y, src_width, src_height (ndarray, N): patch centers and sizes in the source image
+    :param scale, rot (float or ndarray, N): patch scale and rotation in degrees
+    :return: (ndarray, Nx2x3) affine transforms
+    '''
+    c = np.stack([c_x, c_y], axis=-1).astype(np.float64)
+    rot_rad = np.pi * np.asarray(rot, dtype=np.float64) / 180
+    sn, cs = np.broadcast_to(np.sin(rot_rad), c.shape[:1]), np.broadcast_to(np.cos(rot_rad), c.shape[:1])
+    # scale of the patch axes, the linear part maps the rotated source axes onto the patch axes
+    sx = dst_width / (np.asarray(src_width, dtype=np.float64) * scale)
+    sy = dst_height / (np.asarray(src_height, dtype=np.float64) * scale)
+    dst_center = np.array([dst_width * 0.5, dst_height * 0.5])
+
+    trans = np.zeros((c.shape[0], 2, 3))
+    if inv:
+        trans[:, 0, :2] = np.stack([cs / sx, -sn / sy], axis=-1)
+        trans[:, 1, :2] = np.stack([sn / sx, cs / sy], axis=-1)
+        trans[:, :, 2] = c - trans[:, :, :2] @ dst_center
+    else:
+        trans[:, 0, :2] = np.stack([sx * cs, sx * sn], axis=-1)
+        trans[:, 1, :2] = np.stack([-sy * sn, sy * cs], axis=-1)
+        trans[:, :, 2] = dst_center - np.einsum('nij,nj->ni', trans[:, :, :2], c)
+
+    return trans
+
 def generate_patch_image_cv(cvimg, c_x, c_y, bb_width, bb_height, patch_width, patch_height, do_flip, scale, rot):
     img = cvimg.copy()
     img_height, img_width, img_channels = img.shape
@@ -177,7 +208,7 @@ def get_image_crops(image_file, bboxes):
     batch_image = torch.cat([x.unsqueeze(0) for x in crop_images])
     return batch_image
 
-def get_single_image_crop(image, bbox, scale=1.3):
+def get_single_image_crop(image, bbox, scale=1.3, normalize=True):
     if isinstance(image, str):
         if os.path.isfile(image):
             image = cv2.cvtColor(cv2.imread(image), cv2.COLOR_BGR2RGB)
@@ -202,11 +233,11 @@ def get_single_image_crop(image, bbox, scale=1.3):
         rot=0,
     )
 
-    crop_image = convert_cvimg_to_tensor(crop_image)
+    crop_image = convert_cvimg_to_tensor(crop_image, normalize=normalize)
 
     return crop_image
 
-def get_single_image_crop_demo(image, bbox, kp_2d, scale=1.2, crop_size=224):
+def get_single_image_crop_demo(image, bbox, kp_2d, scale=1.2, crop_size=224, normalize=True):
     if isinstance(image, str):
         if os.path.isfile(image):
             image = cv2.cvtColor(cv2.imread(image), cv2.COLOR_BGR2RGB)
@@ -237,17 +268,57 @@ def get_single_image_crop_demo(image, bbox, kp_2d, scale=1.2, crop_size=224):
 
     raw_image = crop_image.copy()
 
-    crop_image = convert_cvimg_to_tensor(crop_image)
+    crop_image = convert_cvimg_to_tensor(crop_image, normalize=normalize)
 
     return crop_image, raw_image, kp_2d
 
+def get_batch_image_crop_demo(images, bboxes, kp_2d=None, scale=1.2, crop_size=224, bgr=False, normalize=True):
+    '''
+    Batched get_single_image_crop_demo for a chunk of a tracklet.
+    :param images (list or ndarray): N uint8 images (HxWx3), RGB unless bgr is set
+    :param bboxes (ndarray, Nx4): bbox centers and sizes
+    :param kp_2d (ndarray, NxJx3): keypoints in image coordinates or None
+    :param scale (float): bbox crop scaling factor
+    :param crop_size (int): crop width and height
+    :param bgr (bool): the images are BGR, e.g. read from a frame source. Crops are always returned as RGB
+    :param normalize (bool): normalize the crops with the ImageNet statistics, else they are only scaled to [0, 1]
+    :return: normalized crops (torch.Tensor, Nx3xSxS), raw crops (ndarray, NxSxSx3), keypoints in crop coordinates
+    '''
+    bboxes = np.asarray(bboxes)
+    trans = gen_trans_from_patch_cv_batch(
+        bboxes[:, 0], bboxes[:, 1], bboxes[:, 2], bboxes[:, 3],
+        crop_size, crop_size, scale,
+    )
+
+    # warpAffine only reads the pixels under each crop, the crops are written into one buffer
+    raw_images = np.empty((len(images), crop_size, crop_size, 3), dtype=np.uint8)
+    for image, t, raw_image in zip(images, trans, raw_images):
+        cv2.warpAffine(image, t, (crop_size, crop_size), dst=raw_image,
+                       flags=cv2.INTER_LINEAR, borderMode=cv2.BORDER_CONSTANT)
+    if bgr:
+        raw_images = np.ascontiguousarray(raw_images[..., ::-1])
+
+    if kp_2d is not None:
+        kp_2d = kp_2d.copy()
+        kp_2d[..., :2] = np.einsum('nij,nkj->nki', trans[:, :, :2], kp_2d[..., :2]) + trans[:, None, :, 2]
+
+    norm_images = torch.from_numpy(raw_images).permute(0, 3, 1, 2).float().div_(255.)
+    if normalize:
+        mean = torch.tensor(IMG_NORM_MEAN).view(1, 3, 1, 1)
+        std = torch.tensor(IMG_NORM_STD).view(1, 3, 1, 1)
+        norm_images = norm_images.sub_(mean).div_(std)
+    norm_images = norm_images.contiguous()
+
+    return norm_images, raw_images, kp_2d
+
 def read_image(filename):
     image = cv2.cvtColor(cv2.imread(filename), cv2.COLOR_BGR2RGB)
     image = cv2.resize(image, (224,224))
     return convert_cvimg_to_tensor(image)
 
-def convert_cvimg_to_tensor(image):
-    transform = get_default_transform()
+def convert_cvimg_to_tensor(image, normalize=True):
+    # without normalize the image is only scaled to [0, 1], the input of models fused with raw_input
+    transform = get_default_transform() if normalize else transforms.ToTensor()
     image = transform(image)
     return image
 
@@ -311,7 +382,7 @@ def normalize_2d_kp(kp_2d, crop_size=224, inv=False):
 
 def get_default_transform():
     normalize = transforms.Normalize(
-        mean=[0.485, 0.456, 0.406], std=[0.229, 0.224, 0.225]
+        mean=IMG_NORM_MEAN, std=IMG_NORM_STD
     )
     transform = transforms.Compose([
         transforms.ToTensor(),
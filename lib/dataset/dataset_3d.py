@@ -30,9 +30,11 @@ from lib.data_utils.img_utils import normalize_2d_kp, transfrom_keypoints, split
 logger = logging.getLogger(__name__)
 
 class Dataset3D(Dataset):
-    def __init__(self, set, seqlen, overlap=0., folder=None, dataset_name=None, debug=False):
+    def __init__(self, set, seqlen, overlap=0., folder=None, dataset_name=None, debug=False, return_video=False):
 
         self.folder = folder
+        # return_video: also crop the images, e.g. to evaluate a different backbone than the stored features
+        self.return_video = return_video
         self.set = set
         self.dataset_name = dataset_name
         self.seqlen = seqlen
@@ -159,7 +161,7 @@ class Dataset3D(Dataset):
             # target['center'] = self.db['bbox'][start_index:end_index+1, :2]
             # target['valid'] = torch.from_numpy(self.db['valid'][start_index:end_index+1])
 
-        if self.debug:
+        if self.debug or self.return_video:
             from lib.data_utils.img_utils import get_single_image_crop
 
             if self.dataset_name == 'mpii3d':
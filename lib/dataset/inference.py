@@ -16,28 +16,28 @@
 
 import os
 import cv2
+import torch
 import numpy as np
 import os.path as osp
-from torch.utils.data import Dataset
+from torch.utils.data import Dataset, IterableDataset
 from torchvision.transforms.functional import to_tensor
 
 from lib.utils.smooth_bbox import get_all_bbox_params
-from lib.data_utils.img_utils import get_single_image_crop_demo
+from lib.utils.frame_source import ImageFolderSource
+from lib.data_utils.img_utils import get_single_image_crop_demo, get_batch_image_crop_demo
 
 
 class Inference(Dataset):
-    def __init__(self, image_folder, frames, bboxes=None, joints2d=None, scale=1.0, crop_size=224):
-        self.image_file_names = [
-            osp.join(image_folder, x)
-            for x in os.listdir(image_folder)
-            if x.endswith('.png') or x.endswith('.jpg')
-        ]
-        self.image_file_names = sorted(self.image_file_names)
-        self.image_file_names = np.array(self.image_file_names)[frames]
+    def __init__(self, image_folder, frames, bboxes=None, joints2d=None, scale=1.0, crop_size=224, normalize=True):
+        # image_folder is either a folder of extracted frames or a frame source from lib.utils.frame_source
+        if isinstance(image_folder, str):
+            image_folder = ImageFolderSource(image_folder)
+        self.frame_source = image_folder
         self.bboxes = bboxes
         self.joints2d = joints2d
         self.scale = scale
         self.crop_size = crop_size
+        self.normalize = normalize
         self.frames = frames
         self.has_keypoints = True if joints2d is not None else False
 
@@ -48,15 +48,14 @@ class Inference(Dataset):
             bboxes[:, 2:] = 150. / bboxes[:, 2:]
             self.bboxes = np.stack([bboxes[:, 0], bboxes[:, 1], bboxes[:, 2], bboxes[:, 2]]).T
 
-            self.image_file_names = self.image_file_names[time_pt1:time_pt2]
             self.joints2d = joints2d[time_pt1:time_pt2]
             self.frames = frames[time_pt1:time_pt2]
 
     def __len__(self):
-        return len(self.image_file_names)
+        return len(self.frames)
 
     def __getitem__(self, idx):
-        img = cv2.cvtColor(cv2.imread(self.image_file_names[idx]), cv2.COLOR_BGR2RGB)
+        img = cv2.cvtColor(self.frame_source[self.frames[idx]], cv2.COLOR_BGR2RGB)
 
         bbox = self.bboxes[idx]
 
@@ -67,12 +66,73 @@ class Inference(Dataset):
             bbox,
             kp_2d=j2d,
             scale=self.scale,
-            crop_size=self.crop_size)
+            crop_size=self.crop_size,
+            normalize=self.normalize)
         if self.has_keypoints:
             return norm_img, kp_2d
         else:
             return norm_img
 
+    def get_batch(self, start, end):
+        '''
+        Crops frames [start, end) of the tracklet with one batched crop call.
+        :return: crops (torch.Tensor, Nx3xSxS) and the keypoints in crop coordinates if available
+        '''
+        images = [self.frame_source[frame] for frame in self.frames[start:end]]
+        j2d = self.joints2d[start:end] if self.has_keypoints else None
+
+        norm_img, raw_img, kp_2d = get_batch_image_crop_demo(
+            images,
+            self.bboxes[start:end],
+            kp_2d=j2d,
+            scale=self.scale,
+            crop_size=self.crop_size,
+            bgr=True,
+            normalize=self.normalize)
+        if self.has_keypoints:
+            return norm_img, torch.from_numpy(kp_2d)
+        else:
+            return norm_img
+
+
+class TrackletBatches(Dataset):
+    """
+    Batches of crops over several Inference datasets. Batch `idx` holds the
+    same samples as batch `idx` of a DataLoader over ConcatDataset(datasets)
+    with `batch_size`, but every tracklet in it is cropped with one
+    Inference.get_batch call. Use with DataLoader(..., batch_size=None).
+    Either all or none of the datasets have 2D keypoints.
+    """
+    def __init__(self, datasets, batch_size):
+        if len(set(d.has_keypoints for d in datasets)) > 1:
+            raise ValueError('TrackletBatches needs tracklets that all have 2D keypoints or all have none')
+        self.datasets = datasets
+        self.batch_size = batch_size
+        self.offsets = np.cumsum([0] + [len(d) for d in datasets])
+        self.has_keypoints = len(datasets) > 0 and datasets[0].has_keypoints
+
+    def __len__(self):
+        return int(np.ceil(self.offsets[-1] / self.batch_size))
+
+    def __getitem__(self, idx):
+        start = idx * self.batch_size
+        end = min(start + self.batch_size, self.offsets[-1])
+
+        norm_imgs, kp_2ds = [], []
+        for dataset, offset, next_offset in zip(self.datasets, self.offsets[:-1], self.offsets[1:]):
+            if offset >= end or next_offset <= start:
+                continue
+            batch = dataset.get_batch(max(start, offset) - offset, min(end, next_offset) - offset)
+            if self.has_keypoints:
+                batch, kp_2d = batch
+                kp_2ds.append(kp_2d)
+            norm_imgs.append(batch)
+
+        if self.has_keypoints:
+            return torch.cat(norm_imgs, dim=0), torch.cat(kp_2ds, dim=0)
+        else:
+            return torch.cat(norm_imgs, dim=0)
+
 
 class ImageFolder(Dataset):
     def __init__(self, image_folder):
@@ -89,3 +149,19 @@ class ImageFolder(Dataset):
     def __getitem__(self, idx):
         img = cv2.cvtColor(cv2.imread(self.image_file_names[idx]), cv2.COLOR_BGR2RGB)
         return to_tensor(img)
+
+
+class FrameStream(IterableDataset):
+    """
+    Streams every frame of a frame source once, in order. Used to feed the
+    multi person tracker without extracting the video to disk.
+    """
+    def __init__(self, frame_source):
+        self.frame_source = frame_source
+
+    def __len__(self):
+        return len(self.frame_source)
+
+    def __iter__(self):
+        for img in self.frame_source:
+            yield to_tensor(cv2.cvtColor(img, cv2.COLOR_BGR2RGB))
@@ -18,7 +18,7 @@ from lib.dataset import Dataset3D
 from lib.core.config import THREEDPW_DIR
 
 class ThreeDPW(Dataset3D):
-    def __init__(self, set, seqlen, overlap=0.75, debug=False):
+    def __init__(self, set, seqlen, overlap=0.75, debug=False, return_video=False):
         db_name = '3dpw'
 
         # during testing we don't need data augmentation
@@ -33,5 +33,6 @@ class ThreeDPW(Dataset3D):
             overlap=overlap,
             dataset_name=db_name,
             debug=debug,
+            return_video=return_video,
         )
         print(f'{db_name} - number of dataset objects {self.__len__()}')
\ No newline at end of file
@@ -0,0 +1,117 @@
+# -*- coding: utf-8 -*-
+
+# Max-Planck-Gesellschaft zur Förderung der Wissenschaften e.V. (MPG) is
+# holder of all proprietary rights on this computer program.
+# You can only use this computer program if you have closed
+# a license agreement with MPG or you get the right to use the computer
+# program from someone who is authorized to grant you that right.
+# Any use of the computer program without a valid license is prohibited and
+# liable to prosecution.
+#
+# Copyright©2019 Max-Planck-Gesellschaft zur Förderung
+# der Wissenschaften e.V. (MPG). acting on behalf of its Max Planck Institute
+# for Intelligent Systems. All rights reserved.
+#
+# Contact: ps-license@tuebingen.mpg.de
+
+import os
+import time
+import torch
+import hashlib
+import os.path as osp
+import torch.nn as nn
+
+from lib.core.config import VIBE_DATA_DIR
+
+
+class FeatureExtractor(nn.Module):
+    """ The ResNet50 backbone of HMR as a module of its own, so it can be traced or compiled """
+    def __init__(self, hmr):
+        super(FeatureExtractor, self).__init__()
+        self.hmr = hmr
+
+    def forward(self, x):
+        return self.hmr.feature_extractor(x)
+
+
+class CompiledVIBE_Demo():
+    """
+    VIBE_Demo with a compiled (traced, torch.compile'd or quantized) backbone.
+    Crops are fed in channels_last memory format, everything else is
+    forwarded to the wrapped model.
+    """
+    def __init__(self, model, backbone):
+        self.model = model
+        self.backbone = backbone
+
+    def extract_features(self, input):
+        return self.backbone(input.contiguous(memory_format=torch.channels_last))
+
+    def __getattr__(self, name):
+        return getattr(self.model, name)
+
+
+def get_cache_key(module, device, mode, weights_files=None, raw_input=False):
+    '''
+    Key of a compiled backbone, from the files (path, size and modification time) the weights were loaded from.
+    Without weights files every weight tensor is hashed, which takes a full pass over the weights.
+    '''
+    sha = hashlib.sha1(f'{torch.__version__}_{device.type}_{mode}_{raw_input}'.encode())
+    if weights_files is not None:
+        for weights_file in weights_files:
+            stat = os.stat(weights_file)
+            sha.update(f'{osp.abspath(weights_file)}_{stat.st_size}_{stat.st_mtime_ns}'.encode())
+    else:
+        for k, v in module.state_dict().items():
+            sha.update(k.encode())
+            sha.update(v.detach().cpu().numpy().tobytes())
+    return sha.hexdigest()[:16]
+
+
+def compile_vibe_demo(model, mode='script', cache_dir=osp.join(VIBE_DATA_DIR, 'compiled'), weights_files=None):
+    '''
+    Compile the backbone of VIBE_Demo for inference.
+
+    script: trace and freeze the backbone with TorchScript, the frozen graph is cached in cache_dir and
+        torch.jit.optimize_for_inference (conv/bn folding, oneDNN kernels on CPU) runs on every load.
+    compile: torch.compile with dynamic batch sizes, the inductor artifacts are cached in cache_dir.
+
+    The temporal encoder runs one fused GRU call over packed sequences and the regressor is a small MLP plus
+    SMPL, they stay in eager mode.
+    :param model (VIBE_Demo): model in eval mode on its target device
+    :param mode (str): 'script' or 'compile'
+    :param cache_dir (str): directory of the compiled artifacts
+    :param weights_files (list): checkpoints or bundle the weights were loaded from, they key the script cache,
+        None hashes the weights instead
+    :return: CompiledVIBE_Demo
+    '''
+    start = time.time()
+    device = next(model.parameters()).device
+    os.makedirs(cache_dir, exist_ok=True)
+    backbone = FeatureExtractor(model.hmr).eval().to(memory_format=torch.channels_last)
+
+    if mode == 'script':
+        key = get_cache_key(backbone, device, mode, weights_files, model.raw_input)
+        cache_file = osp.join(cache_dir, f'backbone_{key}.pt')
+        if osp.isfile(cache_file):
+            frozen = torch.jit.load(cache_file, map_location=device)
+            print(f'=> loaded compiled backbone from \'{cache_file}\'')
+        else:
+            example = torch.zeros(2, 3, 224, 224, device=device).contiguous(memory_format=torch.channels_last)
+            with torch.no_grad():
+                frozen = torch.jit.freeze(torch.jit.trace(backbone, example, check_trace=False))
+            torch.jit.save(frozen, cache_file)
+            print(f'=> saved compiled backbone to \'{cache_file}\'')
+        # graphs rewritten by optimize_for_inference cannot be serialized, only the frozen graph is cached
+        backbone = torch.jit.optimize_for_inference(frozen)
+    elif mode == 'compile':
+        if not hasattr(torch, 'compile'):
+            raise ValueError('compile mode needs torch >= 2.0, use script mode instead')
+        os.environ.setdefault('TORCHINDUCTOR_CACHE_DIR', osp.abspath(cache_dir))
+        os.environ.setdefault('TORCHINDUCTOR_FX_GRAPH_CACHE', '1')
+        backbone = torch.compile(backbone, dynamic=True)
+    else:
+        raise ValueError(f'Unknown compile mode \'{mode}\'')
+
+    print(f'Compiling the VIBE backbone ({mode}) took {time.time() - start:.2f}s')
+    return CompiledVIBE_Demo(model, backbone)
@@ -0,0 +1,208 @@
+# -*- coding: utf-8 -*-
+
+# Max-Planck-Gesellschaft zur Förderung der Wissenschaften e.V. (MPG) is
+# holder of all proprietary rights on this computer program.
+# You can only use this computer program if you have closed
+# a license agreement with MPG or you get the right to use the computer
+# program from someone who is authorized to grant you that right.
+# Any use of the computer program without a valid license is prohibited and
+# liable to prosecution.
+#
+# Copyright©2019 Max-Planck-Gesellschaft zur Förderung
+# der Wissenschaften e.V. (MPG). acting on behalf of its Max Planck Institute
+# for Intelligent Systems. All rights reserved.
+#
+# Contact: ps-license@tuebingen.mpg.de
+
+import os
+import json
+import time
+import torch
+import numpy as np
+import os.path as osp
+import torch.nn as nn
+from types import SimpleNamespace
+
+from lib.core.config import VIBE_DATA_DIR
+from lib.models.jit import FeatureExtractor
+
+ONNX_DIR = osp.join(VIBE_DATA_DIR, 'onnx')
+ONNX_GRAPHS = ['backbone', 'encoder', 'regressor']
+
+
+class TemporalGraph(nn.Module):
+    """ The GRU encoder with an explicit input and output state, all sequences of one call have the same length """
+    def __init__(self, encoder):
+        super(TemporalGraph, self).__init__()
+        self.encoder = encoder
+
+    def forward(self, feature, hidden):
+        return self.encoder(feature, hidden=hidden, return_hidden=True)
+
+
+class RegressorGraph(nn.Module):
+    """ The IEF regressor and SMPL, the outputs of the last iteration as a tuple """
+    def __init__(self, regressor):
+        super(RegressorGraph, self).__init__()
+        self.regressor = regressor
+
+    def forward(self, feature):
+        pred = self.regressor(feature)[-1]
+        return pred['theta'], pred['verts'], pred['kp_3d'], pred['kp_2d']
+
+
+def export_graph(module, inputs, onnx_file, input_names, output_names, dynamic_axes, opset_version):
+    # the wrappers are created in training mode, the exporter restores that mode on all submodules
+    module = module.eval()
+    kwargs = dict(
+        input_names=input_names,
+        output_names=output_names,
+        dynamic_axes=dynamic_axes,
+        opset_version=opset_version,
+    )
+    with torch.no_grad():
+        try:
+            # the dynamo exporter does not take dynamic_axes
+            torch.onnx.export(module, inputs, onnx_file, dynamo=False, **kwargs)
+        except TypeError:
+            # torch < 2.5 has no dynamo argument
+            torch.onnx.export(module, inputs, onnx_file, **kwargs)
+
+
+def export_vibe_demo(model, onnx_dir=ONNX_DIR, opset_version=17):
+    '''
+    Export VIBE_Demo to three ONNX graphs with dynamic batch and sequence axes:
+    backbone.onnx (crops -> features), encoder.onnx (features, GRU state -> temporal features, GRU state)
+    and regressor.onnx (temporal features -> theta, verts, kp_3d, kp_2d, SMPL LBS included).
+    The demo runs the backbone batches and the temporal batches separately, so do the graphs.
+    :param model (VIBE_Demo): float model on the cpu
+    :param onnx_dir (str): output directory, the model config is written next to the graphs
+    :param opset_version (int): ONNX opset
+    '''
+    start = time.time()
+    os.makedirs(onnx_dir, exist_ok=True)
+    gru = model.encoder.gru
+    num_states = gru.num_layers * (2 if gru.bidirectional else 1)
+
+    export_graph(
+        FeatureExtractor(model.hmr),
+        (torch.zeros(2, 3, 224, 224),),
+        osp.join(onnx_dir, 'backbone.onnx'),
+        input_names=['crops'],
+        output_names=['feature'],
+        dynamic_axes={'crops': {0: 'batch'}, 'feature': {0: 'batch'}},
+        opset_version=opset_version,
+    )
+    export_graph(
+        TemporalGraph(model.encoder),
+        (torch.zeros(2, 3, 2048), torch.zeros(num_states, 2, gru.hidden_size)),
+        osp.join(onnx_dir, 'encoder.onnx'),
+        input_names=['feature', 'hidden'],
+        output_names=['temporal_feature', 'hidden_out'],
+        dynamic_axes={
+            'feature': {0: 'batch', 1: 'seqlen'},
+            'hidden': {1: 'batch'},
+            'temporal_feature': {0: 'batch', 1: 'seqlen'},
+            'hidden_out': {1: 'batch'},
+        },
+        opset_version=opset_version,
+    )
+    export_graph(
+        RegressorGraph(model.regressor),
+        (torch.zeros(2, 2048),),
+        osp.join(onnx_dir, 'regressor.onnx'),
+        input_names=['feature'],
+        output_names=['theta', 'verts', 'kp_3d', 'kp_2d'],
+        dynamic_axes={k: {0: 'batch'} for k in ['feature', 'theta', 'verts', 'kp_3d', 'kp_2d']},
+        opset_version=opset_version,
+    )
+
+    with open(osp.join(onnx_dir, 'config.json'), 'w') as f:
+        json.dump(dict(model.config, raw_input=model.raw_input), f, indent=2)
+    print(f'=> exported VIBE_Demo to ONNX in \'{onnx_dir}\' in {time.time() - start:.2f}s')
+
+
+def has_onnx_export(onnx_dir=ONNX_DIR):
+    files = [f'{name}.onnx' for name in ONNX_GRAPHS] + ['config.json']
+    return all(osp.isfile(osp.join(onnx_dir, f)) for f in files)
+
+
+class OnnxVIBE_Demo():
+    """
+    VIBE_Demo exported by export_vibe_demo, run by onnxruntime on the CPU execution provider.
+
+    It has the extract_features, encode and regressor interface of VIBE_Demo
+    that MultiTrackletInference uses, inputs and outputs are cpu tensors.
+    Sequences of different lengths are not packed in ONNX, encode runs one
+    call per sequence length so the returned GRU state is the one after the
+    last valid frame of every sequence.
+    """
+    def __init__(self, onnx_dir=ONNX_DIR, num_threads=None):
+        import onnxruntime as ort
+
+        start = time.time()
+        with open(osp.join(onnx_dir, 'config.json')) as f:
+            self.config = json.load(f)
+        # the backbone of a fused model takes raw [0, 1] crops, see HMR.fuse_for_inference
+        self.raw_input = self.config.pop('raw_input', False)
+
+        options = ort.SessionOptions()
+        options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        if num_threads is not None:
+            options.intra_op_num_threads = num_threads
+        self.sessions = {
+            name: ort.InferenceSession(osp.join(onnx_dir, f'{name}.onnx'), options, providers=['CPUExecutionProvider'])
+            for name in ONNX_GRAPHS
+        }
+
+        # the GRU layout is read from model.encoder.gru by the inference engines
+        self.encoder = SimpleNamespace(gru=SimpleNamespace(
+            num_layers=self.config['n_layers'],
+            hidden_size=self.config['hidden_size'],
+            bidirectional=self.config['bidirectional'],
+        ))
+        print(f'=> loaded ONNX VIBE_Demo from \'{onnx_dir}\' in {time.time() - start:.2f}s')
+
+    def extract_features(self, input):
+        # input size NCHW
+        feature, = self.sessions['backbone'].run(None, {'crops': input.cpu().numpy()})
+        return torch.from_numpy(feature)
+
+    def encode(self, feature, lengths, hidden=None, return_hidden=False):
+        '''
+        See VIBE_Demo.encode.
+        '''
+        feature = feature.cpu().numpy()
+        lengths = np.asarray(lengths)
+        if hidden is None:
+            gru = self.encoder.gru
+            num_states = gru.num_layers * (2 if gru.bidirectional else 1)
+            hidden = np.zeros((num_states, len(lengths), gru.hidden_size), dtype=np.float32)
+        else:
+            hidden = hidden.cpu().numpy()
+
+        output = [None for _ in lengths]
+        hidden_out = np.empty_like(hidden)
+        for length in np.unique(lengths):
+            idx = np.flatnonzero(lengths == length)
+            y, h = self.sessions['encoder'].run(None, {
+                'feature': np.ascontiguousarray(feature[idx, :length]),
+                'hidden': np.ascontiguousarray(hidden[:, idx]),
+            })
+            for i, j in enumerate(idx):
+                output[j] = y[i]
+            hidden_out[:, idx] = h
+
+        feature = torch.from_numpy(np.concatenate(output, axis=0))
+        if return_hidden:
+            return feature, torch.from_numpy(hidden_out)
+        return feature
+
+    def regressor(self, feature, outputs=None):
+        # the exported graph computes all outputs, the ones not in `outputs` are dropped
+        session = self.sessions['regressor']
+        names = [o.name for o in session.get_outputs()]
+        if outputs is not None:
+            names = [name for name in names if name in outputs]
+        pred = session.run(names, {'feature': feature.cpu().numpy()})
+        return [{name: torch.from_numpy(p) for name, p in zip(names, pred)}]
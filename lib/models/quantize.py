@@ -0,0 +1,88 @@
+# -*- coding: utf-8 -*-
+
+# Max-Planck-Gesellschaft zur Förderung der Wissenschaften e.V. (MPG) is
+# holder of all proprietary rights on this computer program.
+# You can only use this computer program if you have closed
+# a license agreement with MPG or you get the right to use the computer
+# program from someone who is authorized to grant you that right.
+# Any use of the computer program without a valid license is prohibited and
+# liable to prosecution.
+#
+# Copyright©2019 Max-Planck-Gesellschaft zur Förderung
+# der Wissenschaften e.V. (MPG). acting on behalf of its Max Planck Institute
+# for Intelligent Systems. All rights reserved.
+#
+# Contact: ps-license@tuebingen.mpg.de
+
+import copy
+import time
+import torch
+import torch.nn as nn
+from torch.ao.quantization import get_default_qconfig_mapping, quantize_dynamic
+from torch.ao.quantization.quantize_fx import prepare_fx, convert_fx
+
+from lib.models.jit import FeatureExtractor, CompiledVIBE_Demo
+
+
+def get_quantized_engine():
+    engines = torch.backends.quantized.supported_engines
+    engine = 'x86' if 'x86' in engines else 'fbgemm'
+    torch.backends.quantized.engine = engine
+    return engine
+
+
+@torch.no_grad()
+def quantize_backbone(hmr, calibration_batches):
+    '''
+    Static int8 quantization of the HMR ResNet50 backbone (FX graph mode, CPU only).
+    Conv/bn/relu are fused and the activation ranges are observed on the calibration batches.
+    :param hmr (HMR): float model, it is copied to the cpu and not modified
+    :param calibration_batches (iterable): crops (torch.Tensor, Nx3x224x224) in the input domain of hmr,
+        raw [0, 1] crops if hmr.raw_input is set (see HMR.fuse_for_inference), else normalized crops
+    :return: quantized backbone mapping crops to 2048-d features
+    '''
+    start = time.time()
+    engine = get_quantized_engine()
+
+    backbone = FeatureExtractor(copy.deepcopy(hmr)).cpu().eval()
+    example = torch.zeros(1, 3, 224, 224)
+    prepared = prepare_fx(backbone, get_default_qconfig_mapping(engine), example_inputs=(example,))
+
+    # raw crops lie in [0, 1], normalized ones (zero padded borders included) go below 0
+    num_crops, min_value, max_value = 0, float('inf'), float('-inf')
+    for batch in calibration_batches:
+        prepared(batch.cpu())
+        num_crops += batch.shape[0]
+        min_value, max_value = min(min_value, batch.min().item()), max(max_value, batch.max().item())
+    if num_crops == 0:
+        raise ValueError('Static quantization needs at least one calibration batch')
+    if (0. <= min_value and max_value <= 1.) != hmr.raw_input:
+        raise ValueError(f'The calibration crops range over [{min_value:.2f}, {max_value:.2f}], the backbone takes '
+                         f'{"raw [0, 1]" if hmr.raw_input else "normalized"} crops')
+
+    backbone = convert_fx(prepared)
+    print(f'Quantized the VIBE backbone ({engine}) on {num_crops} calibration crops in {time.time() - start:.2f}s')
+    return backbone
+
+
+def quantize_temporal(model):
+    '''
+    Dynamic int8 quantization of the GRU and of the linear layers (temporal encoder and regressor).
+    :param model (VIBE or VIBE_Demo): float model, moved to the cpu but not quantized in place
+    :return: quantized copy of the model
+    '''
+    get_quantized_engine()
+    return quantize_dynamic(model.cpu(), {nn.GRU, nn.Linear}, dtype=torch.qint8)
+
+
+def quantize_vibe_demo(model, calibration_batches):
+    '''
+    Int8 variant of VIBE_Demo for CPU inference: a statically quantized backbone,
+    a dynamically quantized GRU and regressor.
+    :param model (VIBE_Demo): float model in eval mode, moved to the cpu
+    :param calibration_batches (iterable): crops (torch.Tensor, Nx3x224x224), raw [0, 1] crops if model.raw_input
+        is set, else normalized crops
+    :return: CompiledVIBE_Demo on cpu
+    '''
+    backbone = quantize_backbone(model.hmr, calibration_batches)
+    return CompiledVIBE_Demo(quantize_temporal(model), backbone)
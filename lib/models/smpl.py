@@ -6,7 +6,7 @@ import numpy as np
 import os.path as osp
 from smplx import SMPL as _SMPL
 from smplx.utils import ModelOutput, SMPLOutput
-from smplx.lbs import vertices2joints
+from smplx.lbs import vertices2joints, blend_shapes, batch_rodrigues, batch_rigid_transform
 
 from lib.core.config import VIBE_DATA_DIR
 
@@ -61,13 +61,25 @@ H36M_TO_J14 = H36M_TO_J17[:14]
 class SMPL(_SMPL):
     """ Extension of the official SMPL implementation to support more joints """
 
-    def __init__(self, *args, **kwargs):
+    def __init__(self, *args, J_regressor_extra=None, **kwargs):
         super(SMPL, self).__init__(*args, **kwargs)
         joints = [JOINT_MAP[i] for i in JOINT_NAMES]
-        J_regressor_extra = np.load(JOINT_REGRESSOR_TRAIN_EXTRA)
+        if J_regressor_extra is None:
+            J_regressor_extra = np.load(JOINT_REGRESSOR_TRAIN_EXTRA)
         self.register_buffer('J_regressor_extra', torch.tensor(J_regressor_extra, dtype=torch.float32))
         self.joint_map = torch.tensor(joints, dtype=torch.long)
 
+        # get_joints poses only the vertices the joints are read from, J is linear in the betas
+        vertex_joint_ids = self.vertex_joint_selector.extra_joints_idxs.long()
+        joint_vertex_ids = torch.unique(torch.cat([
+            vertex_joint_ids, torch.nonzero(self.J_regressor_extra.abs().sum(dim=0)).flatten()
+        ]))
+        self.register_buffer('joint_vertex_ids', joint_vertex_ids, persistent=False)
+        self.register_buffer('vertex_joint_ids', torch.searchsorted(joint_vertex_ids, vertex_joint_ids), persistent=False)
+        self.register_buffer('J_template', vertices2joints(self.J_regressor, self.v_template[None])[0], persistent=False)
+        self.register_buffer('J_shapedirs', torch.einsum('jv,vkl->jkl', self.J_regressor, self.shapedirs),
+                             persistent=False)
+
     def forward(self, *args, **kwargs):
         kwargs['get_skin'] = True
         smpl_output = super(SMPL, self).forward(*args, **kwargs)
@@ -82,6 +94,52 @@ class SMPL(_SMPL):
                             full_pose=smpl_output.full_pose)
         return output
 
+    def pose_vertices(self, betas, rot_mats, vertex_ids):
+        '''
+        Linear blend skinning of a subset of the vertices.
+        :param betas (torch.Tensor, Bx10): shape parameters
+        :param rot_mats (torch.Tensor, Bx24x3x3): global orientation and body pose as rotation matrices
+        :param vertex_ids (torch.Tensor, V'): vertices to pose
+        :return: posed vertices (torch.Tensor, BxV'x3) and joints (torch.Tensor, Bx24x3)
+        '''
+        batch_size = rot_mats.shape[0]
+        J = self.J_template + blend_shapes(betas, self.J_shapedirs)
+        v_shaped = self.v_template[vertex_ids] + blend_shapes(betas, self.shapedirs[vertex_ids])
+
+        ident = torch.eye(3, dtype=rot_mats.dtype, device=rot_mats.device)
+        pose_feature = (rot_mats[:, 1:] - ident).view(batch_size, -1)
+        posedirs = self.posedirs.view(self.posedirs.shape[0], -1, 3)[:, vertex_ids]
+        v_posed = v_shaped + torch.matmul(pose_feature, posedirs.reshape(posedirs.shape[0], -1)).view(batch_size, -1, 3)
+
+        J_transformed, A = batch_rigid_transform(rot_mats, J, self.parents)
+        T = torch.matmul(self.lbs_weights[vertex_ids], A.view(batch_size, -1, 16)).view(batch_size, -1, 4, 4)
+        verts = torch.matmul(T[:, :, :3, :3], v_posed[..., None])[..., 0] + T[:, :, :3, 3]
+        return verts, J_transformed
+
+    def get_joints(self, betas, body_pose, global_orient, pose2rot=True, J_regressor=None):
+        '''
+        The joints of forward() without posing the full mesh.
+        :param pose2rot (bool): the pose is in axis-angle format, else in rotation matrices
+        :param J_regressor (torch.Tensor, JxV): regress these joints from the posed mesh instead
+        :return: joints (torch.Tensor, BxJx3)
+        '''
+        full_pose = torch.cat([global_orient, body_pose], dim=1)
+        batch_size = full_pose.shape[0]
+        if pose2rot:
+            rot_mats = batch_rodrigues(full_pose.reshape(-1, 3)).view(batch_size, -1, 3, 3)
+        else:
+            rot_mats = full_pose.view(batch_size, -1, 3, 3)
+
+        if J_regressor is not None:
+            vertex_ids = torch.nonzero(J_regressor.abs().sum(dim=0)).flatten()
+            verts, _ = self.pose_vertices(betas, rot_mats, vertex_ids)
+            return vertices2joints(J_regressor[:, vertex_ids], verts)
+
+        verts, joints = self.pose_vertices(betas, rot_mats, self.joint_vertex_ids)
+        extra_joints = vertices2joints(self.J_regressor_extra[:, self.joint_vertex_ids], verts)
+        joints = torch.cat([joints, verts[:, self.vertex_joint_ids], extra_joints], dim=1)
+        return joints[:, self.joint_map, :]
+
 
 def get_smpl_faces():
     smpl = SMPL(SMPL_MODEL_DIR, batch_size=1, create_transl=False)
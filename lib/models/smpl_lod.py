@@ -0,0 +1,287 @@
+# -*- coding: utf-8 -*-
+
+# Max-Planck-Gesellschaft zur Förderung der Wissenschaften e.V. (MPG) is
+# holder of all proprietary rights on this computer program.
+# You can only use this computer program if you have closed
+# a license agreement with MPG or you get the right to use the computer
+# program from someone who is authorized to grant you that right.
+# Any use of the computer program without a valid license is prohibited and
+# liable to prosecution.
+#
+# Copyright©2019 Max-Planck-Gesellschaft zur Förderung
+# der Wissenschaften e.V. (MPG). acting on behalf of its Max Planck Institute
+# for Intelligent Systems. All rights reserved.
+#
+# Contact: ps-license@tuebingen.mpg.de
+
+
+import os
+import time
+import torch
+import numpy as np
+import os.path as osp
+import scipy.sparse as sparse
+from scipy.sparse.csgraph import dijkstra, connected_components
+
+from lib.core.config import VIBE_DATA_DIR
+
+SMPL_LOD_LEVELS = [1500, 3000]
+
+
+class MeshLOD():
+    """
+    Decimated topology of the SMPL mesh. Every vertex is a fixed barycentric
+    combination of the vertices of one face of the full 6890 vertex mesh, so
+    the decimated mesh follows any SMPL output with one gather.
+    """
+    def __init__(self, faces, vertex_ids, bary):
+        '''
+        :param faces (ndarray, Fx3): faces of the decimated mesh
+        :param vertex_ids (ndarray, Nx3): SMPL vertices each decimated vertex is interpolated from
+        :param bary (ndarray, Nx3): barycentric weights of these vertices
+        '''
+        self.faces = faces
+        self.vertex_ids = vertex_ids
+        self.bary = bary
+
+    @property
+    def num_verts(self):
+        return self.vertex_ids.shape[0]
+
+    def __call__(self, verts):
+        '''
+        :param verts (ndarray or torch.Tensor, ...x6890x3): SMPL vertices
+        :return: decimated vertices (...xNx3), same type as verts
+        '''
+        if isinstance(verts, torch.Tensor):
+            bary = torch.as_tensor(self.bary, dtype=verts.dtype, device=verts.device)
+            return (verts[..., torch.as_tensor(self.vertex_ids, device=verts.device), :] * bary[..., None]).sum(-2)
+        return (verts[..., self.vertex_ids, :] * self.bary[..., None].astype(verts.dtype)).sum(-2)
+
+    def save(self, filename):
+        np.savez(filename, faces=self.faces, vertex_ids=self.vertex_ids, bary=self.bary)
+
+    @classmethod
+    def load(cls, filename):
+        data = np.load(filename)
+        return cls(data['faces'], data['vertex_ids'], data['bary'])
+
+
+def project_to_face(point, tri):
+    # barycentric coordinates of the projection of point onto the triangle plane, clamped into the triangle
+    v0, v1, d = tri[1] - tri[0], tri[2] - tri[0], point - tri[0]
+    d00, d01, d11 = v0 @ v0, v0 @ v1, v1 @ v1
+    d20, d21 = d @ v0, d @ v1
+    denom = max(d00 * d11 - d01 * d01, 1e-12)
+    b1 = (d11 * d20 - d01 * d21) / denom
+    b2 = (d00 * d21 - d01 * d20) / denom
+    bary = np.clip([1. - b1 - b2, b1, b2], 0., None)
+    bary /= max(bary.sum(), 1e-12)
+    return bary, np.linalg.norm(bary @ tri - point)
+
+
+def face_normals(verts, faces):
+    # area weighted (unnormalized) face normals
+    tris = verts[faces]
+    return np.cross(tris[:, 1] - tris[:, 0], tris[:, 2] - tris[:, 0])
+
+
+def vertex_normals(verts, faces):
+    normals = np.zeros_like(verts)
+    np.add.at(normals, faces.ravel(), np.repeat(face_normals(verts, faces), 3, axis=0))
+    return normals / np.maximum(np.linalg.norm(normals, axis=1, keepdims=True), 1e-12)
+
+
+def edge_counts(faces):
+    # unique undirected edges of the faces and the number of faces sharing each of them
+    edges = np.sort(faces[:, [0, 1, 1, 2, 2, 0]].reshape(-1, 2), axis=1)
+    return np.unique(edges, axis=0, return_counts=True)
+
+
+def count_components(faces, num_verts):
+    # connected components of the vertices along the face edges, unreferenced vertices count as components
+    edges = faces[:, [0, 1, 1, 2, 2, 0]].reshape(-1, 2)
+    graph = sparse.csr_matrix((np.ones(len(edges)), (edges[:, 0], edges[:, 1])), shape=(num_verts, num_verts))
+    return connected_components(graph, directed=False)[0]
+
+
+def count_boundary_loops(faces, num_verts):
+    # connected components of the edges that belong to a single face, one per hole of a manifold mesh
+    edges, counts = edge_counts(faces)
+    boundary = edges[counts == 1]
+    if len(boundary) == 0:
+        return 0
+    graph = sparse.csr_matrix((np.ones(len(boundary)), (boundary[:, 0], boundary[:, 1])), shape=(num_verts, num_verts))
+    labels = connected_components(graph, directed=False)[1]
+    return len(np.unique(labels[boundary[:, 0]]))
+
+
+def check_lod(lod, v_template, faces, min_area=1e-4):
+    '''
+    Validate a decimated mesh against the full mesh it was built from, raises ValueError on
+    - degenerate faces, with an area below min_area times the median face area
+    - flipped faces, whose normal points against the interpolated normals of the full mesh
+    - non-manifold edges, shared by more than two faces
+    - holes, boundary loops the full mesh does not have (SMPL has none, every edge must have two faces)
+    - an Euler characteristic (V - E + F) other than the one of the full mesh
+    - parts that are disconnected although they are connected in the full mesh
+    :param lod (MeshLOD): decimated mesh
+    :param v_template (ndarray, Vx3): vertices of the rest mesh
+    :param faces (ndarray, Fx3): faces of the full mesh
+    '''
+    verts = lod(v_template)
+    normals = face_normals(verts, lod.faces)
+    areas = 0.5 * np.linalg.norm(normals, axis=1)
+    reference = lod(vertex_normals(v_template, faces))[lod.faces].sum(axis=1)
+
+    edges, counts = edge_counts(lod.faces)
+    full_edges, _ = edge_counts(faces)
+
+    errors = []
+    num_degenerate = np.count_nonzero(areas <= min_area * np.median(areas))
+    if num_degenerate > 0:
+        errors.append(f'{num_degenerate} degenerate faces')
+    num_flipped = np.count_nonzero(np.sum(normals * reference, axis=1) < 0)
+    if num_flipped > 0:
+        errors.append(f'{num_flipped} faces flipped against the full mesh')
+    num_non_manifold = np.count_nonzero(counts > 2)
+    if num_non_manifold > 0:
+        errors.append(f'{num_non_manifold} non-manifold edges')
+    num_loops = count_boundary_loops(lod.faces, lod.num_verts)
+    num_full_loops = count_boundary_loops(faces, v_template.shape[0])
+    if num_loops != num_full_loops:
+        errors.append(f'{np.count_nonzero(counts == 1)} boundary edges in {num_loops} loops, '
+                      f'the full mesh has {num_full_loops} loops')
+    euler = lod.num_verts - len(edges) + len(lod.faces)
+    full_euler = v_template.shape[0] - len(full_edges) + len(faces)
+    if euler != full_euler:
+        errors.append(f'Euler characteristic {euler}, the full mesh has {full_euler}')
+    num_components = count_components(lod.faces, lod.num_verts)
+    num_full_components = count_components(faces, v_template.shape[0])
+    if num_components != num_full_components:
+        errors.append(f'{num_components} connected components, the full mesh has {num_full_components}')
+
+    if len(errors) > 0:
+        raise ValueError(f'Invalid level of detail with {lod.num_verts} vertices: {", ".join(errors)}')
+
+
+def build_lod(v_template, faces, num_verts):
+    '''
+    Decimate a mesh by vertex clustering: `num_verts` seeds are picked by farthest point sampling, every
+    vertex joins the seed closest along the mesh edges, faces spanning three clusters are kept. A decimated
+    vertex is the centroid of its cluster projected onto the closest face around the member nearest to it.
+    Degenerate faces are dropped, faces are oriented along the normals of the full mesh and an edge keeps at
+    most its two largest faces, the result is validated with check_lod (this rejects the holes dropping faces
+    can open).
+    :param v_template (ndarray, Vx3): vertices of the rest mesh
+    :param faces (ndarray, Fx3): faces of the full mesh
+    :param num_verts (int): clusters of the decimated mesh, the vertices of clusters without faces are dropped
+    :return: MeshLOD with at most num_verts vertices
+    '''
+    num_full = v_template.shape[0]
+
+    # farthest point sampling of the seeds
+    seeds = np.zeros(num_verts, dtype=np.int64)
+    dist = np.linalg.norm(v_template - v_template.mean(axis=0), axis=1)
+    for i in range(num_verts):
+        seeds[i] = np.argmax(dist)
+        dist = np.minimum(dist, np.linalg.norm(v_template - v_template[seeds[i]], axis=1))
+
+    # geodesic clusters, distances along the mesh edges
+    edges = np.unique(np.sort(faces[:, [0, 1, 1, 2, 2, 0]].reshape(-1, 2), axis=1), axis=0)
+    lengths = np.linalg.norm(v_template[edges[:, 0]] - v_template[edges[:, 1]], axis=1)
+    graph = sparse.csr_matrix((lengths, (edges[:, 0], edges[:, 1])), shape=(num_full, num_full))
+    _, _, sources = dijkstra(graph, directed=False, indices=seeds, min_only=True, return_predecessors=True)
+    cluster = np.full(num_full, -1, dtype=np.int64)
+    cluster[seeds] = np.arange(num_verts)
+    labels = cluster[sources]
+
+    # faces of distinct clusters, duplicates keep the orientation of their first occurrence
+    lod_faces = labels[faces]
+    lod_faces = lod_faces[(lod_faces[:, 0] != lod_faces[:, 1]) &
+                          (lod_faces[:, 1] != lod_faces[:, 2]) &
+                          (lod_faces[:, 2] != lod_faces[:, 0])]
+    _, first = np.unique(np.sort(lod_faces, axis=1), axis=0, return_index=True)
+    lod_faces = lod_faces[np.sort(first)]
+
+    vertex_faces = [[] for _ in range(num_full)]
+    for face_idx, face in enumerate(faces):
+        for v in face:
+            vertex_faces[v].append(face_idx)
+
+    vertex_ids = np.zeros((num_verts, 3), dtype=np.int64)
+    bary = np.zeros((num_verts, 3), dtype=np.float32)
+    for k in range(num_verts):
+        members = np.nonzero(labels == k)[0]
+        centroid = v_template[members].mean(axis=0)
+        nearest = members[np.argmin(np.linalg.norm(v_template[members] - centroid, axis=1))]
+
+        best = None
+        for face_idx in vertex_faces[nearest]:
+            b, d = project_to_face(centroid, v_template[faces[face_idx]])
+            if best is None or d < best[2]:
+                best = (faces[face_idx], b, d)
+        vertex_ids[k], bary[k] = best[0], best[1]
+
+    lod = MeshLOD(lod_faces.astype(np.int64), vertex_ids, bary)
+    lod_faces = repair_faces(lod, v_template, faces)
+
+    # clusters that are not part of any face (e.g. a finger tip enclosed by a single other cluster) are dropped
+    used = np.unique(lod_faces)
+    remap = np.full(num_verts, -1, dtype=np.int64)
+    remap[used] = np.arange(len(used))
+    lod = MeshLOD(remap[lod_faces], vertex_ids[used], bary[used])
+
+    check_lod(lod, v_template, faces)
+    return lod
+
+
+def repair_faces(lod, v_template, faces, min_area=1e-4):
+    # drop degenerate faces, orient the others along the interpolated normals of the full mesh
+    verts = lod(v_template)
+    lod_faces = lod.faces.copy()
+    normals = face_normals(verts, lod_faces)
+    areas = 0.5 * np.linalg.norm(normals, axis=1)
+    keep = areas > min_area * np.median(areas)
+    lod_faces, normals, areas = lod_faces[keep], normals[keep], areas[keep]
+    reference = lod(vertex_normals(v_template, faces))[lod_faces].sum(axis=1)
+    flipped = np.sum(normals * reference, axis=1) < 0
+    lod_faces[flipped] = lod_faces[flipped][:, [0, 2, 1]]
+
+    # every edge keeps at most two faces, larger faces first
+    edge_faces = {}
+    kept = []
+    for face_idx in np.argsort(-areas, kind='stable'):
+        face_edges = [tuple(sorted(e)) for e in lod_faces[face_idx][[[0, 1], [1, 2], [2, 0]]]]
+        if all(len(edge_faces.get(e, ())) < 2 for e in face_edges):
+            for e in face_edges:
+                edge_faces.setdefault(e, []).append(face_idx)
+            kept.append(face_idx)
+    return lod_faces[np.sort(kept)]
+
+
+def get_smpl_lod(num_verts, cache_dir=VIBE_DATA_DIR):
+    '''
+    Decimated SMPL topology, built from the SMPL template on the first call and cached in cache_dir.
+    Raises ValueError instead of caching a mesh that fails check_lod, call it before a long run that needs it.
+    :param num_verts (int): vertices of the decimated mesh, one of SMPL_LOD_LEVELS
+    :return: MeshLOD
+    '''
+    if num_verts not in SMPL_LOD_LEVELS:
+        raise ValueError(f'Unknown SMPL level of detail {num_verts}, expected one of {SMPL_LOD_LEVELS}')
+
+    # v3: validated with check_lod including holes, meshes cached by earlier versions are not reused
+    cache_file = osp.join(cache_dir, f'smpl_lod_{num_verts}_v3.npz')
+    if osp.isfile(cache_file):
+        return MeshLOD.load(cache_file)
+
+    from lib.models.smpl import SMPL, SMPL_MODEL_DIR
+    start = time.time()
+    smpl = SMPL(SMPL_MODEL_DIR, batch_size=1, create_transl=False)
+    lod = build_lod(smpl.v_template.cpu().numpy().astype(np.float64), smpl.faces.astype(np.int64), num_verts)
+
+    os.makedirs(cache_dir, exist_ok=True)
+    lod.save(cache_file)
+    print(f'Built the SMPL level of detail with {lod.num_verts} vertices and {len(lod.faces)} faces '
+          f'in {time.time() - start:.2f}s, saved to \'{cache_file}\'')
+    return lod
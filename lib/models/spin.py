@@ -7,8 +7,10 @@ import numpy as np
 import os.path as osp
 import torch.nn as nn
 import torchvision.models.resnet as resnet
+from torch.nn.utils.fusion import fuse_conv_bn_eval
 
 from lib.core.config import VIBE_DATA_DIR
+from lib.data_utils.img_utils import IMG_NORM_MEAN, IMG_NORM_STD
 from lib.utils.geometry import rotation_matrix_to_angle_axis, rot6d_to_rotmat
 from lib.models.smpl import SMPL, SMPL_MODEL_DIR, H36M_TO_J14, SMPL_MEAN_PARAMS
 
@@ -55,15 +57,26 @@ class Bottleneck(nn.Module):
 
         return out
 
+    def fuse_for_inference(self):
+        # every conv is followed by a bn, fold the bn into the conv weights and bias
+        self.conv1, self.bn1 = fuse_conv_bn_eval(self.conv1, self.bn1), nn.Identity()
+        self.conv2, self.bn2 = fuse_conv_bn_eval(self.conv2, self.bn2), nn.Identity()
+        self.conv3, self.bn3 = fuse_conv_bn_eval(self.conv3, self.bn3), nn.Identity()
+        if self.downsample is not None:
+            self.downsample = fuse_conv_bn_eval(self.downsample[0], self.downsample[1])
+
 
 class HMR(nn.Module):
     """
     SMPL Iterative Regressor with ResNet50 backbone
     """
-    def __init__(self, block, layers, smpl_mean_params):
+    def __init__(self, block, layers, smpl_mean_params, feature_only=False):
         self.inplanes = 64
         super(HMR, self).__init__()
         npose = 24 * 6
+        self.feature_only = feature_only
+        # set by fuse_for_inference, the input is a raw [0, 1] crop instead of a normalized one
+        self.raw_input = False
         self.conv1 = nn.Conv2d(3, 64, kernel_size=7, stride=2, padding=3,
                                bias=False)
         self.bn1 = nn.BatchNorm2d(64)
@@ -74,6 +87,19 @@ class HMR(nn.Module):
         self.layer3 = self._make_layer(block, 256, layers[2], stride=2)
         self.layer4 = self._make_layer(block, 512, layers[3], stride=2)
         self.avgpool = nn.AvgPool2d(7, stride=1)
+
+        for m in self.modules():
+            if isinstance(m, nn.Conv2d):
+                n = m.kernel_size[0] * m.kernel_size[1] * m.out_channels
+                m.weight.data.normal_(0, math.sqrt(2. / n))
+            elif isinstance(m, nn.BatchNorm2d):
+                m.weight.data.fill_(1)
+                m.bias.data.zero_()
+
+        # the temporal models only use the backbone features, skip the IEF head and SMPL
+        if feature_only:
+            return
+
         self.fc1 = nn.Linear(512 * block.expansion + npose + 13, 1024)
         self.drop1 = nn.Dropout()
         self.fc2 = nn.Linear(1024, 1024)
@@ -91,14 +117,6 @@ class HMR(nn.Module):
             create_transl=False
         ).to('cpu')
 
-        for m in self.modules():
-            if isinstance(m, nn.Conv2d):
-                n = m.kernel_size[0] * m.kernel_size[1] * m.out_channels
-                m.weight.data.normal_(0, math.sqrt(2. / n))
-            elif isinstance(m, nn.BatchNorm2d):
-                m.weight.data.fill_(1)
-                m.bias.data.zero_()
-
         mean_params = np.load(smpl_mean_params)
         init_pose = torch.from_numpy(mean_params['pose'][:]).unsqueeze(0)
         init_shape = torch.from_numpy(mean_params['shape'][:].astype('float32')).unsqueeze(0)
@@ -124,7 +142,34 @@ class HMR(nn.Module):
 
         return nn.Sequential(*layers)
 
+    def fuse_for_inference(self, raw_input=True):
+        '''
+        Fold every BatchNorm of the backbone into the preceding conv, for inference only (the running statistics
+        are frozen). With raw_input the ImageNet std is folded into conv1 as well and the mean is subtracted in
+        feature_extractor, so the model takes raw [0, 1] RGB crops. The mean is not folded into the conv1 bias,
+        that would change the zero padding of conv1 at the crop borders.
+        :param raw_input (bool): take raw crops instead of crops normalized by get_default_transform
+        '''
+        if self.training:
+            raise RuntimeError('fuse_for_inference needs the model in eval mode')
+
+        self.conv1, self.bn1 = fuse_conv_bn_eval(self.conv1, self.bn1), nn.Identity()
+        for layer in [self.layer1, self.layer2, self.layer3, self.layer4]:
+            for block in layer:
+                block.fuse_for_inference()
+
+        if raw_input and not self.raw_input:
+            mean = torch.tensor(IMG_NORM_MEAN, device=self.conv1.weight.device).view(1, 3, 1, 1)
+            std = torch.tensor(IMG_NORM_STD, device=self.conv1.weight.device).view(1, 3, 1, 1)
+            with torch.no_grad():
+                self.conv1.weight.div_(std)
+            self.register_buffer('input_mean', mean, persistent=False)
+            self.raw_input = True
+        return self
+
     def feature_extractor(self, x):
+        if self.raw_input:
+            x = x - self.input_mean
 
         x = self.conv1(x)
         x = self.bn1(x)
@@ -141,6 +186,8 @@ class HMR(nn.Module):
         return xf
 
     def forward(self, x, init_pose=None, init_shape=None, init_cam=None, n_iter=3, return_features=False):
+        if self.feature_only:
+            raise RuntimeError('HMR was built with feature_only=True, use feature_extractor()')
 
         batch_size = x.shape[0]
 
@@ -151,18 +198,7 @@ class HMR(nn.Module):
         if init_cam is None:
             init_cam = self.init_cam.expand(batch_size, -1)
 
-        x = self.conv1(x)
-        x = self.bn1(x)
-        x = self.relu(x)
-        x = self.maxpool(x)
-
-        x1 = self.layer1(x)
-        x2 = self.layer2(x1)
-        x3 = self.layer3(x2)
-        x4 = self.layer4(x3)
-
-        xf = self.avgpool(x4)
-        xf = xf.view(xf.size(0), -1)
+        xf = self.feature_extractor(x)
 
         pred_pose = init_pose
         pred_shape = init_shape
@@ -206,8 +242,15 @@ class HMR(nn.Module):
             return output
 
 
+REGRESSOR_OUTPUTS = ['theta', 'verts', 'kp_2d', 'kp_3d', 'rotmat']
+
+
 class Regressor(nn.Module):
-    def __init__(self, smpl_mean_params=SMPL_MEAN_PARAMS):
+    def __init__(self, smpl_mean_params=SMPL_MEAN_PARAMS, smpl=None):
+        '''
+        :param smpl_mean_params (str): mean params file, None leaves the init buffers to be loaded from a state dict
+        :param smpl (SMPL): SMPL layer to use instead of loading one from SMPL_MODEL_DIR
+        '''
         super(Regressor, self).__init__()
 
         npose = 24 * 6
@@ -223,24 +266,35 @@ class Regressor(nn.Module):
         nn.init.xavier_uniform_(self.decshape.weight, gain=0.01)
         nn.init.xavier_uniform_(self.deccam.weight, gain=0.01)
 
-        self.smpl = SMPL(
-            SMPL_MODEL_DIR,
-            batch_size=64,
-            create_transl=False
-        )
+        if smpl is None:
+            smpl = SMPL(
+                SMPL_MODEL_DIR,
+                batch_size=64,
+                create_transl=False
+            )
+        self.smpl = smpl
 
-        mean_params = np.load(smpl_mean_params)
-        init_pose = torch.from_numpy(mean_params['pose'][:]).unsqueeze(0)
-        init_shape = torch.from_numpy(mean_params['shape'][:].astype('float32')).unsqueeze(0)
-        init_cam = torch.from_numpy(mean_params['cam']).unsqueeze(0)
+        if smpl_mean_params is not None:
+            mean_params = np.load(smpl_mean_params)
+            init_pose = torch.from_numpy(mean_params['pose'][:]).unsqueeze(0)
+            init_shape = torch.from_numpy(mean_params['shape'][:].astype('float32')).unsqueeze(0)
+            init_cam = torch.from_numpy(mean_params['cam']).unsqueeze(0)
+        else:
+            init_pose, init_shape, init_cam = torch.zeros(1, npose), torch.zeros(1, 10), torch.zeros(1, 3)
         self.register_buffer('init_pose', init_pose)
         self.register_buffer('init_shape', init_shape)
         self.register_buffer('init_cam', init_cam)
 
 
 
-    def forward(self, x, init_pose=None, init_shape=None, init_cam=None, n_iter=3, J_regressor=None):
+    def forward(self, x, init_pose=None, init_shape=None, init_cam=None, n_iter=3, J_regressor=None, outputs=None):
+        '''
+        :param outputs (iterable): outputs to compute, a subset of REGRESSOR_OUTPUTS, None for all of them.
+            Without 'verts' the SMPL mesh is not posed, only the vertices kp_3d and kp_2d are regressed from.
+            Without 'theta' the rotation matrices are not converted to axis-angle
+        '''
         batch_size = x.shape[0]
+        outputs = REGRESSOR_OUTPUTS if outputs is None else outputs
 
         if init_pose is None:
             init_pose = self.init_pose.expand(batch_size, -1)
@@ -264,32 +318,47 @@ class Regressor(nn.Module):
 
         pred_rotmat = rot6d_to_rotmat(pred_pose).view(batch_size, 24, 3, 3)
 
-        pred_output = self.smpl(
-            betas=pred_shape,
-            body_pose=pred_rotmat[:, 1:],
-            global_orient=pred_rotmat[:, 0].unsqueeze(1),
-            pose2rot=False
-        )
+        output = {}
+        if 'rotmat' in outputs:
+            output['rotmat'] = pred_rotmat
 
-        pred_vertices = pred_output.vertices
-        pred_joints = pred_output.joints
+        if 'verts' in outputs:
+            pred_output = self.smpl(
+                betas=pred_shape,
+                body_pose=pred_rotmat[:, 1:],
+                global_orient=pred_rotmat[:, 0].unsqueeze(1),
+                pose2rot=False
+            )
+            pred_vertices = pred_output.vertices
+            pred_joints = pred_output.joints
+            output['verts'] = pred_vertices
+
+            if J_regressor is not None:
+                J_regressor_batch = J_regressor[None, :].expand(pred_vertices.shape[0], -1, -1).to(pred_vertices.device)
+                pred_joints = torch.matmul(J_regressor_batch, pred_vertices)
+        elif 'kp_3d' in outputs or 'kp_2d' in outputs:
+            # only the vertices the joints are regressed from are posed
+            pred_joints = self.smpl.get_joints(
+                betas=pred_shape,
+                body_pose=pred_rotmat[:, 1:],
+                global_orient=pred_rotmat[:, 0].unsqueeze(1),
+                pose2rot=False,
+                J_regressor=J_regressor.to(x.device) if J_regressor is not None else None,
+            )
 
-        if J_regressor is not None:
-            J_regressor_batch = J_regressor[None, :].expand(pred_vertices.shape[0], -1, -1).to(pred_vertices.device)
-            pred_joints = torch.matmul(J_regressor_batch, pred_vertices)
-            pred_joints = pred_joints[:, H36M_TO_J14, :]
+        if 'kp_3d' in outputs or 'kp_2d' in outputs:
+            if J_regressor is not None:
+                pred_joints = pred_joints[:, H36M_TO_J14, :]
+            if 'kp_3d' in outputs:
+                output['kp_3d'] = pred_joints
+            if 'kp_2d' in outputs:
+                output['kp_2d'] = projection(pred_joints, pred_cam)
 
-        pred_keypoints_2d = projection(pred_joints, pred_cam)
+        if 'theta' in outputs:
+            pose = rotation_matrix_to_angle_axis(pred_rotmat.reshape(-1, 3, 3)).reshape(-1, 72)
+            output['theta'] = torch.cat([pred_cam, pose, pred_shape], dim=1)
 
-        pose = rotation_matrix_to_angle_axis(pred_rotmat.reshape(-1, 3, 3)).reshape(-1, 72)
-
-        output = [{
-            'theta'  : torch.cat([pred_cam, pose, pred_shape], dim=1),
-            'verts'  : pred_vertices,
-            'kp_2d'  : pred_keypoints_2d,
-            'kp_3d'  : pred_joints,
-            'rotmat' : pred_rotmat
-        }]
+        output = [output]
         return output
 
 
@@ -353,10 +422,13 @@ def perspective_projection(points, rotation, translation,
     return projected_points[:, :, :-1]
 
 
-def get_pretrained_hmr():
+def get_pretrained_hmr(fuse=True):
     device = 'cuda'
     model = hmr().to(device)
     checkpoint = torch.load(osp.join(VIBE_DATA_DIR, 'spin_model_checkpoint.pth.tar'), map_location='cpu')
     model.load_state_dict(checkpoint['model'], strict=False)
     model.eval()
+    if fuse:
+        # takes raw [0, 1] crops, see HMR.fuse_for_inference
+        model.fuse_for_inference()
     return model
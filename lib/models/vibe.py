@@ -15,13 +15,17 @@
 # Contact: ps-license@tuebingen.mpg.de
 
 import os
+import time
 import torch
 import os.path as osp
 import torch.nn as nn
 import torch.nn.functional as F
+from torch.nn.utils.rnn import pack_padded_sequence, pad_packed_sequence
 
 from lib.core.config import VIBE_DATA_DIR
+from smplx.utils import Struct
 from lib.models.spin import Regressor, hmr
+from lib.models.smpl import SMPL, SMPL_MODEL_DIR, SMPL_MEAN_PARAMS
 
 
 class TemporalEncoder(nn.Module):
@@ -49,10 +53,17 @@ class TemporalEncoder(nn.Module):
             self.linear = nn.Linear(hidden_size, 2048)
         self.use_residual = use_residual
 
-    def forward(self, x):
+    def forward(self, x, lengths=None, hidden=None, return_hidden=False):
+        # lengths: valid length of each sequence if x is a padded batch of sequences
+        # hidden: GRU state to continue from, e.g. the returned state of the previous chunk of the same sequences
         n,t,f = x.shape
         x = x.permute(1,0,2) # NTF -> TNF
-        y, _ = self.gru(x)
+        if lengths is not None:
+            y = pack_padded_sequence(x, torch.as_tensor(lengths, dtype=torch.int64), enforce_sorted=False)
+            y, hidden = self.gru(y, hidden)
+            y, _ = pad_packed_sequence(y, total_length=t)
+        else:
+            y, hidden = self.gru(x, hidden)
         if self.linear:
             y = F.relu(y)
             y = self.linear(y.view(-1, y.size(-1)))
@@ -60,6 +71,8 @@ class TemporalEncoder(nn.Module):
         if self.use_residual and y.shape[-1] == 2048:
             y = y + x
         y = y.permute(1,0,2) # TNF -> NTF
+        if return_hidden:
+            return y, hidden
         return y
 
 
@@ -99,20 +112,17 @@ class VIBE(nn.Module):
             print(f'=> loaded pretrained model from \'{pretrained}\'')
 
 
-    def forward(self, input, J_regressor=None):
-        # input size NTF
+    def forward(self, input, J_regressor=None, outputs=None):
+        # input size NTF, outputs: see Regressor.forward
         batch_size, seqlen = input.shape[:2]
 
         feature = self.encoder(input)
         feature = feature.reshape(-1, feature.size(-1))
 
-        smpl_output = self.regressor(feature, J_regressor=J_regressor)
+        smpl_output = self.regressor(feature, J_regressor=J_regressor, outputs=outputs)
         for s in smpl_output:
-            s['theta'] = s['theta'].reshape(batch_size, seqlen, -1)
-            s['verts'] = s['verts'].reshape(batch_size, seqlen, -1, 3)
-            s['kp_2d'] = s['kp_2d'].reshape(batch_size, seqlen, -1, 2)
-            s['kp_3d'] = s['kp_3d'].reshape(batch_size, seqlen, -1, 3)
-            s['rotmat'] = s['rotmat'].reshape(batch_size, seqlen, -1, 3, 3)
+            for k, v in s.items():
+                s[k] = v.reshape(batch_size, seqlen, *v.shape[1:])
 
         return smpl_output
 
@@ -128,12 +138,23 @@ class VIBE_Demo(nn.Module):
             bidirectional=False,
             use_residual=True,
             pretrained=osp.join(VIBE_DATA_DIR, 'spin_model_checkpoint.pth.tar'),
+            smpl_mean_params=SMPL_MEAN_PARAMS,
+            smpl=None,
     ):
 
         super(VIBE_Demo, self).__init__()
 
         self.seqlen = seqlen
         self.batch_size = batch_size
+        self.config = dict(
+            seqlen=seqlen,
+            batch_size=batch_size,
+            n_layers=n_layers,
+            hidden_size=hidden_size,
+            add_linear=add_linear,
+            bidirectional=bidirectional,
+            use_residual=use_residual,
+        )
 
         self.encoder = TemporalEncoder(
             n_layers=n_layers,
@@ -143,37 +164,127 @@ class VIBE_Demo(nn.Module):
             use_residual=use_residual,
         )
 
-        self.hmr = hmr()
-        checkpoint = torch.load(pretrained, map_location='cpu')
-        self.hmr.load_state_dict(checkpoint['model'], strict=False)
+        # only the backbone of HMR is used, its ImageNet weights are overwritten by the SPIN checkpoint
+        self.hmr = hmr(pretrained=False, feature_only=True)
 
         # regressor can predict cam, pose and shape params in an iterative way
-        self.regressor = Regressor()
+        self.regressor = Regressor(smpl_mean_params=smpl_mean_params, smpl=smpl)
 
         if pretrained and os.path.isfile(pretrained):
             pretrained_dict = torch.load(pretrained, map_location='cpu')['model']
 
+            self.hmr.load_state_dict(pretrained_dict, strict=False)
             self.regressor.load_state_dict(pretrained_dict, strict=False)
             print(f'=> loaded pretrained model from \'{pretrained}\'')
 
+    def save_bundle(self, bundle_file):
+        '''
+        Save a deployment bundle: the model config, all weights and buffers, the SMPL model data and the
+        mean params in one file that from_bundle loads without touching any other checkpoint.
+        :param bundle_file (str): output file
+        '''
+        smpl = self.regressor.smpl
+        num_verts = smpl.v_template.shape[0]
+        kintree_table = torch.stack([smpl.parents, torch.arange(smpl.parents.shape[0])])
+        smpl_data = {
+            'v_template': smpl.v_template,
+            'shapedirs': smpl.shapedirs,
+            'posedirs': smpl.posedirs.t().reshape(num_verts, 3, -1),
+            'J_regressor': smpl.J_regressor,
+            'weights': smpl.lbs_weights,
+            'kintree_table': kintree_table,
+            'f': smpl.faces_tensor,
+            'J_regressor_extra': smpl.J_regressor_extra,
+        }
+        # the SMPL layer is rebuilt from smpl_data, its buffers are not stored twice
+        state_dict = {k: v for k, v in self.state_dict().items() if not k.startswith('regressor.smpl.')}
+
+        torch.save({
+            'config': self.config,
+            'smpl': {k: v.detach().cpu().contiguous() for k, v in smpl_data.items()},
+            'state_dict': state_dict,
+        }, bundle_file)
+        print(f'=> saved VIBE_Demo bundle to \'{bundle_file}\'')
+
+    @classmethod
+    def from_bundle(cls, bundle_file):
+        '''
+        Build the model from a bundle written by save_bundle with a single (memory mapped) read.
+        :param bundle_file (str): bundle file
+        :return: VIBE_Demo on cpu
+        '''
+        start = time.time()
+        try:
+            bundle = torch.load(bundle_file, map_location='cpu', mmap=True)
+        except TypeError:
+            # torch < 2.1 has no mmap argument
+            bundle = torch.load(bundle_file, map_location='cpu')
+
+        smpl_data = {k: v.numpy() for k, v in bundle['smpl'].items()}
+        J_regressor_extra = smpl_data.pop('J_regressor_extra')
+        smpl = SMPL(
+            SMPL_MODEL_DIR,
+            data_struct=Struct(**smpl_data),
+            J_regressor_extra=J_regressor_extra,
+            batch_size=64,
+            create_transl=False
+        )
 
-    def forward(self, input, J_regressor=None):
-        # input size NTF
+        model = cls(**bundle['config'], pretrained=None, smpl_mean_params=None, smpl=smpl)
+        missing, unexpected = model.load_state_dict(bundle['state_dict'], strict=False)
+        missing = [k for k in missing if not k.startswith('regressor.smpl.')]
+        if len(missing) > 0 or len(unexpected) > 0:
+            raise RuntimeError(f'Bundle \'{bundle_file}\' does not match VIBE_Demo, '
+                               f'missing keys: {missing}, unexpected keys: {unexpected}')
+
+        print(f'=> loaded VIBE_Demo bundle from \'{bundle_file}\' in {time.time() - start:.2f}s')
+        return model
+
+    def fuse_for_inference(self, raw_input=True):
+        '''
+        Fold the BatchNorms of the backbone, see HMR.fuse_for_inference.
+        :param raw_input (bool): extract_features takes raw [0, 1] crops instead of normalized ones
+        '''
+        self.hmr.fuse_for_inference(raw_input=raw_input)
+        return self
+
+    @property
+    def raw_input(self):
+        return self.hmr.raw_input
+
+    def extract_features(self, input):
+        # input size NCHW, normalized crops or raw [0, 1] crops if raw_input is set
+        return self.hmr.feature_extractor(input)
+
+    def encode(self, feature, lengths, hidden=None, return_hidden=False):
+        '''
+        Run the temporal encoder over a padded batch of feature sequences.
+        :param feature (torch.Tensor, NxTx2048): zero padded feature sequences
+        :param lengths (list): valid length of each sequence
+        :param hidden (torch.Tensor, n_layers x N x hidden_size): GRU state carried over from the previous chunks
+        :param return_hidden (bool): also return the GRU state after the last valid frame of each sequence
+        :return: temporal features of the valid frames, concatenated sequence by sequence
+        '''
+        feature, hidden = self.encoder(feature, lengths=lengths, hidden=hidden, return_hidden=True)
+        feature = torch.cat([feature[i, :l] for i, l in enumerate(lengths)], dim=0)
+        if return_hidden:
+            return feature, hidden
+        return feature
+
+    def forward(self, input, J_regressor=None, outputs=None):
+        # input size NTCHW, outputs: see Regressor.forward
         batch_size, seqlen, nc, h, w = input.shape
 
-        feature = self.hmr.feature_extractor(input.reshape(-1, nc, h, w))
+        feature = self.extract_features(input.reshape(-1, nc, h, w))
 
         feature = feature.reshape(batch_size, seqlen, -1)
         feature = self.encoder(feature)
         feature = feature.reshape(-1, feature.size(-1))
 
-        smpl_output = self.regressor(feature, J_regressor=J_regressor)
+        smpl_output = self.regressor(feature, J_regressor=J_regressor, outputs=outputs)
 
         for s in smpl_output:
-            s['theta'] = s['theta'].reshape(batch_size, seqlen, -1)
-            s['verts'] = s['verts'].reshape(batch_size, seqlen, -1, 3)
-            s['kp_2d'] = s['kp_2d'].reshape(batch_size, seqlen, -1, 2)
-            s['kp_3d'] = s['kp_3d'].reshape(batch_size, seqlen, -1, 3)
-            s['rotmat'] = s['rotmat'].reshape(batch_size, seqlen, -1, 3, 3)
+            for k, v in s.items():
+                s[k] = v.reshape(batch_size, seqlen, *v.shape[1:])
 
         return smpl_output
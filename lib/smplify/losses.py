@@ -105,9 +105,10 @@ def temporal_body_fitting_loss(body_pose, betas, model_joints, camera_t, camera_
                                focal_length=5000, sigma=100, pose_prior_weight=4.78,
                                shape_prior_weight=5, angle_prior_weight=15.2,
                                smooth_2d_weight=0.01, smooth_3d_weight=1.0,
-                               output='sum'):
+                               same_sequence=None, output='sum'):
     """
     Loss function for body fitting
+    same_sequence (N-1) masks the smoothness terms between consecutive frames of different sequences
     """
     # pose_prior_weight = 1.
     # shape_prior_weight = 1.
@@ -136,6 +137,8 @@ def temporal_body_fitting_loss(body_pose, betas, model_joints, camera_t, camera_
 
     # Smooth 2d joint loss
     joint_conf_diff = joints_conf[1:]
+    if same_sequence is not None:
+        joint_conf_diff = joint_conf_diff * same_sequence[:, None]
     joints_2d_diff = projected_joints[1:] - projected_joints[:-1]
     smooth_j2d_loss = (joint_conf_diff ** 2) * joints_2d_diff.abs().sum(dim=-1)
     smooth_j2d_loss = torch.cat(
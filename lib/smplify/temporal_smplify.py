@@ -3,25 +3,55 @@
 
 import os
 import torch
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
 
 from lib.core.config import VIBE_DATA_DIR
 from lib.models.smpl import SMPL, JOINT_IDS, SMPL_MODEL_DIR
 from lib.smplify.losses import temporal_camera_fitting_loss, temporal_body_fitting_loss
+from lib.utils.smooth_pose import axis_angle_to_rotation, rotation_to_axis_angle
 
 # For the GMM prior, we use the GMM implementation of SMPLify-X
 # https://github.com/vchoutas/smplify-x/blob/master/smplifyx/prior.py
 from .prior import MaxMixturePrior
 
-def arrange_betas(pose, betas):
-    batch_size = pose.shape[0]
-    num_video = betas.shape[0]
+def get_sequence_index(seq_lengths, device):
+    """
+    Index of the sequence of every frame of a batch of concatenated sequences,
+    betas[seq_idx] expands the per sequence betas to the frames.
+    """
+    return torch.repeat_interleave(
+        torch.arange(len(seq_lengths), device=device),
+        torch.as_tensor(seq_lengths, device=device),
+    )
+
+def get_windows(seq_lengths, window_size, overlap):
+    """
+    Overlapping windows of window_size frames over every sequence of a batch of concatenated sequences.
+    The windows of a sequence are spread evenly, neighbours overlap by at least `overlap` frames.
+    Returns (sequence index, start, end) of every window, start and end index the concatenated batch.
+    """
+    windows = []
+    offset = 0
+    for seq, length in enumerate(seq_lengths):
+        if length <= window_size:
+            starts = [0]
+        else:
+            num_windows = int(np.ceil((length - overlap) / (window_size - overlap)))
+            starts = np.round(np.linspace(0, length - window_size, num_windows)).astype(int).tolist()
+        windows += [(seq, offset + start, offset + min(start + window_size, length)) for start in starts]
+        offset += length
+    return windows
+
 
-    video_size = batch_size // num_video
-    betas_ext = torch.zeros(batch_size, betas.shape[-1], device=betas.device)
-    for i in range(num_video):
-        betas_ext[i*video_size:(i+1)*video_size] = betas[i]
+def get_blend_weights(start, end, overlap):
+    """
+    Weights of the frames of a window when blending overlapping windows, they ramp up linearly over
+    the first and down over the last `overlap` frames.
+    """
+    t = torch.arange(end - start, dtype=torch.float32)
+    return torch.clamp(torch.min(t + 1, end - start - t) / (overlap + 1), max=1.)
 
-    return betas_ext
 
 class TemporalSMPLify():
     """Implementation of single-stage SMPLify."""
@@ -55,14 +85,17 @@ class TemporalSMPLify():
                          batch_size=batch_size,
                          create_transl=False).to(self.device)
 
-    def __call__(self, init_pose, init_betas, init_cam_t, camera_center, keypoints_2d):
+    def __call__(self, init_pose, init_betas, init_cam_t, camera_center, keypoints_2d, seq_lengths=None):
         """Perform body fitting.
         Input:
             init_pose: SMPL pose estimate
-            init_betas: SMPL betas estimate
+            init_betas: SMPL betas estimate, one row per sequence
             init_cam_t: Camera translation estimate
             camera_center: Camera center location
             keypoints_2d: Keypoints used for the optimization
+            seq_lengths: Number of frames of every sequence (person) of the batch, the sequences are
+                concatenated along the first axis and optimized as one problem with their own betas.
+                Defaults to sequences of equal length, one per row of init_betas
         Returns:
             vertices: Vertices of optimized shape
             joints: 3D joints of optimized shape
@@ -72,6 +105,12 @@ class TemporalSMPLify():
             reprojection_loss: Final joint reprojection loss
         """
 
+        if seq_lengths is None:
+            seq_lengths = [init_pose.shape[0] // init_betas.shape[0]] * init_betas.shape[0]
+        seq_idx = get_sequence_index(seq_lengths, init_pose.device)
+        # the smoothness terms must not connect the last frame of a sequence to the first of the next
+        same_sequence = (seq_idx[1:] == seq_idx[:-1]).float()
+
         # Make camera translation a learnable parameter
         camera_translation = init_cam_t.clone()
 
@@ -99,7 +138,7 @@ class TemporalSMPLify():
             for i in range(self.num_iters):
                 def closure():
                     camera_optimizer.zero_grad()
-                    betas_ext = arrange_betas(body_pose, betas)
+                    betas_ext = betas[seq_idx]
                     smpl_output = self.smpl(global_orient=global_orient,
                                             body_pose=body_pose,
                                             betas=betas_ext)
@@ -117,7 +156,7 @@ class TemporalSMPLify():
             camera_optimizer = torch.optim.Adam(camera_opt_params, lr=self.step_size, betas=(0.9, 0.999))
 
             for i in range(self.num_iters):
-                betas_ext = arrange_betas(body_pose, betas)
+                betas_ext = betas[seq_idx]
                 smpl_output = self.smpl(global_orient=global_orient,
                                         body_pose=body_pose,
                                         betas=betas_ext)
@@ -149,15 +188,15 @@ class TemporalSMPLify():
             for i in range(self.num_iters):
                 def closure():
                     body_optimizer.zero_grad()
-                    betas_ext = arrange_betas(body_pose, betas)
+                    betas_ext = betas[seq_idx]
                     smpl_output = self.smpl(global_orient=global_orient,
                                             body_pose=body_pose,
                                             betas=betas_ext)
                     model_joints = smpl_output.joints
 
-                    loss = temporal_body_fitting_loss(body_pose, betas, model_joints, camera_translation, camera_center,
-                                             joints_2d, joints_conf, self.pose_prior,
-                                             focal_length=self.focal_length)
+                    loss = temporal_body_fitting_loss(body_pose, betas_ext, model_joints, camera_translation,
+                                             camera_center, joints_2d, joints_conf, self.pose_prior,
+                                             focal_length=self.focal_length, same_sequence=same_sequence)
                     loss.backward()
                     return loss
 
@@ -166,14 +205,14 @@ class TemporalSMPLify():
             body_optimizer = torch.optim.Adam(body_opt_params, lr=self.step_size, betas=(0.9, 0.999))
 
             for i in range(self.num_iters):
-                betas_ext = arrange_betas(body_pose, betas)
+                betas_ext = betas[seq_idx]
                 smpl_output = self.smpl(global_orient=global_orient,
                                         body_pose=body_pose,
                                         betas=betas_ext)
                 model_joints = smpl_output.joints
-                loss = temporal_body_fitting_loss(body_pose, betas, model_joints, camera_translation, camera_center,
-                                         joints_2d, joints_conf, self.pose_prior,
-                                         focal_length=self.focal_length)
+                loss = temporal_body_fitting_loss(body_pose, betas_ext, model_joints, camera_translation,
+                                         camera_center, joints_2d, joints_conf, self.pose_prior,
+                                         focal_length=self.focal_length, same_sequence=same_sequence)
                 body_optimizer.zero_grad()
                 loss.backward()
                 body_optimizer.step()
@@ -182,15 +221,16 @@ class TemporalSMPLify():
         # Get final loss value
 
         with torch.no_grad():
-            betas_ext = arrange_betas(body_pose, betas)
+            betas_ext = betas[seq_idx]
             smpl_output = self.smpl(global_orient=global_orient,
                                     body_pose=body_pose,
                                     betas=betas_ext)
             model_joints = smpl_output.joints
-            reprojection_loss = temporal_body_fitting_loss(body_pose, betas, model_joints, camera_translation,
+            reprojection_loss = temporal_body_fitting_loss(body_pose, betas_ext, model_joints, camera_translation,
                                                            camera_center,
                                                            joints_2d, joints_conf, self.pose_prior,
                                                            focal_length=self.focal_length,
+                                                           same_sequence=same_sequence,
                                                            output='reprojection')
 
         vertices = smpl_output.vertices.detach()
@@ -204,7 +244,7 @@ class TemporalSMPLify():
             camera_translation[:,0], camera_translation[:,1]
         ], dim=-1)
 
-        betas = betas.repeat(pose.shape[0],1)
+        betas = betas[seq_idx]
         output = {
             'theta': torch.cat([camera_translation, pose, betas], dim=1),
             'verts': vertices,
@@ -214,6 +254,91 @@ class TemporalSMPLify():
         return output, reprojection_loss
         # return vertices, joints, pose, betas, camera_translation, reprojection_loss
 
+    def fit_windows(self, init_pose, init_betas, init_cam_t, camera_center, keypoints_2d, seq_lengths=None,
+                    window_size=100, overlap=20, num_workers=4):
+        """Perform body fitting on overlapping windows of the sequences.
+        The speedup over __call__ comes from the bounded window length: the optimization cost of a
+        window does not grow with the sequence length. The windows run in a thread pool, the threads
+        share the intra-op thread pool of torch (split evenly between them on the cpu for the duration
+        of the fit) and on the gpu one stream, so running windows concurrently only helps while a
+        single window leaves cores or the gpu idle, it does not scale linearly with num_workers.
+        All windows of a sequence start from the betas of the sequence, the fitted betas are averaged
+        into one estimate per sequence, the pose (in 6D rotation space) and camera translation are
+        blended over the overlaps.
+        Input and output as in __call__, plus:
+            window_size: Number of frames of a window
+            overlap: Minimum number of frames shared by neighbouring windows
+            num_workers: Number of windows optimized at once
+        """
+        if seq_lengths is None:
+            seq_lengths = [init_pose.shape[0] // init_betas.shape[0]] * init_betas.shape[0]
+        seq_idx = get_sequence_index(seq_lengths, init_pose.device)
+        windows = get_windows(seq_lengths, window_size, overlap)
+
+        def fit_window(window):
+            seq, start, end = window
+            output, _ = self(init_pose[start:end], init_betas[seq:seq + 1], init_cam_t[start:end],
+                             camera_center[start:end], keypoints_2d[start:end].clone())
+            return output['theta']
+
+        # concurrent windows on the cpu would oversubscribe the cores with num_workers x num_threads threads
+        num_threads = torch.get_num_threads()
+        if init_pose.device.type == 'cpu':
+            torch.set_num_threads(max(1, num_threads // num_workers))
+        try:
+            with ThreadPoolExecutor(max_workers=num_workers) as executor:
+                thetas = list(executor.map(fit_window, windows))
+        finally:
+            torch.set_num_threads(num_threads)
+
+        num_frames = init_pose.shape[0]
+        rot = torch.zeros(num_frames, 24, 6, device=init_pose.device)
+        camera_translation = torch.zeros(num_frames, 3, device=init_pose.device)
+        frame_weights = torch.zeros(num_frames, 1, device=init_pose.device)
+        betas = torch.zeros_like(init_betas)
+        seq_weights = torch.zeros(init_betas.shape[0], 1, device=init_pose.device)
+        for (seq, start, end), theta in zip(windows, thetas):
+            weights = get_blend_weights(start, end, overlap).to(init_pose.device)[:, None]
+            cam = theta[:, :3]
+            cam_t = torch.stack([cam[:, 1], cam[:, 2], 2 * 5000. / (224 * cam[:, 0] + 1e-9)], dim=-1)
+            rot[start:end] += weights[:, :, None] * axis_angle_to_rotation(theta[:, 3:75], '6d')
+            camera_translation[start:end] += weights * cam_t
+            frame_weights[start:end] += weights
+            betas[seq] += (end - start) * theta[0, 75:]
+            seq_weights[seq] += end - start
+
+        pose = rotation_to_axis_angle(rot, '6d')
+        camera_translation = camera_translation / frame_weights
+        betas = (betas / seq_weights)[seq_idx]
+
+        # Get final loss value of the blended fit
+        joints_2d = keypoints_2d[:, :, :2]
+        joints_conf = keypoints_2d[:, :, -1].clone()
+        joints_conf[:, self.ign_joints] = 0.
+        with torch.no_grad():
+            smpl_output = self.smpl(global_orient=pose[:, :3],
+                                    body_pose=pose[:, 3:],
+                                    betas=betas)
+            reprojection_loss = temporal_body_fitting_loss(pose[:, 3:], betas, smpl_output.joints, camera_translation,
+                                                           camera_center,
+                                                           joints_2d, joints_conf, self.pose_prior,
+                                                           focal_length=self.focal_length,
+                                                           output='reprojection')
+
+        # Back to weak perspective camera
+        camera_translation = torch.stack([
+            2 * 5000. / (224 * camera_translation[:,2] + 1e-9),
+            camera_translation[:,0], camera_translation[:,1]
+        ], dim=-1)
+
+        output = {
+            'theta': torch.cat([camera_translation, pose, betas], dim=1),
+            'verts': smpl_output.vertices.detach(),
+            'kp_3d': smpl_output.joints.detach(),
+        }
+
+        return output, reprojection_loss
+
     def get_fitting_loss(self, pose, betas, cam_t, camera_center, keypoints_2d):
         """Given body and camera parameters, compute reprojection loss value.
         Input:
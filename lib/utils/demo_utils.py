@@ -19,18 +19,34 @@ import cv2
 import time
 import json
 import torch
+import shutil
 import subprocess
 import numpy as np
 import os.path as osp
 from pytube import YouTube
 from collections import OrderedDict
-
+from torch.utils.data import DataLoader
+
+from lib.core.config import VIBE_DATA_DIR
+from lib.models.vibe import VIBE_Demo
+from lib.models.jit import compile_vibe_demo
+from lib.models.onnx_backend import ONNX_DIR, OnnxVIBE_Demo, export_vibe_demo, has_onnx_export
+from lib.dataset.inference import FrameStream
+from lib.utils.frame_source import VideoFrameSource, ImageFolderSource, FrameStore
 from lib.utils.smooth_bbox import get_smooth_bbox_params, get_all_bbox_params
-from lib.data_utils.img_utils import get_single_image_crop_demo
+from lib.data_utils.img_utils import get_batch_image_crop_demo
 from lib.utils.geometry import rotation_matrix_to_angle_axis
 from lib.smplify.temporal_smplify import TemporalSMPLify
 
 
+# regressor outputs of the demo output modes: the full mesh, the joints only or the SMPL parameters only
+DEMO_OUTPUTS = {
+    'mesh': ['theta', 'verts', 'kp_3d', 'kp_2d'],
+    'joints': ['theta', 'kp_3d', 'kp_2d'],
+    'theta': ['theta'],
+}
+
+
 def preprocess_video(video, joints2d, bboxes, frames, scale=1.0, crop_size=224):
     """
     Read video, do normalize and crop it according to the bounding box.
@@ -54,66 +70,84 @@ def preprocess_video(video, joints2d, bboxes, frames, scale=1.0, crop_size=224):
         joints2d = joints2d[time_pt1:time_pt2]
         frames = frames[time_pt1:time_pt2]
 
-    shape = video.shape
-
-    temp_video = np.zeros((shape[0], crop_size, crop_size, shape[-1]))
-    norm_video = torch.zeros(shape[0], shape[-1], crop_size, crop_size)
-
-    for idx in range(video.shape[0]):
+    norm_video, temp_video, joints2d = get_batch_image_crop_demo(
+        video,
+        bboxes,
+        kp_2d=joints2d,
+        scale=scale,
+        crop_size=crop_size)
 
-        img = video[idx]
-        bbox = bboxes[idx]
-
-        j2d = joints2d[idx] if joints2d is not None else None
-
-        norm_img, raw_img, kp_2d = get_single_image_crop_demo(
-            img,
-            bbox,
-            kp_2d=j2d,
-            scale=scale,
-            crop_size=crop_size)
+    return temp_video, norm_video, bboxes, joints2d, frames
 
-        if joints2d is not None:
-            joints2d[idx] = kp_2d
 
-        temp_video[idx] = raw_img
-        norm_video[idx] = norm_img
+def download_youtube_clip(url, download_folder):
+    return YouTube(url).streams.first().download(output_path=download_folder)
 
-    temp_video = temp_video.astype(np.uint8)
 
-    return temp_video, norm_video, bboxes, joints2d, frames
+# TemporalSMPLify of the smplify runners, one per device. The GMM prior and SMPL are loaded once,
+# the optimization options are set on every call
+_smplify_models = {}
 
 
-def download_youtube_clip(url, download_folder):
-    return YouTube(url).streams.first().download(output_path=download_folder)
+def get_smplify(device, lr=1.0, opt_steps=1, use_lbfgs=True):
+    if device not in _smplify_models:
+        _smplify_models[device] = TemporalSMPLify(focal_length=5000., device=device)
+    smplify = _smplify_models[device]
+    smplify.step_size = lr
+    smplify.num_iters = opt_steps
+    smplify.use_lbfgs = use_lbfgs
+    return smplify
 
 
-def smplify_runner(
-        pred_rotmat,
+def batch_smplify_runner(
+        pred_rotmats,
         pred_betas,
-        pred_cam,
-        j2d,
+        pred_cams,
+        j2ds,
         device,
-        batch_size,
         lr=1.0,
         opt_steps=1,
         use_lbfgs=True,
-        pose2aa=True
+        pose2aa=True,
+        window_size=None,
+        overlap=20,
+        num_workers=4,
 ):
-    smplify = TemporalSMPLify(
-        step_size=lr,
-        batch_size=batch_size,
-        num_iters=opt_steps,
-        focal_length=5000.,
-        use_lbfgs=use_lbfgs,
-        device=device,
-        # max_iter=10,
-    )
+    '''
+    Temporal SMPLify on the sequences of several persons at once.
+    The sequences are concatenated and optimized as one problem, every person keeps its own betas
+    (initialized from its frame with the lowest reprojection loss) and the temporal smoothness terms
+    do not cross from one person to the next.
+    :param pred_rotmats (list): VIBE pose of every person (rotation matrices, or axis-angle Nx72 if not pose2aa)
+    :param pred_betas (list): VIBE betas (torch.Tensor, Nx10) of every person
+    :param pred_cams (list): VIBE weak perspective camera (torch.Tensor, Nx3) of every person
+    :param j2ds (list): 2D keypoints (torch.Tensor, Nx49x3) of every person in the spin format
+    :param window_size (int): optimize overlapping windows of this many frames in num_workers threads instead of
+        whole sequences, see TemporalSMPLify.fit_windows
+    :param overlap (int): minimum number of frames shared by neighbouring windows
+    :return: list of the smplify_runner outputs of every person
+    '''
+    if len(j2ds) == 0:
+        return []
+    if window_size is not None and not 0 <= overlap < window_size:
+        raise ValueError(f'The SMPLify window overlap must be in [0, {window_size}), got {overlap}')
+
+    smplify = get_smplify(device, lr=lr, opt_steps=opt_steps, use_lbfgs=use_lbfgs)
+    lengths = [j2d.shape[0] for j2d in j2ds]
+    offsets = np.cumsum([0] + lengths)
+    batch_size = offsets[-1]
+
     # Convert predicted rotation matrices to axis-angle
     if pose2aa:
-        pred_pose = rotation_matrix_to_angle_axis(pred_rotmat.detach()).reshape(batch_size, -1)
+        pred_pose = torch.cat([
+            rotation_matrix_to_angle_axis(pred_rotmat.detach()).reshape(length, -1)
+            for pred_rotmat, length in zip(pred_rotmats, lengths)
+        ])
     else:
-        pred_pose = pred_rotmat
+        pred_pose = torch.cat(pred_rotmats)
+    pred_betas = torch.cat(pred_betas)
+    pred_cam = torch.cat(pred_cams)
+    camera_center = 0.5 * 224 * torch.ones(batch_size, 2, device=device)
 
     # Calculate camera parameters for smplify
     pred_cam_t = torch.stack([
@@ -121,50 +155,76 @@ def smplify_runner(
         2 * 5000 / (224 * pred_cam[:, 0] + 1e-9)
     ], dim=-1)
 
-    gt_keypoints_2d_orig = j2d
+    gt_keypoints_2d_orig = torch.cat(j2ds)
     # Before running compute reprojection error of the network
     opt_joint_loss = smplify.get_fitting_loss(
         pred_pose.detach(), pred_betas.detach(),
         pred_cam_t.detach(),
-        0.5 * 224 * torch.ones(batch_size, 2, device=device),
+        camera_center,
         gt_keypoints_2d_orig).mean(dim=-1)
 
-    best_prediction_id = torch.argmin(opt_joint_loss).item()
-    pred_betas = pred_betas[best_prediction_id].unsqueeze(0)
-    # pred_betas = pred_betas[best_prediction_id:best_prediction_id+2] # .unsqueeze(0)
-    # top5_best_idxs = torch.topk(opt_joint_loss, 5, largest=False)[1]
-    # breakpoint()
+    best_prediction_ids = [
+        start + torch.argmin(opt_joint_loss[start:end]).item() for start, end in zip(offsets[:-1], offsets[1:])
+    ]
+    init_betas = pred_betas[best_prediction_ids]
 
-    start = time.time()
     # Run SMPLify optimization initialized from the network prediction
-    # new_opt_vertices, new_opt_joints, \
-    # new_opt_pose, new_opt_betas, \
-    # new_opt_cam_t, \
-    output, new_opt_joint_loss = smplify(
-        pred_pose.detach(), pred_betas.detach(),
-        pred_cam_t.detach(),
-        0.5 * 224 * torch.ones(batch_size, 2, device=device),
-        gt_keypoints_2d_orig,
-    )
+    if window_size is not None:
+        output, new_opt_joint_loss = smplify.fit_windows(
+            pred_pose.detach(), init_betas.detach(),
+            pred_cam_t.detach(),
+            camera_center,
+            gt_keypoints_2d_orig,
+            seq_lengths=lengths,
+            window_size=window_size,
+            overlap=overlap,
+            num_workers=num_workers,
+        )
+    else:
+        output, new_opt_joint_loss = smplify(
+            pred_pose.detach(), init_betas.detach(),
+            pred_cam_t.detach(),
+            camera_center,
+            gt_keypoints_2d_orig,
+            seq_lengths=lengths,
+        )
     new_opt_joint_loss = new_opt_joint_loss.mean(dim=-1)
-    # smplify_time = time.time() - start
-    # print(f'Smplify time: {smplify_time}')
     # Will update the dictionary for the examples where the new loss is less than the current one
     update = (new_opt_joint_loss < opt_joint_loss)
 
-    new_opt_vertices = output['verts']
-    new_opt_cam_t = output['theta'][:,:3]
-    new_opt_pose = output['theta'][:,3:75]
-    new_opt_betas = output['theta'][:,75:]
-    new_opt_joints3d = output['kp_3d']
-
-    return_val = [
-        update, new_opt_vertices.cpu(), new_opt_cam_t.cpu(),
-        new_opt_pose.cpu(), new_opt_betas.cpu(), new_opt_joints3d.cpu(),
-        new_opt_joint_loss, opt_joint_loss,
+    new_opt_vertices = output['verts'].cpu()
+    new_opt_cam_t = output['theta'][:, :3].cpu()
+    new_opt_pose = output['theta'][:, 3:75].cpu()
+    new_opt_betas = output['theta'][:, 75:].cpu()
+    new_opt_joints3d = output['kp_3d'].cpu()
+
+    return [
+        [
+            update[start:end], new_opt_vertices[start:end], new_opt_cam_t[start:end],
+            new_opt_pose[start:end], new_opt_betas[start:end], new_opt_joints3d[start:end],
+            new_opt_joint_loss[start:end], opt_joint_loss[start:end],
+        ]
+        for start, end in zip(offsets[:-1], offsets[1:])
     ]
 
-    return return_val
+
+def smplify_runner(
+        pred_rotmat,
+        pred_betas,
+        pred_cam,
+        j2d,
+        device,
+        batch_size,
+        lr=1.0,
+        opt_steps=1,
+        use_lbfgs=True,
+        pose2aa=True
+):
+    # batch_size is the number of frames of j2d, the engine does not depend on it anymore
+    return batch_smplify_runner(
+        [pred_rotmat], [pred_betas], [pred_cam], [j2d], device,
+        lr=lr, opt_steps=opt_steps, use_lbfgs=use_lbfgs, pose2aa=pose2aa,
+    )[0]
 
 
 def trim_videos(filename, start_time, end_time, output_filename):
@@ -204,6 +264,79 @@ def video_to_images(vid_file, img_folder=None, return_info=False):
         return img_folder
 
 
+def get_frame_source(vid_file, dump_frames=False, img_folder=None, frame_store=False, store_dir=None):
+    '''
+    Open a video for the demo pipeline.
+    :param vid_file (str): input video path
+    :param dump_frames (bool): extract all frames to a PNG folder with ffmpeg first (legacy behaviour)
+    :param img_folder (str): PNG folder used when dump_frames is enabled
+    :param frame_store (bool): decode the video once into a memory mapped FrameStore shared by all stages
+    :param store_dir (str): directory of the FrameStore file, defaults to /dev/shm when the video fits
+    :return: VideoFrameSource, ImageFolderSource or FrameStore
+    '''
+    frame_source = None
+    if not dump_frames:
+        try:
+            frame_source = VideoFrameSource(vid_file)
+            print(f'Decoding \"{vid_file}\" in process, {frame_source.fps:.2f} fps')
+        except ValueError as e:
+            print(f'{e}, falling back to extracting frames with ffmpeg')
+
+    if frame_source is None:
+        img_folder = video_to_images(vid_file, img_folder=img_folder)
+        cap = cv2.VideoCapture(vid_file)
+        fps = cap.get(cv2.CAP_PROP_FPS) if cap.isOpened() else None
+        cap.release()
+        frame_source = ImageFolderSource(img_folder, fps=fps)
+
+    if frame_store:
+        store = FrameStore.from_source(frame_source, store_dir=store_dir)
+        frame_source.release()
+        if isinstance(frame_source, ImageFolderSource):
+            shutil.rmtree(frame_source.img_folder)
+        frame_source = store
+
+    return frame_source
+
+
+def require_mpt_internals(mot, names, hint=''):
+    '''
+    The public API of multi_person_tracker is MPT.__call__ on an image folder. Streaming frames (run_tracker) and
+    per frame tracking (demo_live.py) use its internals, which are not versioned (it is installed from the git
+    master branch, see requirements.txt). Fail with a clear error if they are missing instead of deep inside them.
+    :param mot (MPT): tracker
+    :param names (list): attributes used, dotted for nested ones, e.g. 'tracker.update'
+    :param hint (str): appended to the error message
+    '''
+    for name in names:
+        obj = mot
+        for part in name.split('.'):
+            if not hasattr(obj, part):
+                raise RuntimeError(
+                    f'This version of multi_person_tracker has no MPT.{name}, which is used outside of its public '
+                    f'API. {hint}'.strip()
+                )
+            obj = getattr(obj, part)
+
+
+def run_tracker(mot, frame_source, batch_size=12):
+    '''
+    Run the multi person tracker on a frame source.
+    Frames are streamed to the detector, nothing is written to disk.
+    :return: tracking results dict, same format as MPT(output_format='dict')
+    '''
+    if isinstance(frame_source, ImageFolderSource):
+        return mot(frame_source.img_folder)
+
+    require_mpt_internals(
+        mot, ['run_tracker', 'prepare_output_tracks'],
+        hint='Use --dump_frames (the "dump_frames" config) to track on extracted frames with the public API.',
+    )
+    dataloader = DataLoader(FrameStream(frame_source), batch_size=batch_size, num_workers=0)
+    trackers = mot.run_tracker(dataloader)
+    return mot.prepare_output_tracks(trackers)
+
+
 def download_url(url, outdir):
     print(f'Downloading files from {url}')
     cmd = ['wget', '-c', url, '-P', outdir]
@@ -217,6 +350,62 @@ def download_url(url, outdir):
     # subprocess.call(cmd)
 
 
+def get_demo_model(device, bundle_file=None, compile_mode=None, backend='torch', onnx_dir=ONNX_DIR):
+    '''
+    Build VIBE_Demo with the pretrained demo weights.
+    :param device (torch.device): device of the model, the onnx backend always runs on the cpu
+    :param bundle_file (str): deployment bundle, loaded in one read if it exists, else created from the
+        SPIN and VIBE checkpoints
+    :param compile_mode (str): compile the backbone with 'script' (TorchScript) or 'compile' (torch.compile),
+        see lib.models.jit
+    :param backend (str): 'torch' or 'onnx' (onnxruntime), see lib.models.onnx_backend
+    :param onnx_dir (str): ONNX graphs of the onnx backend, exported from the torch model if they do not exist
+    :return: VIBE_Demo in eval mode, or OnnxVIBE_Demo
+    '''
+    start = time.time()
+    if backend == 'onnx' and has_onnx_export(onnx_dir):
+        model = OnnxVIBE_Demo(onnx_dir)
+        print(f'VIBE model startup took {time.time() - start:.2f}s')
+        return model
+
+    if bundle_file is not None and osp.isfile(bundle_file):
+        model = VIBE_Demo.from_bundle(bundle_file)
+        weights_files = [bundle_file]
+    else:
+        model = VIBE_Demo(
+            seqlen=16,
+            n_layers=2,
+            hidden_size=1024,
+            add_linear=True,
+            use_residual=True,
+        )
+
+        pretrained_file = download_ckpt(use_3dpw=False)
+        ckpt = torch.load(pretrained_file, map_location='cpu')
+        print(f'Performance of pretrained model on 3DPW: {ckpt["performance"]}')
+        ckpt = ckpt['gen_state_dict']
+        model.load_state_dict(ckpt, strict=False)
+        print(f'Loaded pretrained weights from \"{pretrained_file}\"')
+        # the backbone weights come from the SPIN checkpoint, see VIBE_Demo
+        spin_file = osp.join(VIBE_DATA_DIR, 'spin_model_checkpoint.pth.tar')
+        weights_files = [spin_file, pretrained_file] if osp.isfile(spin_file) else [pretrained_file]
+
+        if bundle_file is not None:
+            model.save_bundle(bundle_file)
+
+    # BatchNorms and the input normalization are folded into the convs, the model takes raw [0, 1] crops
+    model = model.eval().fuse_for_inference()
+    if backend == 'onnx':
+        export_vibe_demo(model, onnx_dir)
+        model = OnnxVIBE_Demo(onnx_dir)
+    else:
+        model = model.to(device).eval()
+        if compile_mode is not None:
+            model = compile_vibe_demo(model, mode=compile_mode, weights_files=weights_files)
+    print(f'VIBE model startup took {time.time() - start:.2f}s')
+    return model
+
+
 def download_ckpt(outdir='data/vibe_data', use_3dpw=False):
     base_dir = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
     outdir = os.path.join(base_dir, outdir)
@@ -294,14 +483,17 @@ def convert_crop_coords_to_orig_img(bbox, keypoints, crop_size):
 def prepare_rendering_results(vibe_results, nframes):
     frame_results = [{} for _ in range(nframes)]
     for person_id, person_data in vibe_results.items():
+        # verts and joints3d are None if they were not computed, the renderer reconstructs them from row idx
+        verts, joints3d = person_data.get('verts'), person_data.get('joints3d')
         for idx, frame_id in enumerate(person_data['frame_ids']):
             frame_results[frame_id][person_id] = {
-                'verts': person_data['verts'][idx],
+                'idx': idx,
+                'verts': verts[idx] if verts is not None else None,
                 'cam': person_data['orig_cam'][idx],
 
                 # [VIBE-Object Start]
                 # Append the 3D joint data so that we can translate our object accordingly.
-                'joints3d': person_data['joints3d'][idx],
+                'joints3d': joints3d[idx] if joints3d is not None else None,
                 'pose': person_data['pose'][idx]
                 # [VIBE-Object End]
             }
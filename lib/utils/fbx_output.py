@@ -162,8 +162,14 @@ def process_poses(
 
     print('Processing: ' + input_path)
 
-    data = joblib.load(input_path)
-    poses = data[person_id]['pose']
+    if input_path.endswith('.h5'):
+        # only the poses of this person are read from the results file
+        import h5py
+        with h5py.File(input_path, 'r') as f:
+            poses = f[str(person_id)]['pose'][()]
+    else:
+        data = joblib.load(input_path)
+        poses = data[person_id]['pose']
     trans = np.zeros((poses.shape[0], 3))
 
     if gender == 'female':
@@ -306,7 +312,7 @@ if __name__ == '__main__':
             sys.exit(1)
 
         # Process pose file
-        if input_path.endswith('.pkl'):
+        if input_path.endswith('.pkl') or input_path.endswith('.h5'):
             if not os.path.isfile(input_path):
                 print('ERROR: Invalid input file')
                 sys.exit(1)
@@ -0,0 +1,231 @@
+# -*- coding: utf-8 -*-
+
+# Max-Planck-Gesellschaft zur Förderung der Wissenschaften e.V. (MPG) is
+# holder of all proprietary rights on this computer program.
+# You can only use this computer program if you have closed
+# a license agreement with MPG or you get the right to use the computer
+# program from someone who is authorized to grant you that right.
+# Any use of the computer program without a valid license is prohibited and
+# liable to prosecution.
+#
+# Copyright©2019 Max-Planck-Gesellschaft zur Förderung
+# der Wissenschaften e.V. (MPG). acting on behalf of its Max Planck Institute
+# for Intelligent Systems. All rights reserved.
+#
+# Contact: ps-license@tuebingen.mpg.de
+
+import os
+import cv2
+import shutil
+import tempfile
+import numpy as np
+import os.path as osp
+
+
+class VideoFrameSource:
+    """
+    Decodes the frames of a video file in process with OpenCV.
+
+    Frames are returned as BGR uint8 arrays, exactly like cv2.imread on the
+    PNGs written by video_to_images. Iterating streams the whole video once.
+
+    Indexing is frame accurate: frames are only ever decoded in order, since
+    seeking with CAP_PROP_POS_FRAMES lands on a neighbouring frame for many
+    long-GOP and variable frame rate videos. Up to `max_decoders` decoders
+    are kept open at different positions, a frame is read by advancing the
+    decoder closest before it, or a new one from the first frame. Contiguous
+    reads (e.g. one tracklet of a DataLoader batch or one render chunk)
+    continue where the previous read stopped.
+    """
+    def __init__(self, vid_file, max_decoders=4):
+        self.vid_file = vid_file
+        self.max_decoders = max_decoders
+
+        cap = cv2.VideoCapture(vid_file)
+        if not cap.isOpened():
+            raise ValueError(f'Could not open video file \"{vid_file}\"')
+
+        # CAP_PROP_FRAME_COUNT is read from the container and may be slightly off,
+        # it is replaced by the decoded frame count after the first full pass.
+        self.num_frames = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
+        self.fps = cap.get(cv2.CAP_PROP_FPS)
+        width = int(cap.get(cv2.CAP_PROP_FRAME_WIDTH))
+        height = int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT))
+        self.img_shape = (height, width, 3)
+        cap.release()
+
+        # [capture, index of the next frame it decodes], least recently used first
+        self._decoders = []
+
+    def __len__(self):
+        return self.num_frames
+
+    def __getitem__(self, idx):
+        if idx < 0:
+            idx += len(self)
+
+        decoders = [d for d in self._decoders if d[1] <= idx]
+        if len(decoders) > 0:
+            decoder = max(decoders, key=lambda d: d[1])
+            self._decoders.remove(decoder)
+        else:
+            if len(self._decoders) >= self.max_decoders:
+                self._decoders.pop(0)[0].release()
+            decoder = [cv2.VideoCapture(self.vid_file), 0]
+
+        cap = decoder[0]
+        # grab decodes without converting the frame
+        while decoder[1] < idx and cap.grab():
+            decoder[1] += 1
+        ret, img = cap.read() if decoder[1] == idx else (False, None)
+        if not ret:
+            cap.release()
+            raise IndexError(f'Frame {idx} could not be decoded from \"{self.vid_file}\"')
+
+        decoder[1] = idx + 1
+        self._decoders.append(decoder)
+        return img
+
+    def __iter__(self):
+        cap = cv2.VideoCapture(self.vid_file)
+        num_frames = 0
+        while True:
+            ret, img = cap.read()
+            if not ret:
+                break
+            num_frames += 1
+            yield img
+        cap.release()
+        self.num_frames = num_frames
+
+    def __getstate__(self):
+        # cv2.VideoCapture cannot be pickled, every DataLoader worker opens its own decoders
+        state = self.__dict__.copy()
+        state['_decoders'] = []
+        return state
+
+    def release(self):
+        for cap, _ in self._decoders:
+            cap.release()
+        self._decoders = []
+
+
+class ImageFolderSource:
+    """
+    Frame source backed by a folder of extracted frames, i.e. the output of
+    video_to_images. Kept as a fallback for inputs OpenCV cannot decode.
+    """
+    def __init__(self, img_folder, fps=None):
+        self.img_folder = img_folder
+        self.image_file_names = sorted([
+            osp.join(img_folder, x)
+            for x in os.listdir(img_folder)
+            if x.endswith('.png') or x.endswith('.jpg')
+        ])
+        self.num_frames = len(self.image_file_names)
+        self.fps = fps
+        self.img_shape = cv2.imread(self.image_file_names[0]).shape
+
+    def __len__(self):
+        return self.num_frames
+
+    def __getitem__(self, idx):
+        return cv2.imread(self.image_file_names[idx])
+
+    def __iter__(self):
+        for img_fname in self.image_file_names:
+            yield cv2.imread(img_fname)
+
+    def release(self):
+        pass
+
+
+class FrameStore:
+    """
+    The decoded frames of a video held once as a single uint8 (N,H,W,3)
+    memory mapped array.
+
+    Indexing returns zero-copy, read-only views (slices are supported), so the
+    tracker, the crop DataLoader workers and the renderer all share the same
+    page cache instead of decoding the video again. Place the file on tmpfs
+    (/dev/shm) to keep it in RAM.
+    """
+    def __init__(self, filename, num_frames, img_shape, fps=None):
+        self.filename = filename
+        self.num_frames = num_frames
+        self.img_shape = tuple(img_shape)
+        self.fps = fps
+        self.frames = None
+        self._owner = False
+
+    @classmethod
+    def from_source(cls, frame_source, store_dir=None):
+        '''
+        Decode a frame source into a new memory mapped store.
+        :param frame_source: VideoFrameSource or ImageFolderSource
+        :param store_dir (str): directory of the store file, defaults to /dev/shm if the video fits, else temp/
+        '''
+        img_shape = frame_source.img_shape
+        frame_bytes = int(np.prod(img_shape))
+        capacity = max(len(frame_source), 1)
+
+        if store_dir is None:
+            store_dir = 'temp'
+            if osp.isdir('/dev/shm') and shutil.disk_usage('/dev/shm').free > 2 * capacity * frame_bytes:
+                store_dir = '/dev/shm'
+        os.makedirs(store_dir, exist_ok=True)
+
+        fd, filename = tempfile.mkstemp(suffix='.frames', dir=store_dir)
+        os.close(fd)
+        print(f'Storing decoded frames in \"{filename}\" ({capacity * frame_bytes / 2**30:.2f} GB)')
+
+        store = cls(filename, 0, img_shape, fps=frame_source.fps)
+        store._owner = True
+        frames = np.memmap(filename, dtype=np.uint8, mode='w+', shape=(capacity,) + tuple(img_shape))
+
+        num_frames = 0
+        for img in frame_source:
+            if num_frames == capacity:
+                # the container frame count was too low, grow the file
+                frames.flush()
+                del frames
+                capacity = int(capacity * 1.1) + 1
+                frames = np.memmap(filename, dtype=np.uint8, mode='r+', shape=(capacity,) + tuple(img_shape))
+            frames[num_frames] = img
+            num_frames += 1
+
+        frames.flush()
+        del frames
+
+        store.num_frames = num_frames
+        return store
+
+    def _open(self):
+        self.frames = np.memmap(self.filename, dtype=np.uint8, mode='r',
+                                shape=(self.num_frames,) + self.img_shape)
+
+    def __len__(self):
+        return self.num_frames
+
+    def __getitem__(self, idx):
+        if self.frames is None:
+            self._open()
+        return self.frames[idx]
+
+    def __iter__(self):
+        if self.frames is None:
+            self._open()
+        for idx in range(self.num_frames):
+            yield self.frames[idx]
+
+    def __getstate__(self):
+        # DataLoader workers map the file again instead of pickling the frames
+        state = self.__dict__.copy()
+        state['frames'] = None
+        state['_owner'] = False
+        return state
+
+    def release(self):
+        self.frames = None
+        if self._owner and osp.isfile(self.filename):
+            os.remove(self.filename)
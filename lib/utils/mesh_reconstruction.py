@@ -0,0 +1,128 @@
+# -*- coding: utf-8 -*-
+
+# Max-Planck-Gesellschaft zur Förderung der Wissenschaften e.V. (MPG) is
+# holder of all proprietary rights on this computer program.
+# You can only use this computer program if you have closed
+# a license agreement with MPG or you get the right to use the computer
+# program from someone who is authorized to grant you that right.
+# Any use of the computer program without a valid license is prohibited and
+# liable to prosecution.
+#
+# Copyright©2019 Max-Planck-Gesellschaft zur Förderung
+# der Wissenschaften e.V. (MPG). acting on behalf of its Max Planck Institute
+# for Intelligent Systems. All rights reserved.
+#
+# Contact: ps-license@tuebingen.mpg.de
+
+import torch
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+
+from lib.models.smpl import SMPL, SMPL_MODEL_DIR
+
+
+class MeshReconstructor():
+    """
+    Reconstructs SMPL meshes from pose and betas on demand, chunk by chunk,
+    so the vertices of a whole video never have to be held in memory.
+    With `prefetch` the next chunk is reconstructed on a worker thread
+    while the current one is consumed.
+    """
+    def __init__(self, smpl=None, device=torch.device('cpu'), chunk_size=128, prefetch=True):
+        if smpl is None:
+            smpl = SMPL(SMPL_MODEL_DIR, batch_size=chunk_size, create_transl=False)
+        self.smpl = smpl.to(device).eval()
+        self.faces = smpl.faces
+        self.device = device
+        self.chunk_size = chunk_size
+        self.executor = ThreadPoolExecutor(max_workers=1) if prefetch else None
+
+    @torch.no_grad()
+    def reconstruct(self, pose, betas):
+        '''
+        :param pose (ndarray, Nx72): SMPL pose in axis-angle format
+        :param betas (ndarray, Nx10): SMPL shape
+        :return: vertices (ndarray, Nx6890x3) and joints (ndarray, Nx49x3)
+        '''
+        pose = torch.as_tensor(np.asarray(pose), dtype=torch.float32, device=self.device)
+        betas = torch.as_tensor(np.asarray(betas), dtype=torch.float32, device=self.device)
+        smpl_output = self.smpl(betas=betas, body_pose=pose[:, 3:], global_orient=pose[:, :3])
+        return smpl_output.vertices.cpu().numpy(), smpl_output.joints.cpu().numpy()
+
+    def submit(self, pose, betas):
+        if self.executor is None:
+            return None
+        return self.executor.submit(self.reconstruct, pose, betas)
+
+    def iter_chunks(self, pose, betas):
+        '''
+        :return: generator of (start, vertices, joints) over chunks of `chunk_size` frames
+        '''
+        meshes = LazyMeshes(self, pose, betas)
+        for start in range(0, len(meshes), self.chunk_size):
+            yield (start,) + meshes.get_chunk(start // self.chunk_size)
+
+    def close(self):
+        if self.executor is not None:
+            self.executor.shutdown()
+
+
+class LazyMeshes():
+    """
+    The meshes of one person, indexed by row like the pose and betas they are
+    reconstructed from. Only the chunk of the last accessed row is kept, and
+    the chunk after it is prefetched, accessing the rows in order (e.g. while
+    rendering) never waits for more than the first chunk.
+    """
+    def __init__(self, reconstructor, pose, betas):
+        self.reconstructor = reconstructor
+        self.pose = pose
+        self.betas = betas
+        self.chunk_idx = None
+        self.chunk = None
+        self.pending = {}
+
+    @classmethod
+    def from_results(cls, reconstructor, reader, person_id, start_frame=None, end_frame=None):
+        '''
+        :param reader (ResultsReader): results store of the demo, see lib.utils.results_store
+        :return: LazyMeshes of one person over a video frame range
+        '''
+        pose = reader.read(person_id, 'pose', start_frame, end_frame)
+        betas = reader.read(person_id, 'betas', start_frame, end_frame)
+        return cls(reconstructor, pose, betas)
+
+    def __len__(self):
+        return len(self.pose)
+
+    def chunk_rows(self, chunk_idx):
+        start = chunk_idx * self.reconstructor.chunk_size
+        return slice(start, min(start + self.reconstructor.chunk_size, len(self)))
+
+    def get_chunk(self, chunk_idx):
+        if chunk_idx != self.chunk_idx:
+            future = self.pending.pop(chunk_idx, None)
+            if future is not None:
+                self.chunk = future.result()
+            else:
+                rows = self.chunk_rows(chunk_idx)
+                self.chunk = self.reconstructor.reconstruct(self.pose[rows], self.betas[rows])
+            self.chunk_idx = chunk_idx
+
+            # chunks that were prefetched but skipped are dropped
+            self.pending.clear()
+            next_rows = self.chunk_rows(chunk_idx + 1)
+            if next_rows.start < len(self):
+                future = self.reconstructor.submit(self.pose[next_rows], self.betas[next_rows])
+                if future is not None:
+                    self.pending[chunk_idx + 1] = future
+        return self.chunk
+
+    def __getitem__(self, idx):
+        '''
+        :return: vertices (ndarray, 6890x3) and joints (ndarray, 49x3) of row idx
+        '''
+        chunk_idx = idx // self.reconstructor.chunk_size
+        verts, joints = self.get_chunk(chunk_idx)
+        offset = idx - chunk_idx * self.reconstructor.chunk_size
+        return verts[offset], joints[offset]
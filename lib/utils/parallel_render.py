@@ -0,0 +1,93 @@
+# -*- coding: utf-8 -*-
+
+# Max-Planck-Gesellschaft zur Förderung der Wissenschaften e.V. (MPG) is
+# holder of all proprietary rights on this computer program.
+# You can only use this computer program if you have closed
+# a license agreement with MPG or you get the right to use the computer
+# program from someone who is authorized to grant you that right.
+# Any use of the computer program without a valid license is prohibited and
+# liable to prosecution.
+#
+# Copyright©2019 Max-Planck-Gesellschaft zur Förderung
+# der Wissenschaften e.V. (MPG). acting on behalf of its Max Planck Institute
+# for Intelligent Systems. All rights reserved.
+#
+# Contact: ps-license@tuebingen.mpg.de
+
+
+import pickle
+import multiprocessing as mp
+from collections import deque
+
+# state of a render worker process, set up once by init_worker
+_worker = {}
+
+
+def init_worker(frame_source, setup):
+    import torch
+    torch.set_num_threads(1)
+
+    # a copy of the source with handles of its own, e.g. a FrameStore maps the shared file again
+    _worker['frame_source'] = pickle.loads(pickle.dumps(frame_source))
+    _worker['render_fn'] = setup()
+
+
+def render_chunk(start, end):
+    frame_source, render_fn = _worker['frame_source'], _worker['render_fn']
+    return [render_fn(frame_source[frame_idx], frame_idx) for frame_idx in range(start, end)]
+
+
+class ParallelRenderer():
+    """
+    Renders the frames of a video on `num_workers` processes.
+
+    The frame range is split into chunks of `chunk_size` contiguous frames
+    that are handed out to the workers. Every worker has a Renderer (and so
+    an EGL context) of its own, created by `setup` after the fork, and reads
+    its frames from its own handle of the frame source; with a FrameStore
+    all workers map the same shared memory. The rendered frames are yielded
+    in order, at most `max_pending` chunks are in flight so memory stays
+    bounded when the consumer (e.g. the video writer) is slower.
+
+    With `num_workers` <= 1 the frames are rendered in process.
+    """
+    def __init__(self, frame_source, setup, num_workers=1, chunk_size=16, max_pending=None):
+        '''
+        :param frame_source: frame source of the video, see lib.utils.frame_source
+        :param setup (callable): called once per worker, returns render_fn(img, frame_idx) -> rendered img.
+            It is not pickled, the workers are forked, but it must not reuse GPU or thread state of the parent
+        '''
+        self.frame_source = frame_source
+        self.setup = setup
+        self.num_workers = num_workers
+        self.chunk_size = chunk_size
+        self.max_pending = max_pending if max_pending is not None else 2 * num_workers
+
+    def __call__(self, num_frames):
+        '''
+        :param num_frames (int): render frames 0 to num_frames - 1
+        :return: generator of (frame_idx, rendered img) in frame order
+        '''
+        if self.num_workers <= 1:
+            render_fn = self.setup()
+            for frame_idx, img in enumerate(self.frame_source):
+                if frame_idx >= num_frames:
+                    break
+                yield frame_idx, render_fn(img, frame_idx)
+            return
+
+        chunks = [(start, min(start + self.chunk_size, num_frames)) for start in range(0, num_frames, self.chunk_size)]
+
+        # forked workers get `setup` without pickling, each one creates its own EGL context in it
+        ctx = mp.get_context('fork')
+        with ctx.Pool(self.num_workers, initializer=init_worker, initargs=(self.frame_source, self.setup)) as pool:
+            pending = deque()
+            next_chunk = 0
+            while next_chunk < len(chunks) or len(pending) > 0:
+                while next_chunk < len(chunks) and len(pending) < self.max_pending:
+                    pending.append((chunks[next_chunk][0], pool.apply_async(render_chunk, chunks[next_chunk])))
+                    next_chunk += 1
+
+                start, result = pending.popleft()
+                for i, img in enumerate(result.get()):
+                    yield start + i, img
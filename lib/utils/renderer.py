@@ -18,8 +18,16 @@ import math
 import trimesh
 import pyrender
 import numpy as np
+import scipy.sparse as sparse
 from pyrender.constants import RenderFlags
+from OpenGL.GL import glBindBuffer, glBufferData, glBufferSubData, GL_ARRAY_BUFFER, GL_STATIC_DRAW
 from lib.models.smpl import get_smpl_faces
+from lib.models.smpl_lod import get_smpl_lod
+
+# The persistent meshes and asset instances are updated in place through private pyrender state
+# (Primitive._vaid and ._buffers, OffscreenRenderer._platform). The layout was checked against pyrender 0.1.36
+# (requirements.txt) up to 0.1.45, see Renderer.has_gl_buffers for the fallback on other versions.
+PYRENDER_GL_VERSIONS = ('0.1.36', '0.1.45')
 
 
 class WeakPerspectiveCamera(pyrender.Camera):
@@ -47,11 +55,53 @@ class WeakPerspectiveCamera(pyrender.Camera):
         return P
 
 
+class CroppedCamera(pyrender.Camera):
+    """ Renders the pixel region (x0, y0, x1, y1) of the width x height image seen by `camera` """
+    def __init__(self, camera, region, width, height):
+        super(CroppedCamera, self).__init__(
+            znear=camera.znear,
+            zfar=camera.zfar,
+        )
+        self.camera = camera
+        self.width = width
+        self.height = height
+
+        # maps the NDC range of the region to [-1, 1], pixel rows go down while NDC y goes up
+        x0, y0, x1, y1 = region
+        left, right = 2. * x0 / width - 1., 2. * x1 / width - 1.
+        bottom, top = 1. - 2. * y1 / height, 1. - 2. * y0 / height
+        self.crop = np.eye(4)
+        self.crop[0, 0], self.crop[0, 3] = 2. / (right - left), -(right + left) / (right - left)
+        self.crop[1, 1], self.crop[1, 3] = 2. / (top - bottom), -(top + bottom) / (top - bottom)
+
+    def get_projection_matrix(self, width=None, height=None):
+        return self.crop @ self.camera.get_projection_matrix(self.width, self.height)
+
+
 class Renderer:
-    def __init__(self, resolution=(224,224), orig_img=False, wireframe=False, renderOnWhite = False):
+    """
+    With `persistent` the humans pushed with a track_id keep their mesh node
+    between frames. Every track gets one node sharing the SMPL face indices,
+    only the vertex positions and normals are written to its vertex buffer on
+    later frames. The weak perspective camera and the materials are reused too.
+
+    Rendered pixels are copied onto the frame in place (uint8), only inside the
+    projected bounding box of the pushed meshes. With `scissor` only that box
+    (rounded up to `scissor_step` pixels, which keeps the framebuffer size
+    stable) is rendered and read back instead of the full frame.
+
+    With `lod` (see lib.models.smpl_lod) the humans are drawn with a decimated
+    SMPL mesh of that many vertices, full SMPL vertices are mapped to it.
+    """
+    def __init__(self, resolution=(224,224), orig_img=False, wireframe=False, renderOnWhite = False, persistent=False,
+                 scissor=False, scissor_step=64, lod=None):
         self.resolution = resolution
+        self.scissor = scissor
+        self.scissor_step = scissor_step
 
-        self.faces = get_smpl_faces()
+        self.lod = get_smpl_lod(lod) if lod is not None else None
+        self.faces = self.lod.faces if self.lod is not None else get_smpl_faces()
+        self.persistent = persistent
         self.orig_img = orig_img
         self.wireframe = wireframe
         self.renderer = pyrender.OffscreenRenderer(
@@ -79,15 +129,32 @@ class Renderer:
         self.cam_node = None
         self.camera_pose = np.eye(4)
         self.fov = 0.0
-        self.object_nodes = []
+        self.asset_nodes = {}
+        self.asset_meshes = {}
+        self.asset_poses = {}
         self.human_nodes = []
         # [VIBE-Object End]
 
+        # persistent scene graph: track_id -> mesh node, pending vertex buffer updates, reused camera and materials
+        self.track_nodes = {}
+        self.visible_tracks = []
+        self.vertex_updates = {}
+        self.weak_cam_node = None
+        self.materials = {}
+
+        # sums the (area weighted) normals of the faces around every vertex
+        num_faces = self.faces.shape[0]
+        self.vertex_faces = sparse.csr_matrix(
+            (np.ones(num_faces * 3), (self.faces.ravel(), np.repeat(np.arange(num_faces), 3))),
+            shape=(self.lod.num_verts if self.lod is not None else self.faces.max() + 1, num_faces),
+        )
+
         if renderOnWhite:
             self.whiteBackground = np.full((self.resolution[1], self.resolution[0], 3), 255, dtype=np.uint8)
 
     # Original VIBE function to render a human.
     def render(self, img, verts, cam, angle=None, axis=None, mesh_filename=None, color=[1.0, 1.0, 0.9]):
+        verts = self.lod_verts(verts)
         mesh = trimesh.Trimesh(vertices=verts, faces=self.faces, process=False)
 
         Rx = trimesh.transformations.rotation_matrix(math.radians(180), [1, 0, 0])
@@ -126,10 +193,10 @@ class Renderer:
         else:
             render_flags = RenderFlags.RGBA
 
+        self.renderer.viewport_width, self.renderer.viewport_height = self.resolution
         rgb, _ = self.renderer.render(self.scene, flags=render_flags)
-        valid_mask = (rgb[:, :, -1] > 0)[:, :, np.newaxis]
-        output_img = rgb[:, :, :-1] * valid_mask + (1 - valid_mask) * img
-        image = output_img.astype(np.uint8)
+        image = img.copy()
+        self.composite(image, rgb)
 
         self.scene.remove_node(mesh_node)
         self.scene.remove_node(cam_node)
@@ -138,21 +205,57 @@ class Renderer:
 
     def push_weak_cam(self, cam):
         sx, sy, tx, ty = cam
-        camera = WeakPerspectiveCamera(
-            scale=[sx, sy],
-            translation=[tx, ty],
-            zfar=1000.
-        )
         self.camera_pose = np.eye(4)
-        self.cam_node = self.scene.add(camera, pose=self.camera_pose)
+        if self.persistent and self.weak_cam_node is not None:
+            self.weak_cam_node.camera.scale = [sx, sy]
+            self.weak_cam_node.camera.translation = [tx, ty]
+            self.cam_node = self.weak_cam_node
+        else:
+            camera = WeakPerspectiveCamera(
+                scale=[sx, sy],
+                translation=[tx, ty],
+                zfar=1000.
+            )
+            self.cam_node = self.scene.add(camera, pose=self.camera_pose)
+            if self.persistent:
+                self.weak_cam_node = self.cam_node
+        self.scene.main_camera_node = self.cam_node
 
     def push_persp_cam(self, yfov, cam_pose=np.eye(4)):
         self.fov = yfov
         camera = pyrender.PerspectiveCamera(yfov, 0.1, 1000.0)
         self.camera_pose = cam_pose
         self.cam_node = self.scene.add(camera, pose=self.camera_pose)
-        
-    def push_human(self, verts, color=[1.0, 1.0, 0.9], translation=[0.0, 0.0, 0.0]):
+        self.scene.main_camera_node = self.cam_node
+
+    def lod_verts(self, verts):
+        # SMPL vertices to the vertices of the level of detail, vertices that already are pass through
+        if self.lod is None or len(verts) == self.lod.num_verts:
+            return verts
+        return self.lod(np.asarray(verts))
+
+    def get_material(self, color):
+        key = tuple(float(c) for c in color[:3])
+        if key not in self.materials:
+            self.materials[key] = pyrender.MetallicRoughnessMaterial(
+                metallicFactor=0.5,
+                alphaMode='OPAQUE',
+                baseColorFactor=(key[0], key[1], key[2], 1.0)
+            )
+        return self.materials[key]
+
+    def vertex_normals(self, verts):
+        tris = verts[self.faces]
+        normals = self.vertex_faces @ np.cross(tris[:, 1] - tris[:, 0], tris[:, 2] - tris[:, 0])
+        return normals / np.maximum(np.linalg.norm(normals, axis=1, keepdims=True), 1e-12)
+
+    def push_human(self, verts, color=[1.0, 1.0, 0.9], translation=[0.0, 0.0, 0.0], track_id=None, joints3d=None):
+        # joints3d is only drawn by the SkeletonRenderer
+        verts = self.lod_verts(verts)
+        if self.persistent and track_id is not None:
+            self.push_track(track_id, verts, color, translation)
+            return
+
         # Build mesh from vertices.
         mesh = trimesh.Trimesh(vertices=verts, faces=self.faces, process=False)
 
@@ -173,6 +276,94 @@ class Renderer:
         mesh = pyrender.Mesh.from_trimesh(mesh, material=material)
         self.human_nodes.append(self.scene.add(mesh))
 
+    def push_track(self, track_id, verts, color=[1.0, 1.0, 0.9], translation=[0.0, 0.0, 0.0]):
+        # the rotation to the renderer coordinate system and the translation go to the node pose
+        Rx = trimesh.transformations.rotation_matrix(math.pi, [1, 0, 0])
+        pose = trimesh.transformations.translation_matrix(translation) @ Rx
+
+        verts = np.asarray(verts, dtype=np.float32)
+        normals = self.vertex_normals(verts).astype(np.float32)
+
+        node = self.track_nodes.get(track_id)
+        if node is not None and not self.has_gl_buffers(node.mesh.primitives[0]):
+            # the buffers cannot be updated in place, rebuild the mesh
+            self.scene.remove_node(node)
+            node = None
+
+        if node is None:
+            primitive = pyrender.Primitive(
+                positions=verts,
+                normals=normals,
+                indices=self.faces,
+                material=self.get_material(color),
+            )
+            node = self.scene.add(pyrender.Mesh([primitive]), pose=pose)
+            self.track_nodes[track_id] = node
+        else:
+            primitive = node.mesh.primitives[0]
+            primitive.positions = verts
+            primitive.normals = normals
+            primitive.material = self.get_material(color)
+            self.scene.set_pose(node, pose)
+            # primitives that were rendered before are bound to a vertex buffer (positions and normals interleaved)
+            if primitive._vaid is not None:
+                self.vertex_updates[track_id] = (primitive, np.ascontiguousarray(np.hstack([verts, normals])))
+
+        node.mesh.is_visible = True
+        self.visible_tracks.append(node)
+
+    def has_gl_buffers(self, primitive):
+        '''
+        Whether the GL buffers of the primitive can be updated in place, i.e. pyrender exposes them in the layout of
+        PYRENDER_GL_VERSIONS: _vaid (None until the first draw uploads the primitive), _buffers[0] the interleaved
+        vertex buffer, _buffers[1] the model matrix buffer and a renderer platform with make_current.
+        Otherwise the caller rebuilds the pyrender.Mesh.
+        '''
+        return hasattr(primitive, '_vaid') and isinstance(getattr(primitive, '_buffers', None), list) \
+            and hasattr(getattr(self.renderer, '_platform', None), 'make_current')
+
+    def remove_track(self, track_id):
+        node = self.track_nodes.pop(track_id, None)
+        if node is not None:
+            self.scene.remove_node(node)
+        self.vertex_updates.pop(track_id, None)
+
+    def upload_buffers(self):
+        # the instance poses of every asset that is drawn in this pass
+        instance_updates = []
+        for key, node in self.asset_nodes.items():
+            poses = self.asset_poses.get(key)
+            node.mesh.is_visible = poses is not None
+            if poses is None:
+                continue
+            if not all(self.has_gl_buffers(primitive) for primitive in node.mesh.primitives):
+                # the instance buffers cannot be updated in place, rebuild the mesh with the poses of this pass
+                self.scene.remove_node(node)
+                color = key[1]
+                self.asset_nodes[key] = self.scene.add(pyrender.Mesh.from_trimesh(
+                    self.asset_meshes[key], material=self.get_material(color), poses=np.stack(poses)
+                ))
+                continue
+            for primitive in node.mesh.primitives:
+                primitive.poses = np.stack(poses)
+                if primitive._vaid is not None:
+                    instance_updates.append(primitive)
+
+        if len(self.vertex_updates) == 0 and len(instance_updates) == 0:
+            return
+
+        self.renderer._platform.make_current()
+        for primitive, vertex_data in self.vertex_updates.values():
+            glBindBuffer(GL_ARRAY_BUFFER, primitive._buffers[0])
+            glBufferSubData(GL_ARRAY_BUFFER, 0, vertex_data.nbytes, vertex_data)
+        for primitive in instance_updates:
+            # the model matrix buffer holds the transposed poses, its size changes with the number of instances
+            pose_data = np.ascontiguousarray(np.transpose(primitive.poses, [0, 2, 1]), dtype=np.float32)
+            glBindBuffer(GL_ARRAY_BUFFER, primitive._buffers[1])
+            glBufferData(GL_ARRAY_BUFFER, pose_data.nbytes, pose_data, GL_STATIC_DRAW)
+        glBindBuffer(GL_ARRAY_BUFFER, 0)
+        self.vertex_updates.clear()
+
     def push_obj(self,
                    mesh_file,
                    translation_offset = [0.0, 0.0, 0.0],
@@ -181,43 +372,92 @@ class Renderer:
                    axis=[1.0, 0.0, 0.0], # Rotation Axis (Right-Hand System: X points right. Y points up. Z points out.)
                    scale=[1.0, 1.0, 1.0],
                    color=[0.3, 1.0, 0.3]):
-        # Load mesh from file.
-        mesh = trimesh.load(mesh_file)
+        # Every asset is loaded and uploaded once, with one node per (file, color).
+        # Its placements of a render pass are drawn as instances of that node.
+        key = (mesh_file, tuple(float(c) for c in color[:3]))
+        if key not in self.asset_nodes:
+            self.asset_meshes[key] = trimesh.load(mesh_file)
+            mesh = pyrender.Mesh.from_trimesh(self.asset_meshes[key], material=self.get_material(color))
+            self.asset_nodes[key] = self.scene.add(mesh)
 
-        T_Offset = trimesh.transformations.translation_matrix(translation_offset)
-
-        # Apply transformations.
-        Sx = trimesh.transformations.scale_matrix(scale[0], origin=[0,0, 0.0, 0.0], direction=[1.0, 0.0, 0.0])
-        Sy = trimesh.transformations.scale_matrix(scale[1], origin=[0,0, 0.0, 0.0], direction=[0.0, 1.0, 0.0])
-        Sz = trimesh.transformations.scale_matrix(scale[2], origin=[0,0, 0.0, 0.0], direction=[0.0, 0.0, 1.0])
-        
         # prevent divide by zero error when angle is 0
         if angle == 0:
             R = trimesh.transformations.identity_matrix()
         else:
             R = trimesh.transformations.rotation_matrix(angle, axis)
 
+        # scale, offset, rotate and translate in one matrix
+        S = np.diag([scale[0], scale[1], scale[2], 1.0])
+        T_Offset = trimesh.transformations.translation_matrix(translation_offset)
         T = trimesh.transformations.translation_matrix(translation)
-        
-        mesh.apply_transform(Sx)
-        mesh.apply_transform(Sy)
-        mesh.apply_transform(Sz)
-        mesh.apply_transform(T_Offset)
-        mesh.apply_transform(R)
-        mesh.apply_transform(T)
-
-        # Setup material.
-        material = pyrender.MetallicRoughnessMaterial(
-            metallicFactor=0.5,
-            alphaMode='OPAQUE',
-            baseColorFactor=(color[0], color[1], color[2], 1.0)
-        )
-
-        # Attach material to mesh and add it to scene.
-        mesh = pyrender.Mesh.from_trimesh(mesh, material=material)
-        self.object_nodes.append(self.scene.add(mesh))
-
-    def pop_and_render(self, img = None):
+        self.asset_poses.setdefault(key, []).append(T @ R @ T_Offset @ S)
+
+    def projected_bbox(self):
+        '''
+        :return: pixel bbox (x0, y0, x1, y1) that contains everything pushed for this pass,
+            None if a mesh reaches behind a perspective camera
+        '''
+        def box_corners(points):
+            lo, hi = points.min(axis=0), points.max(axis=0)
+            return np.array([[x, y, z, 1.] for x in (lo[0], hi[0]) for y in (lo[1], hi[1]) for z in (lo[2], hi[2])])
+
+        corners = []
+        for node in self.visible_tracks + self.human_nodes:
+            for primitive in node.mesh.primitives:
+                corners.append(box_corners(primitive.positions) @ self.scene.get_pose(node).T)
+        for key, poses in self.asset_poses.items():
+            node = self.asset_nodes[key]
+            for primitive in node.mesh.primitives:
+                local = box_corners(primitive.positions) @ self.scene.get_pose(node).T
+                corners.extend(local @ pose.T for pose in poses)
+        if len(corners) == 0:
+            return 0, 0, 0, 0
+
+        width, height = self.resolution
+        P = self.cam_node.camera.get_projection_matrix(width, height)
+        V = np.linalg.inv(self.scene.get_pose(self.cam_node))
+        clip = np.concatenate(corners) @ (P @ V).T
+        if np.any(clip[:, 3] <= 0):
+            return None
+
+        ndc = clip[:, :2] / clip[:, 3:]
+        x = (ndc[:, 0] + 1.) * 0.5 * width
+        y = (1. - ndc[:, 1]) * 0.5 * height
+        # one pixel of margin for rasterization
+        x0, x1 = np.clip([math.floor(x.min()) - 1, math.ceil(x.max()) + 1], 0, width)
+        y0, y1 = np.clip([math.floor(y.min()) - 1, math.ceil(y.max()) + 1], 0, height)
+        return int(x0), int(y0), int(x1), int(y1)
+
+    def scissor_region(self, bbox):
+        # round the region up to scissor_step pixels, so the framebuffer is not reallocated on every frame
+        width, height = self.resolution
+        x0, y0, x1, y1 = bbox
+        w = min(width, int(math.ceil(max(x1 - x0, 1) / self.scissor_step)) * self.scissor_step)
+        h = min(height, int(math.ceil(max(y1 - y0, 1) / self.scissor_step)) * self.scissor_step)
+        x0, y0 = min(x0, width - w), min(y0, height - h)
+        return x0, y0, x0 + w, y0 + h
+
+    @staticmethod
+    def composite(img, rgba, bbox=None, offset=(0, 0)):
+        '''
+        Copy the rendered pixels onto img in place.
+        :param rgba (ndarray, HxWx4): rendered region whose top left pixel is at `offset` (x, y) in img
+        :param bbox (tuple): only the pixels of img inside (x0, y0, x1, y1) are touched
+        '''
+        if bbox is None:
+            bbox = (offset[0], offset[1], offset[0] + rgba.shape[1], offset[1] + rgba.shape[0])
+        x0, y0, x1, y1 = bbox
+        if x1 <= x0 or y1 <= y0:
+            return
+        src = rgba[y0 - offset[1]:y1 - offset[1], x0 - offset[0]:x1 - offset[0]]
+        np.copyto(img[y0:y1, x0:x1], src[:, :, :3], where=src[:, :, 3:] > 0)
+
+    def pop_and_render(self, img = None, inplace=False):
+        '''
+        :param img (ndarray, HxWx3): uint8 frame, rendered onto a copy of it unless `inplace` is set
+            (read-only frames, e.g. FrameStore views, are always copied)
+        :return: rendered frame
+        '''
         # Render triangles or wireframe.
         if self.wireframe:
             render_flags = RenderFlags.RGBA | RenderFlags.ALL_WIREFRAME
@@ -226,25 +466,39 @@ class Renderer:
 
         # background will just be white
         if img is None:
-            img = self.whiteBackground
+            img, inplace = self.whiteBackground, False
+        image = img if inplace and img.flags.writeable else img.copy()
 
         # Combine current rendered scene with input image.
         # Allows multiple objects to be rendered by combining their resultant output.
-        rgb, _ = self.renderer.render(self.scene, flags=render_flags)
-        valid_mask = (rgb[:, :, -1] > 0)[:, :, np.newaxis]
-        output_img = rgb[:, :, :-1] * valid_mask + (1 - valid_mask) * img
-        image = output_img.astype(np.uint8)
+        self.upload_buffers()
+        bbox = self.projected_bbox()
+        width, height = self.resolution
+        if self.scissor and bbox is not None:
+            region = self.scissor_region(bbox)
+            camera = self.cam_node.camera
+            self.cam_node.camera = CroppedCamera(camera, region, width, height)
+            self.renderer.viewport_width, self.renderer.viewport_height = region[2] - region[0], region[3] - region[1]
+            rgba, _ = self.renderer.render(self.scene, flags=render_flags)
+            self.cam_node.camera = camera
+            self.composite(image, rgba, bbox, offset=region[:2])
+        else:
+            self.renderer.viewport_width, self.renderer.viewport_height = width, height
+            rgba, _ = self.renderer.render(self.scene, flags=render_flags)
+            self.composite(image, rgba, bbox)
 
-        # Remove nodes
-        self.scene.remove_node(self.cam_node)
-        for n in self.object_nodes:
-            self.scene.remove_node(n)
+        # Remove nodes, the persistent ones are only hidden
+        if self.cam_node is not self.weak_cam_node:
+            self.scene.remove_node(self.cam_node)
         for n in self.human_nodes:
             self.scene.remove_node(n)
+        for n in self.visible_tracks:
+            n.mesh.is_visible = False
         
         self.cam_node = None
-        self.object_nodes.clear()
+        self.asset_poses.clear()
         self.human_nodes.clear()
+        self.visible_tracks.clear()
 
         return image
     
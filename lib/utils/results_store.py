@@ -0,0 +1,152 @@
+# -*- coding: utf-8 -*-
+
+# Max-Planck-Gesellschaft zur Förderung der Wissenschaften e.V. (MPG) is
+# holder of all proprietary rights on this computer program.
+# You can only use this computer program if you have closed
+# a license agreement with MPG or you get the right to use the computer
+# program from someone who is authorized to grant you that right.
+# Any use of the computer program without a valid license is prohibited and
+# liable to prosecution.
+#
+# Copyright©2019 Max-Planck-Gesellschaft zur Förderung
+# der Wissenschaften e.V. (MPG). acting on behalf of its Max Planck Institute
+# for Intelligent Systems. All rights reserved.
+#
+# Contact: ps-license@tuebingen.mpg.de
+
+import h5py
+import numpy as np
+
+RESULTS_FORMAT_VERSION = 1
+VERTS_FORMATS = ['float32', 'float16', 'int16', 'none']
+
+
+def save_results(results_file, vibe_results, verts_format='float32', chunk_frames=64, compression=None, lod=None):
+    '''
+    Save the VIBE results to an HDF5 file with one group per person and one dataset per output, chunked
+    by frames so that a person or a frame range is read without loading the rest of the file.
+    :param results_file (str): output .h5 file
+    :param vibe_results (dict): person_id -> output dict of demo.py, outputs that are None (or dropped vertices)
+        are not stored, their names are kept in the none_keys attribute of the person
+    :param verts_format (str): 'float32', 'float16', 'int16' (offsets from the mean mesh of the person,
+        quantized with a per person scale) or 'none' to drop the vertices
+    :param chunk_frames (int): frames per HDF5 chunk
+    :param compression (str): HDF5 compression filter of the datasets, e.g. 'gzip' or 'lzf'
+    :param lod (MeshLOD): store the vertices of this decimated SMPL mesh (see lib.models.smpl_lod),
+        its faces are stored in the lod_faces dataset
+    '''
+    if verts_format not in VERTS_FORMATS:
+        raise ValueError(f'Unknown verts format \'{verts_format}\', expected one of {VERTS_FORMATS}')
+
+    with h5py.File(results_file, 'w') as f:
+        f.attrs['format_version'] = RESULTS_FORMAT_VERSION
+        f.attrs['verts_format'] = verts_format
+        f.attrs['lod'] = lod.num_verts if lod is not None else 0
+        if lod is not None and verts_format != 'none':
+            f.create_dataset('lod_faces', data=lod.faces.astype(np.int32))
+
+        for person_id, person in vibe_results.items():
+            group = f.create_group(str(person_id))
+            none_keys = [k for k, v in person.items() if v is None or (k == 'verts' and verts_format == 'none')]
+            if len(none_keys) > 0:
+                group.attrs['none_keys'] = np.array(none_keys, dtype='S')
+            for k, v in person.items():
+                if k in none_keys:
+                    continue
+                v = np.asarray(v)
+
+                if k == 'verts' and lod is not None:
+                    v = lod(v)
+                if k == 'verts' and verts_format == 'float16':
+                    v = v.astype(np.float16)
+                elif k == 'verts' and verts_format == 'int16':
+                    ref = v.mean(axis=0)
+                    scale = max(float(np.abs(v - ref).max()), 1e-8) / np.iinfo(np.int16).max
+                    group.create_dataset('verts_ref', data=ref.astype(np.float32))
+                    group.attrs['verts_scale'] = scale
+                    v = np.round((v - ref) / scale).astype(np.int16)
+
+                chunks = (min(chunk_frames, v.shape[0]),) + v.shape[1:] if v.ndim > 0 and v.shape[0] > 0 else None
+                group.create_dataset(k, data=v, chunks=chunks, compression=compression if chunks else None)
+
+    print(f'Saved VIBE results of {len(vibe_results)} persons to \"{results_file}\" (verts: {verts_format})')
+
+
+class ResultsReader():
+    """
+    Random access to the results written by save_results, by person and by frame range.
+    Only the requested rows of the requested outputs are read from the file.
+    """
+    def __init__(self, results_file):
+        self.file = h5py.File(results_file, 'r')
+        self.verts_format = self.file.attrs['verts_format']
+        self.lod = int(self.file.attrs.get('lod', 0))
+
+    def person_ids(self):
+        return sorted(int(k) for k in self.file.keys() if k.isdigit())
+
+    def faces(self):
+        '''
+        :return: faces of the stored vertices if they are a decimated SMPL mesh, None for the full SMPL mesh
+        '''
+        return self.file['lod_faces'][()] if 'lod_faces' in self.file else None
+
+    def keys(self, person_id):
+        # outputs that were None when saved are listed too, read returns None for them
+        group = self.file[str(person_id)]
+        none_keys = [k.decode() if isinstance(k, bytes) else k for k in group.attrs.get('none_keys', [])]
+        return [k for k in group.keys() if k != 'verts_ref'] + none_keys
+
+    def frame_ids(self, person_id):
+        return self.file[str(person_id)]['frame_ids'][()]
+
+    def rows(self, person_id, start_frame=None, end_frame=None):
+        # frame_ids of a person are sorted, [start_frame, end_frame) in video frames to a row slice
+        frame_ids = self.frame_ids(person_id)
+        start = 0 if start_frame is None else int(np.searchsorted(frame_ids, start_frame, side='left'))
+        end = len(frame_ids) if end_frame is None else int(np.searchsorted(frame_ids, end_frame, side='left'))
+        return slice(start, end)
+
+    def read(self, person_id, key, start_frame=None, end_frame=None):
+        '''
+        :param person_id (int): person id
+        :param key (str): output name, e.g. 'pose' or 'verts'
+        :param start_frame (int): first video frame, None for the first frame of the person
+        :param end_frame (int): end video frame (exclusive), None for the last frame of the person
+        :return: ndarray of the output over the frame range, None if it was not stored
+        '''
+        group = self.file[str(person_id)]
+        if key not in group:
+            return None
+
+        rows = self.rows(person_id, start_frame, end_frame)
+        v = group[key][rows]
+        if key == 'verts':
+            if self.verts_format == 'int16':
+                v = group['verts_ref'][()] + v.astype(np.float32) * np.float32(group.attrs['verts_scale'])
+            v = v.astype(np.float32)
+        return v
+
+    def read_person(self, person_id, start_frame=None, end_frame=None):
+        '''
+        :return: output dict of one person, as in vibe_output.pkl (outputs that were None are None)
+        '''
+        return {k: self.read(person_id, k, start_frame, end_frame) for k in self.keys(person_id)}
+
+    def close(self):
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def load_results(results_file):
+    '''
+    Load all persons of a results file, see save_results.
+    :return: person_id -> output dict, as in vibe_output.pkl
+    '''
+    with ResultsReader(results_file) as reader:
+        return {person_id: reader.read_person(person_id) for person_id in reader.person_ids()}
@@ -0,0 +1,114 @@
+# -*- coding: utf-8 -*-
+
+# Max-Planck-Gesellschaft zur Förderung der Wissenschaften e.V. (MPG) is
+# holder of all proprietary rights on this computer program.
+# You can only use this computer program if you have closed
+# a license agreement with MPG or you get the right to use the computer
+# program from someone who is authorized to grant you that right.
+# Any use of the computer program without a valid license is prohibited and
+# liable to prosecution.
+#
+# Copyright©2019 Max-Planck-Gesellschaft zur Förderung
+# der Wissenschaften e.V. (MPG). acting on behalf of its Max Planck Institute
+# for Intelligent Systems. All rights reserved.
+#
+# Contact: ps-license@tuebingen.mpg.de
+
+
+import cv2
+import numpy as np
+
+from lib.models.smpl import get_smpl_faces
+from lib.models.smpl_lod import get_smpl_lod
+from lib.data_utils.kp_utils import get_spin_skeleton
+
+
+class SkeletonRenderer:
+    """
+    QA overlay without OpenGL, a drop-in for Renderer in the demo render loop.
+
+    Instead of shading the mesh, the 3D joints (mode 'skeleton', the SPIN
+    skeleton of the 49 VIBE joints) or a decimated set of mesh edges (mode
+    'mesh', every `edge_step`-th unique edge of the SMPL faces) are projected
+    with the weak perspective camera of the person and drawn with a single
+    cv2.polylines call. Attached objects are drawn as a dot at their origin.
+    With `lod` the mesh edges are taken from that decimated SMPL mesh.
+    """
+    def __init__(self, resolution=(224,224), mode='skeleton', edge_step=4, thickness=2, lod=None, **kwargs):
+        if mode not in ('skeleton', 'mesh'):
+            raise ValueError(f'Unknown skeleton renderer mode \'{mode}\'')
+
+        self.resolution = resolution
+        self.mode = mode
+        self.thickness = thickness
+        self.lod = get_smpl_lod(lod) if lod is not None else None
+        self.faces = self.lod.faces if self.lod is not None else get_smpl_faces()
+        self.skeleton = get_spin_skeleton()
+
+        edges = np.sort(self.faces[:, [0, 1, 1, 2, 2, 0]].reshape(-1, 2), axis=1)
+        self.edges = np.unique(edges, axis=0)[::edge_step]
+
+        self.cam = None
+        self.lines = []
+        self.points = []
+
+    def push_weak_cam(self, cam):
+        self.cam = np.asarray(cam, dtype=np.float64)
+
+    def project(self, points):
+        # same projection as the WeakPerspectiveCamera of Renderer, including its flip around the x axis
+        sx, sy, tx, ty = self.cam
+        width, height = self.resolution
+        u = (sx * (points[:, 0] + tx) + 1.) * 0.5 * width
+        v = (sy * (points[:, 1] + ty) + 1.) * 0.5 * height
+        return np.stack([u, v], axis=1)
+
+    def push_human(self, verts=None, color=[1.0, 1.0, 0.9], translation=[0.0, 0.0, 0.0], track_id=None, joints3d=None):
+        '''
+        :param verts (ndarray, 6890x3): SMPL vertices, used in mode 'mesh'
+        :param joints3d (ndarray, 49x3): VIBE joints, used in mode 'skeleton'
+        '''
+        if self.mode == 'skeleton':
+            if joints3d is None:
+                raise ValueError('The skeleton mode needs the 3D joints')
+            points, edges = joints3d, self.skeleton
+        else:
+            points, edges = self.lod_verts(verts), self.edges
+
+        # Renderer translates after flipping y and z
+        translation = np.array([translation[0], -translation[1], 0.])
+        pts = self.project(np.asarray(points)[:, :3] + translation)
+        self.lines.append((np.round(pts[edges]).astype(np.int32), color))
+
+    def lod_verts(self, verts):
+        if self.lod is None or len(verts) == self.lod.num_verts:
+            return verts
+        return self.lod(np.asarray(verts))
+
+    def push_obj(self, mesh_file, translation=[0.0, 0.0, 0.0], color=[0.3, 1.0, 0.3], **kwargs):
+        # objects are placed in the flipped renderer space, flip them back before projecting
+        point = np.array([[translation[0], -translation[1], -translation[2]]])
+        self.points.append((np.round(self.project(point)[0]).astype(int), color))
+
+    def remove_track(self, track_id):
+        pass
+
+    def pop_and_render(self, img = None, inplace=False):
+        '''
+        :param img (ndarray, HxWx3): uint8 frame, drawn onto a copy of it unless `inplace` is set
+        :return: rendered frame
+        '''
+        if img is None:
+            img = np.full((self.resolution[1], self.resolution[0], 3), 255, dtype=np.uint8)
+        elif not inplace or not img.flags.writeable:
+            img = img.copy()
+
+        for lines, color in self.lines:
+            cv2.polylines(img, lines, False, tuple(float(c) * 255 for c in color), self.thickness, cv2.LINE_AA)
+        for point, color in self.points:
+            cv2.circle(img, (int(point[0]), int(point[1])), 3 * self.thickness, tuple(float(c) * 255 for c in color), -1)
+
+        self.cam = None
+        self.lines.clear()
+        self.points.clear()
+        return img
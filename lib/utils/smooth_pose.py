@@ -14,55 +14,205 @@
 #
 # Contact: ps-license@tuebingen.mpg.de
 
+import math
 import torch
 import numpy as np
+from scipy.ndimage import gaussian_filter1d
+from scipy.signal import savgol_filter
 
 from lib.models.smpl import SMPL, SMPL_MODEL_DIR
-from lib.utils.one_euro_filter import OneEuroFilter
+from lib.utils.geometry import batch_rodrigues, rot6d_to_rotmat, rotation_matrix_to_angle_axis, \
+    rotation_matrix_to_quaternion, quaternion_to_angle_axis
 
+# one_euro is the causal OneEuroFilter on the axis-angle values, the others are zero-phase
+# filters in rotation space, see smooth_rotations
+SMOOTH_METHODS = ['one_euro', 'gaussian', 'savgol']
 
-def smooth_pose(pred_pose, pred_betas, min_cutoff=0.004, beta=0.7):
-    # min_cutoff: Decreasing the minimum cutoff frequency decreases slow speed jitter
-    # beta: Increasing the speed coefficient(beta) decreases speed lag.
+# SMPL models of smooth_poses, one per device
+_smpl_models = {}
 
-    one_euro_filter = OneEuroFilter(
-        np.zeros_like(pred_pose[0]),
-        pred_pose[0],
-        min_cutoff=min_cutoff,
-        beta=beta,
-    )
 
-    smpl = SMPL(model_path=SMPL_MODEL_DIR)
+def get_smpl(device):
+    if device not in _smpl_models:
+        _smpl_models[device] = SMPL(model_path=SMPL_MODEL_DIR, create_transl=False).to(device).eval()
+    return _smpl_models[device]
 
-    pred_pose_hat = np.zeros_like(pred_pose)
 
-    # initialize
-    pred_pose_hat[0] = pred_pose[0]
+def one_euro_filter(x, min_cutoff=0.004, beta=0.7, d_cutoff=1.0):
+    '''
+    OneEuroFilter (see lib.utils.one_euro_filter) over whole sequences with one sample per time step.
+    The recursion runs over the first axis, every step filters all other axes at once.
+    :param x (ndarray, Tx...): signal, e.g. TxPx72 poses of P persons
+    :return: filtered signal, x_hat[0] == x[0]
+    '''
+    def smoothing_factor(cutoff):
+        r = 2 * math.pi * cutoff
+        return r / (r + 1)
 
-    pred_verts_hat = []
-    pred_joints3d_hat = []
+    a_d = smoothing_factor(d_cutoff)
+    x_hat = np.empty_like(x)
+    x_hat[0] = x[0]
+    dx_hat = np.zeros_like(x[0])
+    for t in range(1, x.shape[0]):
+        dx_hat = a_d * (x[t] - x_hat[t - 1]) + (1 - a_d) * dx_hat
+        a = smoothing_factor(min_cutoff + beta * np.abs(dx_hat))
+        x_hat[t] = a * x[t] + (1 - a) * x_hat[t - 1]
+    return x_hat
 
-    smpl_output = smpl(
-        betas=torch.from_numpy(pred_betas[0]).unsqueeze(0),
-        body_pose=torch.from_numpy(pred_pose[0, 1:]).unsqueeze(0),
-        global_orient=torch.from_numpy(pred_pose[0, 0:1]).unsqueeze(0),
-    )
-    pred_verts_hat.append(smpl_output.vertices.detach().cpu().numpy())
-    pred_joints3d_hat.append(smpl_output.joints.detach().cpu().numpy())
 
-    for idx, pose in enumerate(pred_pose[1:]):
-        idx += 1
+def axis_angle_to_rotation(pose, rotation='6d'):
+    '''
+    :param pose (torch.Tensor, Nx72): SMPL poses
+    :param rotation (str): '6d' (first two columns of the rotation matrix) or 'quat' (w, x, y, z)
+    :return: Nx24x6 or Nx24x4 rotations
+    '''
+    rotmat = batch_rodrigues(pose.reshape(-1, 3)).reshape(-1, 3, 3)
+    if rotation == '6d':
+        return rotmat[:, :, :2].reshape(pose.shape[0], 24, 6)
+    if rotation == 'quat':
+        rotmat = torch.cat([rotmat, rotmat.new_zeros(rotmat.shape[0], 3, 1)], dim=-1)
+        return rotation_matrix_to_quaternion(rotmat).reshape(pose.shape[0], 24, 4)
+    raise ValueError(f'Unknown rotation representation \'{rotation}\'')
+
+
+def rotation_to_axis_angle(rot, rotation='6d'):
+    '''
+    Inverse of axis_angle_to_rotation, the filtered rotations are projected back onto SO(3)
+    (Gram-Schmidt for 6D, normalization for quaternions).
+    :param rot (torch.Tensor, Nx24x6 or Nx24x4): rotations
+    :return: Nx72 SMPL poses
+    '''
+    if rotation == '6d':
+        aa = rotation_matrix_to_angle_axis(rot6d_to_rotmat(rot.reshape(-1, 6)))
+    else:
+        aa = quaternion_to_angle_axis(rot.reshape(-1, 4) / rot.reshape(-1, 4).norm(dim=-1, keepdim=True))
+    return aa.reshape(rot.shape[0], 72)
+
+
+def smooth_rotations(pred_poses, method='gaussian', rotation='6d', sigma=2.0, window=9, polyorder=2):
+    '''
+    Offline zero-phase smoothing of the poses of several persons in rotation space.
+    The axis-angle poses of all frames of all persons are converted at once, the rotations are filtered with a
+    symmetric kernel along the time axis of the (frames, persons * 24, dims) array, edge padded to the longest
+    person, and converted back. Unlike one_euro_filter the result neither lags behind nor depends on the
+    sign flips and 2pi wraps of axis-angle.
+    :param pred_poses (list): SMPL pose (ndarray, Nx72) of every person
+    :param method (str): 'gaussian' or 'savgol' (Savitzky-Golay)
+    :param rotation (str): '6d' or 'quat', see axis_angle_to_rotation
+    :param sigma (float): standard deviation of the gaussian kernel in frames
+    :param window (int): window length of the Savitzky-Golay filter in frames, odd
+    :param polyorder (int): polynomial order of the Savitzky-Golay filter
+    :return: list of smoothed poses (ndarray, Nx72)
+    '''
+    lengths = [len(pose) for pose in pred_poses]
+    offsets = np.cumsum([0] + lengths)
+    all_poses = torch.from_numpy(np.concatenate(pred_poses).astype(np.float32))
+    rot = axis_angle_to_rotation(all_poses, rotation).numpy()
+
+    padded = np.empty((max(lengths), len(lengths), 24, rot.shape[-1]), dtype=np.float32)
+    for i, (start, end) in enumerate(zip(offsets[:-1], offsets[1:])):
+        person_rot = rot[start:end]
+        if rotation == 'quat' and len(person_rot) > 1:
+            # q and -q are the same rotation, keep every quaternion in the hemisphere of the previous frame
+            flip = np.sum(person_rot[1:] * person_rot[:-1], axis=-1) < 0
+            sign = np.cumprod(np.where(flip, -1., 1.), axis=0)
+            person_rot = person_rot * np.concatenate([np.ones_like(sign[:1]), sign])[..., None]
+        padded[:lengths[i], i] = person_rot
+        padded[lengths[i]:, i] = person_rot[-1]
+
+    # edge padding equals the 'nearest' boundary mode of every shorter person
+    if method == 'gaussian':
+        padded = gaussian_filter1d(padded, sigma, axis=0, mode='nearest')
+    elif method == 'savgol':
+        window = min(window, padded.shape[0] - (1 - padded.shape[0] % 2))
+        if window > polyorder:
+            padded = savgol_filter(padded, window, polyorder, axis=0, mode='nearest')
+    else:
+        raise ValueError(f'Unknown smoothing method \'{method}\'')
 
-        t = np.ones_like(pose) * idx
-        pose = one_euro_filter(t, pose)
-        pred_pose_hat[idx] = pose
+    rot = torch.from_numpy(np.concatenate([padded[:length, i] for i, length in enumerate(lengths)]))
+    all_poses = rotation_to_axis_angle(rot, rotation).numpy()
+    return [all_poses[start:end] for start, end in zip(offsets[:-1], offsets[1:])]
 
-        smpl_output = smpl(
-            betas=torch.from_numpy(pred_betas[idx]).unsqueeze(0),
-            body_pose=torch.from_numpy(pred_pose_hat[idx, 1:]).unsqueeze(0),
-            global_orient=torch.from_numpy(pred_pose_hat[idx, 0:1]).unsqueeze(0),
-        )
-        pred_verts_hat.append(smpl_output.vertices.detach().cpu().numpy())
-        pred_joints3d_hat.append(smpl_output.joints.detach().cpu().numpy())
 
-    return np.vstack(pred_verts_hat), pred_pose_hat, np.vstack(pred_joints3d_hat)
\ No newline at end of file
+@torch.no_grad()
+def smooth_poses(pred_poses, pred_betas, min_cutoff=0.004, beta=0.7, device=torch.device('cpu'), chunk_size=1024,
+                 return_verts=True, method='one_euro', **filter_kwargs):
+    '''
+    Smooth the poses of several persons at once and rebuild their meshes.
+    The poses are filtered in one pass over the padded (frames, persons, 72) array, SMPL runs over the
+    frames of all persons in chunks of chunk_size.
+    :param pred_poses (list): SMPL pose (ndarray, Nx72) of every person
+    :param pred_betas (list): SMPL shape (ndarray, Nx10) of every person
+    :param return_verts (bool): rebuild the vertices, else only the joints and the vertices are None
+    :param method (str): one of SMOOTH_METHODS, min_cutoff and beta apply to one_euro,
+        filter_kwargs (rotation, sigma, window, polyorder) to the others, see smooth_rotations
+    :return: list of (vertices (Nx6890x3), smoothed pose (Nx72), joints (Nx49x3)) per person
+    '''
+    lengths = [len(pose) for pose in pred_poses]
+    if len(lengths) == 0:
+        return []
+
+    if method == 'one_euro':
+        padded = np.zeros((max(lengths), len(lengths), 72), dtype=np.float32)
+        for i, pose in enumerate(pred_poses):
+            padded[:lengths[i], i] = pose
+        padded = one_euro_filter(padded, min_cutoff=min_cutoff, beta=beta)
+        poses = [padded[:length, i] for i, length in enumerate(lengths)]
+    else:
+        poses = smooth_rotations(pred_poses, method=method, **filter_kwargs)
+
+    smpl = get_smpl(device)
+    all_poses = torch.from_numpy(np.concatenate(poses)).to(device)
+    all_betas = torch.from_numpy(np.concatenate(pred_betas).astype(np.float32)).to(device)
+    verts, joints3d = [], []
+    for start in range(0, all_poses.shape[0], chunk_size):
+        pose, betas = all_poses[start:start + chunk_size], all_betas[start:start + chunk_size]
+        if return_verts:
+            smpl_output = smpl(betas=betas, body_pose=pose[:, 3:], global_orient=pose[:, :3])
+            verts.append(smpl_output.vertices.cpu().numpy())
+            joints3d.append(smpl_output.joints.cpu().numpy())
+        else:
+            joints3d.append(smpl.get_joints(betas=betas, body_pose=pose[:, 3:], global_orient=pose[:, :3]).cpu().numpy())
+
+    offsets = np.cumsum([0] + lengths)
+    joints3d = np.concatenate(joints3d)
+    verts = np.concatenate(verts) if return_verts else None
+    return [
+        (verts[start:end] if verts is not None else None, pose, joints3d[start:end])
+        for start, end, pose in zip(offsets[:-1], offsets[1:], poses)
+    ]
+
+
+def smooth_pose(pred_pose, pred_betas, min_cutoff=0.004, beta=0.7):
+    # min_cutoff: Decreasing the minimum cutoff frequency decreases slow speed jitter
+    # beta: Increasing the speed coefficient(beta) decreases speed lag.
+    return smooth_poses([pred_pose], [pred_betas], min_cutoff=min_cutoff, beta=beta)[0]
+
+
+def smooth_vibe_results(vibe_results, min_cutoff=0.004, beta=0.7, device=torch.device('cpu'), method='one_euro',
+                        **filter_kwargs):
+    '''
+    Smooth the poses of all persons of the demo output in place, the vertices and joints that were
+    computed are replaced by the ones of the smoothed poses.
+    :param vibe_results (dict): person_id -> output dict of demo.py
+    :param method (str): one of SMOOTH_METHODS, see smooth_poses
+    '''
+    person_ids = list(vibe_results.keys())
+    smoothed = smooth_poses(
+        [vibe_results[person_id]['pose'] for person_id in person_ids],
+        [vibe_results[person_id]['betas'] for person_id in person_ids],
+        min_cutoff=min_cutoff,
+        beta=beta,
+        device=device,
+        return_verts=any(vibe_results[person_id].get('verts') is not None for person_id in person_ids),
+        method=method,
+        **filter_kwargs,
+    )
+    for person_id, (verts, pose, joints3d) in zip(person_ids, smoothed):
+        person = vibe_results[person_id]
+        person['pose'] = pose
+        if person.get('verts') is not None:
+            person['verts'] = verts
+        if person.get('joints3d') is not None:
+            person['joints3d'] = joints3d
@@ -0,0 +1,109 @@
+# -*- coding: utf-8 -*-
+
+# Max-Planck-Gesellschaft zur Förderung der Wissenschaften e.V. (MPG) is
+# holder of all proprietary rights on this computer program.
+# You can only use this computer program if you have closed
+# a license agreement with MPG or you get the right to use the computer
+# program from someone who is authorized to grant you that right.
+# Any use of the computer program without a valid license is prohibited and
+# liable to prosecution.
+#
+# Copyright©2019 Max-Planck-Gesellschaft zur Förderung
+# der Wissenschaften e.V. (MPG). acting on behalf of its Max Planck Institute
+# for Intelligent Systems. All rights reserved.
+#
+# Contact: ps-license@tuebingen.mpg.de
+
+
+import cv2
+import shutil
+import subprocess
+import numpy as np
+
+
+class VideoWriter():
+    """
+    Encodes frames to a video file as they are produced.
+
+    BGR uint8 frames are piped as raw video to the stdin of an ffmpeg
+    process, nothing is written to disk but the video. Without an ffmpeg
+    binary the frames are encoded in process with cv2.VideoWriter (mp4v),
+    the codec options are ignored then.
+    """
+    def __init__(self, output_vid_file, img_shape, fps=None, codec='libx264', crf=23, preset='veryfast', threads=0):
+        '''
+        :param img_shape (tuple): (height, width, 3) of the frames
+        :param fps (float): frame rate, defaults to 25 (the frame rate images_to_video used)
+        :param codec (str): ffmpeg video encoder
+        :param crf (int): constant rate factor of the x264/x265/vp9 encoders, lower is better quality
+        :param preset (str): encoder speed preset of x264/x265
+        :param threads (int): encoder threads, 0 lets ffmpeg decide
+        '''
+        self.output_vid_file = output_vid_file
+        self.height, self.width = img_shape[:2]
+        self.fps = fps if fps else 25.
+        self.num_frames = 0
+        self.process = None
+        self.writer = None
+
+        if shutil.which('ffmpeg') is not None:
+            command = [
+                'ffmpeg', '-y', '-v', 'error',
+                '-f', 'rawvideo', '-pix_fmt', 'bgr24', '-s', f'{self.width}x{self.height}', '-r', f'{self.fps}',
+                '-i', '-', '-an',
+                # yuv420p needs even dimensions
+                '-vf', 'pad=ceil(iw/2)*2:ceil(ih/2)*2',
+                '-c:v', codec, '-pix_fmt', 'yuv420p', '-threads', str(threads),
+            ]
+            if codec in ('libx264', 'libx265', 'libvpx-vp9'):
+                command += ['-crf', str(crf)]
+            if codec in ('libx264', 'libx265'):
+                command += ['-preset', preset]
+            command.append(output_vid_file)
+
+            print(f'Running \"{" ".join(command)}\"')
+            self.process = subprocess.Popen(command, stdin=subprocess.PIPE)
+        else:
+            print('ffmpeg was not found, encoding the video with OpenCV')
+            self.writer = cv2.VideoWriter(
+                output_vid_file, cv2.VideoWriter_fourcc(*'mp4v'), self.fps, (self.width, self.height)
+            )
+            if not self.writer.isOpened():
+                raise RuntimeError(f'Could not open \"{output_vid_file}\" for writing')
+
+    def write(self, img):
+        '''
+        :param img (ndarray, HxWx3): BGR uint8 frame
+        '''
+        if img.shape[:2] != (self.height, self.width):
+            raise ValueError(f'Frame of shape {img.shape} does not match the video size {self.width}x{self.height}')
+
+        img = np.ascontiguousarray(img, dtype=np.uint8)
+        if self.process is not None:
+            try:
+                self.process.stdin.write(img.data)
+            except BrokenPipeError:
+                raise RuntimeError(f'ffmpeg stopped while encoding \"{self.output_vid_file}\"')
+        else:
+            self.writer.write(img)
+        self.num_frames += 1
+
+    def close(self):
+        if self.process is not None:
+            self.process.stdin.close()
+            if self.process.wait() != 0:
+                raise RuntimeError(f'ffmpeg failed to encode \"{self.output_vid_file}\"')
+            self.process = None
+        if self.writer is not None:
+            self.writer.release()
+            self.writer = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is not None and self.process is not None:
+            # keep the original error, do not wait on a partially written video
+            self.process.kill()
+            self.process = None
+        self.close()
@@ -0,0 +1,61 @@
+import sys
+sys.path.append('.')
+
+import cv2
+import shutil
+import tempfile
+import subprocess
+import numpy as np
+import os.path as osp
+
+from lib.utils.frame_source import VideoFrameSource
+
+NUM_FRAMES = 250
+
+
+def make_video(vid_file, num_frames=NUM_FRAMES, width=64, height=48):
+    # the bits of the frame index as black and white stripes, long-GOP variable frame rate H.264 with B-frames
+    # when ffmpeg is available (seeking with CAP_PROP_POS_FRAMES is inexact on those)
+    frames = [np.zeros((height, width, 3), dtype=np.uint8) for _ in range(num_frames)]
+    for i, img in enumerate(frames):
+        for bit in range(8):
+            img[:, bit * 8:(bit + 1) * 8] = 255 if (i >> bit) & 1 else 0
+
+    if shutil.which('ffmpeg') is not None:
+        process = subprocess.Popen([
+            'ffmpeg', '-y', '-loglevel', 'error', '-f', 'rawvideo', '-pix_fmt', 'bgr24', '-s', f'{width}x{height}',
+            '-r', '25', '-i', '-', '-vf', "setpts='(N+0.45*mod(N*N,3))/25/TB'", '-vsync', '0',
+            '-c:v', 'libx264', '-g', '120', '-bf', '3', '-pix_fmt', 'yuv420p', '-crf', '10', vid_file,
+        ], stdin=subprocess.PIPE)
+        for img in frames:
+            process.stdin.write(img.tobytes())
+        process.stdin.close()
+        process.wait()
+    else:
+        writer = cv2.VideoWriter(vid_file, cv2.VideoWriter_fourcc(*'mp4v'), 25, (width, height))
+        for img in frames:
+            writer.write(img)
+        writer.release()
+
+
+def test_random_access():
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        vid_file = osp.join(tmp_dir, 'video.mp4')
+        make_video(vid_file)
+
+        source = VideoFrameSource(vid_file)
+        sequential = list(source)
+        assert len(sequential) == len(source) > 0
+
+        # backward and forward jumps, and contiguous runs of a few frames as read by the crop workers
+        rng = np.random.default_rng(0)
+        indices = []
+        for start in rng.integers(0, len(sequential), 40):
+            indices.extend(range(start, min(start + int(rng.integers(1, 6)), len(sequential))))
+        for idx in indices:
+            assert np.array_equal(source[idx], sequential[idx]), f'frame {idx}'
+        assert len(source._decoders) <= source.max_decoders
+        source.release()
+    finally:
+        shutil.rmtree(tmp_dir)
@@ -0,0 +1,21 @@
+import sys
+sys.path.append('.')
+
+import numpy as np
+
+from lib.data_utils.img_utils import gen_trans_from_patch_cv, gen_trans_from_patch_cv_batch
+
+
+def test_gen_trans_from_patch_cv_batch():
+    rng = np.random.default_rng(0)
+    n = 16
+    c_x, c_y = rng.uniform(0, 1920, n), rng.uniform(0, 1080, n)
+    width, height = rng.uniform(50, 500, n), rng.uniform(50, 500, n)
+    rot = rng.uniform(-30, 30, n)
+
+    for inv in [False, True]:
+        batch = gen_trans_from_patch_cv_batch(c_x, c_y, width, height, 224, 224, 1.1, rot, inv=inv)
+        assert batch.shape == (n, 2, 3)
+        for i in range(n):
+            expected = gen_trans_from_patch_cv(c_x[i], c_y[i], width[i], height[i], 224, 224, 1.1, rot[i], inv=inv)
+            assert np.allclose(batch[i], expected, rtol=1e-4, atol=1e-3)
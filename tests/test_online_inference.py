@@ -0,0 +1,53 @@
+import sys
+sys.path.append('.')
+
+import torch
+import numpy as np
+from torch import nn
+from types import SimpleNamespace
+
+from lib.core.online_inference import OnlineInference
+
+
+class TinySMPL():
+    def __call__(self, betas, body_pose, global_orient):
+        pose = torch.cat([global_orient, body_pose], dim=1)
+        return SimpleNamespace(vertices=pose[:, :, None].expand(-1, -1, 3), joints=pose[:, :49, None].expand(-1, -1, 3))
+
+
+class TinyRegressor():
+    # the pose of a frame is the mean of its crop
+    smpl = TinySMPL()
+
+    def __call__(self, feature):
+        pose = feature.expand(-1, 72)
+        theta = torch.cat([torch.ones(len(feature), 3), pose, torch.zeros(len(feature), 10)], dim=1)
+        return [{'theta': theta, 'verts': self.smpl(None, pose[:, 3:], pose[:, :3]).vertices, 'kp_3d': pose[:, :49]}]
+
+
+class TinyModel(nn.Module):
+    raw_input = False
+
+    def __init__(self):
+        super().__init__()
+        self.encoder = nn.Module()
+        self.encoder.gru = nn.GRU(1, 1)
+        self.regressor = TinyRegressor()
+
+    def extract_features(self, input):
+        return input.mean(dim=(1, 2, 3))[:, None]
+
+    def encode(self, feature, lengths, hidden=None, return_hidden=False):
+        return feature[:, 0], hidden
+
+
+def test_repeated_frame_idx():
+    engine = OnlineInference(TinyModel(), torch.device('cpu'), crop_size=32)
+    rng = np.random.default_rng(0)
+    bboxes = [[30., 30., 20., 20.]]
+
+    for frame_idx in [0, 1, 1, 0, 2]:
+        frame = rng.integers(0, 255, (64, 64, 3), dtype=np.uint8)
+        with np.errstate(all='raise'):
+            output = engine(frame, bboxes, [7], frame_idx=frame_idx)
+        assert np.all(np.isfinite(output[7]['pose']))
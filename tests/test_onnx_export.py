@@ -0,0 +1,137 @@
+import sys
+sys.path.append('.')
+import torch
+import pytest
+import numpy as np
+import shutil
+import tempfile
+import os.path as osp
+from torch.nn.utils.rnn import pad_sequence
+
+from lib.core.config import VIBE_DATA_DIR
+
+MODEL_BUNDLE = None
+LENGTHS = [16, 9, 16]
+TOLERANCE = 1e-3
+
+# SMPL and the VIBE checkpoint (or a model bundle), they are not part of the repository
+DATA_FILES = [
+    osp.join(VIBE_DATA_DIR, 'SMPL_NEUTRAL.pkl'),
+    osp.join(VIBE_DATA_DIR, 'J_regressor_extra.npy'),
+    osp.join(VIBE_DATA_DIR, 'smpl_mean_params.npz'),
+    MODEL_BUNDLE if MODEL_BUNDLE is not None else osp.join(VIBE_DATA_DIR, 'vibe_model_wo_3dpw.pth.tar'),
+]
+
+
+def missing_data_files():
+    return [f for f in DATA_FILES if not osp.isfile(f)]
+
+
+def run(m, crops, hidden=None):
+    feature = m.extract_features(crops)
+    feature = pad_sequence(torch.split(feature, LENGTHS), batch_first=True)
+    feature, hidden = m.encode(feature, LENGTHS, hidden=hidden, return_hidden=True)
+    return m.regressor(feature)[-1], hidden
+
+
+def test_onnx_export():
+    missing = missing_data_files()
+    if len(missing) > 0:
+        pytest.skip(f'VIBE data files are missing: {missing}')
+    pytest.importorskip('onnxruntime')
+
+    from lib.utils.demo_utils import get_demo_model
+    from lib.models.onnx_backend import export_vibe_demo, OnnxVIBE_Demo
+
+    torch.manual_seed(0)
+    model = get_demo_model(torch.device('cpu'), bundle_file=MODEL_BUNDLE)
+
+    onnx_dir = tempfile.mkdtemp()
+    try:
+        export_vibe_demo(model, onnx_dir)
+        onnx_model = OnnxVIBE_Demo(onnx_dir)
+
+        crops = torch.randn(sum(LENGTHS), 3, 224, 224)
+        with torch.no_grad():
+            # the second chunk continues from the GRU state of the first one
+            torch_pred, torch_hidden = run(model, crops)
+            torch_pred_2, _ = run(model, crops, torch_hidden)
+            onnx_pred, onnx_hidden = run(onnx_model, crops)
+            onnx_pred_2, _ = run(onnx_model, crops, onnx_hidden)
+    finally:
+        shutil.rmtree(onnx_dir)
+
+    failed = False
+    for chunk, (a, b) in enumerate([(torch_pred, onnx_pred), (torch_pred_2, onnx_pred_2)]):
+        for k in ['theta', 'verts', 'kp_3d']:
+            error = (a[k] - b[k]).abs().max().item()
+            print(f'chunk {chunk} {k}: {tuple(b[k].shape)} max abs error {error:.2e}')
+            failed = failed or error > TOLERANCE
+
+    assert not failed, f'ONNX outputs differ from PyTorch by more than {TOLERANCE}'
+    print('ONNX export matches PyTorch')
+
+
+def synthetic_smpl(seed=0):
+    # random SMPL with the real vertex count, the extra joints are read from fixed SMPL vertex ids
+    from smplx.utils import Struct
+    from lib.models.smpl import SMPL
+
+    rng = np.random.default_rng(seed)
+    num_verts = 6890
+    parents = [0, 0, 0, 0, 1, 2, 3, 4, 5, 6, 7, 8, 9, 9, 9, 12, 13, 14, 16, 17, 18, 19, 20, 21]
+    weights = rng.uniform(size=(num_verts, 24))
+    J_regressor = rng.uniform(size=(24, num_verts))
+    data = Struct(
+        v_template=rng.standard_normal((num_verts, 3)) * 0.3,
+        shapedirs=rng.standard_normal((num_verts, 3, 10)) * 0.01,
+        posedirs=rng.standard_normal((num_verts, 3, 207)) * 0.01,
+        J_regressor=J_regressor / J_regressor.sum(axis=1, keepdims=True),
+        weights=weights / weights.sum(axis=1, keepdims=True),
+        kintree_table=np.array([parents, list(range(24))]),
+        f=rng.integers(0, num_verts, (100, 3)),
+    )
+    return SMPL('', data_struct=data, batch_size=1, create_transl=False,
+                J_regressor_extra=rng.uniform(size=(9, num_verts)) / num_verts)
+
+
+def test_regressor_dynamic_batch():
+    # the regressor graph is traced at batch 2, it has to run at any batch size
+    ort = pytest.importorskip('onnxruntime')
+
+    from lib.models.spin import Regressor
+    from lib.models.onnx_backend import RegressorGraph, export_graph
+
+    torch.manual_seed(0)
+    graph = RegressorGraph(Regressor(smpl_mean_params=None, smpl=synthetic_smpl())).eval()
+    names = ['theta', 'verts', 'kp_3d', 'kp_2d']
+
+    onnx_dir = tempfile.mkdtemp()
+    try:
+        export_graph(
+            graph,
+            (torch.zeros(2, 2048),),
+            osp.join(onnx_dir, 'regressor.onnx'),
+            input_names=['feature'],
+            output_names=names,
+            dynamic_axes={k: {0: 'batch'} for k in ['feature'] + names},
+            opset_version=17,
+        )
+        session = ort.InferenceSession(osp.join(onnx_dir, 'regressor.onnx'), providers=['CPUExecutionProvider'])
+
+        for batch_size in [1, 2, 37]:
+            feature = torch.randn(batch_size, 2048)
+            with torch.no_grad():
+                torch_pred = graph(feature)
+            onnx_pred = session.run(None, {'feature': feature.numpy()})
+            for name, a, b in zip(names, torch_pred, onnx_pred):
+                assert b.shape == tuple(a.shape), f'{name} at batch {batch_size}'
+                assert np.abs(a.numpy() - b).max() < TOLERANCE, f'{name} at batch {batch_size}'
+    finally:
+        shutil.rmtree(onnx_dir)
+
+
+if __name__ == '__main__':
+    if len(missing_data_files()) > 0:
+        sys.exit(f'Skipped, VIBE data files are missing: {missing_data_files()}')
+    test_onnx_export()
@@ -0,0 +1,51 @@
+import sys
+sys.path.append('.')
+
+import os
+import tempfile
+import numpy as np
+
+from lib.utils.results_store import save_results, load_results, ResultsReader
+
+
+def make_results(num_frames=20, seed=0):
+    rng = np.random.default_rng(seed)
+    return {
+        1: {
+            'pose': rng.standard_normal((num_frames, 72)).astype(np.float32),
+            'verts': rng.uniform(-1, 1, (num_frames, 100, 3)).astype(np.float32),
+            'joints3d': None,
+            'frame_ids': np.arange(5, 5 + num_frames),
+        },
+    }
+
+
+def test_int16_round_trip():
+    results = make_results()
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        results_file = os.path.join(tmp_dir, 'vibe_output.h5')
+        save_results(results_file, results, verts_format='int16')
+        loaded = load_results(results_file)
+
+        verts = results[1]['verts']
+        scale = np.abs(verts - verts.mean(axis=0)).max() / np.iinfo(np.int16).max
+        assert loaded[1]['verts'].dtype == np.float32
+        assert np.abs(loaded[1]['verts'] - verts).max() <= scale
+        assert np.array_equal(loaded[1]['pose'], results[1]['pose'])
+
+        with ResultsReader(results_file) as reader:
+            rows = reader.read(1, 'verts', start_frame=10, end_frame=15)
+            assert np.allclose(rows, loaded[1]['verts'][5:10])
+
+
+def test_none_outputs_are_restored():
+    results = make_results()
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        results_file = os.path.join(tmp_dir, 'vibe_output.h5')
+        save_results(results_file, results)
+        loaded = load_results(results_file)
+        assert set(loaded[1].keys()) == set(results[1].keys())
+        assert loaded[1]['joints3d'] is None
+
+        save_results(results_file, results, verts_format='none')
+        assert load_results(results_file)[1]['verts'] is None
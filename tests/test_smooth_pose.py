@@ -0,0 +1,52 @@
+import sys
+sys.path.append('.')
+
+import torch
+import numpy as np
+
+from lib.utils.geometry import batch_rodrigues
+from lib.utils.one_euro_filter import OneEuroFilter
+from lib.utils.smooth_pose import one_euro_filter, smooth_rotations, axis_angle_to_rotation, rotation_to_axis_angle
+
+
+def random_poses(num_frames, seed=0):
+    # smooth motion with large global rotations plus noise
+    rng = np.random.default_rng(seed)
+    t = np.linspace(0, 4 * np.pi, num_frames)[:, None]
+    poses = 0.8 * np.sin(t + np.arange(72)[None] * 0.3)
+    poses[:, :3] *= 3.5
+    return (poses + 0.05 * rng.standard_normal(poses.shape)).astype(np.float32)
+
+
+def rotmats(poses):
+    return batch_rodrigues(torch.from_numpy(poses).reshape(-1, 3)).numpy().reshape(len(poses), 24, 9)
+
+
+def test_one_euro_filter_matches_OneEuroFilter():
+    poses = random_poses(50)
+    one_euro = OneEuroFilter(0, poses[0], min_cutoff=0.004, beta=0.7)
+    expected = [poses[0]] + [one_euro(t, poses[t]) for t in range(1, len(poses))]
+
+    smoothed = one_euro_filter(poses, min_cutoff=0.004, beta=0.7)
+    assert np.allclose(smoothed, np.stack(expected), atol=1e-5)
+
+
+def test_rotation_round_trip():
+    poses = random_poses(40)
+    for rotation in ['6d', 'quat']:
+        rot = axis_angle_to_rotation(torch.from_numpy(poses), rotation)
+        assert np.allclose(rotmats(rotation_to_axis_angle(rot, rotation).numpy()), rotmats(poses), atol=1e-5)
+
+
+def test_smooth_rotations():
+    poses = random_poses(120)
+    constant = np.repeat(poses[:1], 30, axis=0)
+    for method in ['gaussian', 'savgol']:
+        for rotation in ['6d', 'quat']:
+            smoothed = smooth_rotations([poses, poses[:70], constant], method=method, rotation=rotation)
+            assert [len(p) for p in smoothed] == [120, 70, 30]
+            # a constant pose is kept
+            assert np.allclose(rotmats(smoothed[2]), rotmats(constant), atol=1e-5)
+            # persons of different lengths are filtered as if they were filtered alone
+            alone = smooth_rotations([poses[:70]], method=method, rotation=rotation)[0]
+            assert np.allclose(rotmats(smoothed[1]), rotmats(alone), atol=1e-5)
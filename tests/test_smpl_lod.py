@@ -0,0 +1,74 @@
+import sys
+sys.path.append('.')
+
+import pytest
+import tempfile
+import numpy as np
+import os.path as osp
+
+from lib.core.config import VIBE_DATA_DIR
+from lib.models.smpl_lod import SMPL_LOD_LEVELS, MeshLOD, build_lod, check_lod, get_smpl_lod
+
+SMPL_FILES = [
+    osp.join(VIBE_DATA_DIR, 'SMPL_NEUTRAL.pkl'),
+    osp.join(VIBE_DATA_DIR, 'J_regressor_extra.npy'),
+]
+
+
+def icosphere(subdivisions):
+    t = (1 + 5 ** .5) / 2
+    verts = [[-1, t, 0], [1, t, 0], [-1, -t, 0], [1, -t, 0], [0, -1, t], [0, 1, t],
+             [0, -1, -t], [0, 1, -t], [t, 0, -1], [t, 0, 1], [-t, 0, -1], [-t, 0, 1]]
+    faces = [[0, 11, 5], [0, 5, 1], [0, 1, 7], [0, 7, 10], [0, 10, 11], [1, 5, 9], [5, 11, 4], [11, 10, 2],
+             [10, 7, 6], [7, 1, 8], [3, 9, 4], [3, 4, 2], [3, 2, 6], [3, 6, 8], [3, 8, 9], [4, 9, 5],
+             [2, 4, 11], [6, 2, 10], [8, 6, 7], [9, 8, 1]]
+    verts = [np.array(v, dtype=np.float64) / np.linalg.norm(v) for v in verts]
+    for _ in range(subdivisions):
+        midpoints, new_faces = {}, []
+
+        def midpoint(a, b):
+            key = (min(a, b), max(a, b))
+            if key not in midpoints:
+                m = verts[a] + verts[b]
+                verts.append(m / np.linalg.norm(m))
+                midpoints[key] = len(verts) - 1
+            return midpoints[key]
+
+        for a, b, c in faces:
+            ab, bc, ca = midpoint(a, b), midpoint(b, c), midpoint(c, a)
+            new_faces += [[a, ab, ca], [b, bc, ab], [c, ca, bc], [ab, bc, ca]]
+        faces = new_faces
+    return np.array(verts), np.array(faces, dtype=np.int64)
+
+
+def test_build_lod_sphere():
+    verts, faces = icosphere(4)
+    verts = verts * [0.3, 1.0, 0.2]
+    lod = build_lod(verts, faces, 800)
+    assert lod.num_verts <= 800
+
+    # removing a face opens a hole
+    holed = MeshLOD(np.delete(lod.faces, len(lod.faces) // 2, axis=0), lod.vertex_ids, lod.bary)
+    with pytest.raises(ValueError, match='boundary edges'):
+        check_lod(holed, verts, faces)
+
+    flipped = MeshLOD(lod.faces[:, [0, 2, 1]], lod.vertex_ids, lod.bary)
+    with pytest.raises(ValueError, match='flipped'):
+        check_lod(flipped, verts, faces)
+
+
+@pytest.mark.parametrize('num_verts', SMPL_LOD_LEVELS)
+def test_smpl_lod(num_verts):
+    missing = [f for f in SMPL_FILES if not osp.isfile(f)]
+    if len(missing) > 0:
+        pytest.skip(f'SMPL model files are missing: {missing}')
+
+    from lib.models.smpl import SMPL, SMPL_MODEL_DIR
+    smpl = SMPL(SMPL_MODEL_DIR, batch_size=1, create_transl=False)
+    v_template = smpl.v_template.cpu().numpy().astype(np.float64)
+    faces = smpl.faces.astype(np.int64)
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        lod = get_smpl_lod(num_verts, cache_dir=tmp_dir)
+        assert lod.num_verts <= num_verts
+        check_lod(MeshLOD.load(osp.join(tmp_dir, f'smpl_lod_{num_verts}_v3.npz')), v_template, faces)
@@ -0,0 +1,35 @@
+import sys
+sys.path.append('.')
+
+import numpy as np
+
+from lib.smplify.temporal_smplify import get_windows, get_blend_weights
+
+
+def test_get_windows():
+    seq_lengths = [100, 95, 30, 61]
+    window_size, overlap = 40, 10
+    windows = get_windows(seq_lengths, window_size, overlap)
+    offsets = np.cumsum([0] + seq_lengths)
+
+    for seq, length in enumerate(seq_lengths):
+        seq_windows = [(start, end) for s, start, end in windows if s == seq]
+        covered = np.zeros(offsets[-1], dtype=bool)
+        for start, end in seq_windows:
+            # windows stay inside their sequence and have window_size frames unless the sequence is shorter
+            assert offsets[seq] <= start < end <= offsets[seq + 1]
+            assert end - start == min(window_size, length)
+            covered[start:end] = True
+        assert covered[offsets[seq]:offsets[seq + 1]].all()
+        # neighbours overlap by at least `overlap` frames
+        for (_, end), (start, _) in zip(seq_windows[:-1], seq_windows[1:]):
+            assert end - start >= overlap
+
+
+def test_get_blend_weights():
+    weights = get_blend_weights(10, 30, 4).numpy()
+    assert weights.shape == (20,)
+    assert np.all(weights > 0) and np.all(weights <= 1)
+    assert np.allclose(weights[:5], [0.2, 0.4, 0.6, 0.8, 1.0])
+    assert np.allclose(weights, weights[::-1])
+    assert np.all(get_blend_weights(0, 10, 0).numpy() == 1)
@@ -0,0 +1,67 @@
+import sys
+sys.path.append('.')
+
+import torch
+import numpy as np
+from torch import nn
+
+from lib.core.tracklet_inference import MultiTrackletInference
+
+
+class FrameSource():
+    def __init__(self, num_frames=12, size=64):
+        rng = np.random.default_rng(0)
+        self.frames = rng.integers(0, 255, (num_frames, size, size, 3), dtype=np.uint8)
+
+    def __len__(self):
+        return len(self.frames)
+
+    def __getitem__(self, idx):
+        return self.frames[idx]
+
+
+class TinyModel(nn.Module):
+    # stands in for VIBE_Demo, the theta of a frame is the mean of its crop
+    raw_input = False
+
+    def __init__(self):
+        super().__init__()
+        self.encoder = nn.Module()
+        self.encoder.gru = nn.GRU(1, 1)
+
+    def extract_features(self, input):
+        return input.mean(dim=(1, 2, 3))[:, None]
+
+    def encode(self, feature, lengths):
+        return torch.cat([feature[i, :l] for i, l in enumerate(lengths)], dim=0)
+
+    def regressor(self, feature, outputs=None):
+        return [{'theta': feature.expand(-1, 85)}]
+
+
+def make_tracklets(num_frames=12):
+    rng = np.random.default_rng(1)
+    joints2d = np.concatenate([rng.uniform(20, 40, (num_frames, 21, 2)), np.ones((num_frames, 21, 1))], axis=2)
+    bboxes = np.tile([[30., 30., 20., 20.]], (num_frames, 1))
+    return {
+        'kp': {'frames': np.arange(num_frames), 'joints2d': joints2d},
+        'bbox': {'frames': np.arange(num_frames), 'bbox': bboxes},
+    }
+
+
+def test_mixed_keypoints():
+    engine = MultiTrackletInference(
+        TinyModel(), torch.device('cpu'), batch_size=5, num_workers=0, crop_size=32, outputs=('theta',)
+    )
+    frame_source, tracklets = FrameSource(), make_tracklets()
+
+    for order in [['kp', 'bbox'], ['bbox', 'kp']]:
+        output = engine(frame_source, {k: tracklets[k] for k in order})
+        assert list(output.keys()) == order
+
+        for person_id in order:
+            single = engine(frame_source, {person_id: tracklets[person_id]})[person_id]
+            assert torch.allclose(output[person_id]['pose'], single['pose'])
+
+        assert output['kp']['norm_joints2d'].shape == (12, 21, 3)
+        assert output['bbox']['norm_joints2d'] is None
@@ -1,20 +1,22 @@
-from lib.dataset.inference import Inference
-from torch.utils.data import DataLoader
 import torch
 import numpy as np
 import os
 import joblib
 
-from lib.models.vibe import VIBE_Demo
+from lib.core.tracklet_inference import MultiTrackletInference
 from lib.data_utils.kp_utils import convert_kps
-from lib.utils.smooth_pose import smooth_pose
+from lib.utils.smooth_pose import smooth_vibe_results
+from lib.models.onnx_backend import ONNX_DIR
+from lib.utils.results_store import save_results
+from lib.models.smpl_lod import get_smpl_lod
 
 from lib.utils.demo_utils import (
-    smplify_runner,
+    batch_smplify_runner,
     convert_crop_coords_to_orig_img,
     convert_crop_cam_to_orig_img,
-    video_to_images,
-    download_ckpt,
+    get_frame_source,
+    get_demo_model,
+    DEMO_OUTPUTS,
 )
 
 class PreProcessPersonData:
@@ -26,31 +28,55 @@ class PreProcessPersonData:
 
 
 class VidSMPLParamCreator:
+    '''
+        Runs VIBE on the people of one video, create one VidSMPLParamCreator per video.
+        "quantize" runs VIBE in int8 on the CPU (torch backend only, cannot be combined with "compile_mode").
+        The backbone is calibrated on the tracklets of the first processPeopleInVid / createVidPersonParams
+        call and the calibrated model is reused by the later calls on this video.
+    '''
     def __init__(self, _vidFilePath, _vibeConfigs):
         self.vidFilePath = _vidFilePath
         self.vibeConfigs = _vibeConfigs
 
+        # the same combinations demo.py rejects
+        if self.vibeConfigs.get("quantize", False) and self.vibeConfigs.get("compile_mode") is not None:
+            raise ValueError('"quantize" and "compile_mode" cannot be combined')
+        if self.vibeConfigs.get("backend", "torch") == "onnx" and \
+                (self.vibeConfigs.get("quantize", False) or self.vibeConfigs.get("compile_mode") is not None):
+            raise ValueError('"quantize" and "compile_mode" only apply to the torch backend')
+
+        # the decimated mesh is built (or loaded) before any inference, a mesh that fails validation raises here
+        self.lod = get_smpl_lod(self.vibeConfigs["lod"]) if self.vibeConfigs.get("lod") else None
+
         self.device = torch.device('cuda') if torch.cuda.is_available() else torch.device('cpu')
-        self.image_folder, num_frames, img_shape = video_to_images(self.vidFilePath, return_info=True)
-        self.orig_height, self.orig_width = img_shape[:2]
+        self.frame_source = get_frame_source(
+            self.vidFilePath,
+            dump_frames=self.vibeConfigs.get("dump_frames", False),
+            frame_store=self.vibeConfigs.get("frame_store", False),
+            store_dir=self.vibeConfigs.get("frame_store_dir", None),
+        )
+        self.orig_height, self.orig_width = self.frame_source.img_shape[:2]
         self.bbox_scale = 1.1
 
-        self.model = VIBE_Demo(
-            seqlen=16,
-            n_layers=2,
-            hidden_size=1024,
-            add_linear=True,
-            use_residual=True,
-        ).to(self.device)
+        self.model = get_demo_model(
+            self.device,
+            bundle_file=self.vibeConfigs.get("model_bundle", None),
+            compile_mode=self.vibeConfigs.get("compile_mode", None),
+            backend=self.vibeConfigs.get("backend", "torch"),
+            onnx_dir=self.vibeConfigs.get("onnx_dir", ONNX_DIR),
+        )
 
-        # ========= Load pretrained weights ========= #
-        pretrained_file = download_ckpt(use_3dpw=False)
-        ckpt = torch.load(pretrained_file, map_location='cpu')
-        print(f'Performance of pretrained model on 3DPW: {ckpt["performance"]}')
-        ckpt = ckpt['gen_state_dict']
-        self.model.load_state_dict(ckpt, strict=False)
-        self.model.eval()
-        print(f'Loaded pretrained weights from \"{pretrained_file}\"')
+        self.engine = MultiTrackletInference(
+            model=self.model,
+            device=torch.device('cpu') if self.vibeConfigs.get("backend", "torch") == "onnx" else self.device,
+            batch_size=self.vibeConfigs["batch_size"],
+            num_workers=16,
+            bbox_scale=self.bbox_scale,
+            carry_gru_state=self.vibeConfigs.get("carry_gru_state", False),
+            outputs=DEMO_OUTPUTS[self.vibeConfigs.get("outputs", "mesh")],
+        )
+        # the int8 model is calibrated on the crops of the people of the first call
+        self.quantized = False
 
     '''
         Arguments:
@@ -60,7 +86,7 @@ class VidSMPLParamCreator:
                 frames = [frame number the person appears in]
                 id = person identification number
             }...] Array of people objects
-            _outputPath: file path to dump the pkl file
+            _outputPath: directory of the results file, vibe_output.pkl or vibe_output.h5 if "results_format" is "h5"
 
         return:
             vibe_results (results of pkl file): dictionary 
@@ -78,11 +104,31 @@ class VidSMPLParamCreator:
                 }...}
     '''
     def processPeopleInVid(self, _people, _outputPath):
+        tracking_results = {}
+        for person in _people:
+            tracking_results[person.id] = self.createTracklet(person.bboxes, person.joints2D, person.frames)
+
+        # all people share the backbone batches of one forward pass
+        predictions = self.runEngine(tracking_results)
+
+        smplifyResults = self.runSmplify(predictions, {person.id: person.joints2D for person in _people})
+
         vibe_results = {}
         for person in _people:
-            vibe_results[person.id] = self.createVidPersonParams(person.bboxes, person.joints2D, person.frames)
+            vibe_results[person.id] = self.postprocessPersonParams(
+                predictions[person.id], person.joints2D, smplifyResults.get(person.id)
+            )
+        self.smoothResults(vibe_results)
     
-        joblib.dump(vibe_results, os.path.join(_outputPath, "vibe_output.pkl"))
+        if self.vibeConfigs.get("results_format", "pkl") == "h5":
+            save_results(
+                os.path.join(_outputPath, "vibe_output.h5"),
+                vibe_results,
+                verts_format=self.vibeConfigs.get("verts_format", "float32"),
+                lod=self.lod,
+            )
+        else:
+            joblib.dump(vibe_results, os.path.join(_outputPath, "vibe_output.pkl"))
 
         return vibe_results
     
@@ -95,82 +141,132 @@ class VidSMPLParamCreator:
             _frames: all detected frame number
     '''
     def createVidPersonParams(self, _bboxes = None, _joints2D = None, _frames = []):
-        dataset = Inference(
-            image_folder= self.image_folder,
-            frames= _frames,
-            bboxes= _bboxes,
-            joints2d= _joints2D,
-            scale= self.bbox_scale,
-        )
+        predictions = self.runEngine({0: self.createTracklet(_bboxes, _joints2D, _frames)})
+        smplifyResults = self.runSmplify(predictions, {0: _joints2D})
+        vibe_results = {0: self.postprocessPersonParams(predictions[0], _joints2D, smplifyResults.get(0))}
+        self.smoothResults(vibe_results)
+        return vibe_results[0]
 
-        bboxes = dataset.bboxes
-        frames = dataset.frames
-        has_keypoints = True if _joints2D is not None else False
+    '''
+        Runs 1 Euro Filter on the poses of all people at once to smooth out the results,
+        "smooth_method" selects an offline zero-phase filter in rotation space instead (see lib.utils.smooth_pose)
+    '''
+    def smoothResults(self, _vibeResults):
+        if not self.vibeConfigs["smooth_results"]:
+            return
 
-        dataloader = DataLoader(dataset, batch_size=self.vibeConfigs["batch_size"], num_workers=16)
+        method = self.vibeConfigs.get("smooth_method", "one_euro")
+        if method == "one_euro":
+            min_cutoff = self.vibeConfigs["smooth_min_cutoff"] # 0.004
+            beta = self.vibeConfigs["smooth_beta"] # 1.5
+            print(f'Running smoothing on {len(_vibeResults)} people min_cutoff: {min_cutoff}, beta: {beta}')
+
+            # [VIBE-Object]
+            # Over here, the joints are smoothed out.
+            smooth_vibe_results(_vibeResults, min_cutoff=min_cutoff, beta=beta, device=self.device)
+            return
+
+        print(f'Running {method} smoothing on {len(_vibeResults)} people')
+        smooth_vibe_results(
+            _vibeResults,
+            device=self.device,
+            method=method,
+            rotation=self.vibeConfigs.get("smooth_rotation", "6d"),
+            sigma=self.vibeConfigs.get("smooth_sigma", 2.0),
+            window=self.vibeConfigs.get("smooth_window", 9),
+        )
 
-        with torch.no_grad():
-            pred_cam, pred_verts, pred_pose, pred_betas, pred_joints3d, smpl_joints2d, norm_joints2d = [], [], [], [], [], [], []
+    '''
+        Runs Temporal SMPLify on the VIBE predictions of all people with 2D keypoints at once,
+        returns person id -> smplify_runner output, empty if "runSimplify" is disabled
+    '''
+    def runSmplify(self, _predictions, _joints2D):
+        if not self.vibeConfigs["runSimplify"]:
+            return {}
+
+        personIds = [personId for personId in _predictions.keys() if _joints2D.get(personId) is not None]
+        results = batch_smplify_runner(
+            pred_rotmats=[_predictions[personId]['pose'].to(self.device) for personId in personIds],
+            pred_betas=[_predictions[personId]['betas'].to(self.device) for personId in personIds],
+            pred_cams=[_predictions[personId]['pred_cam'].to(self.device) for personId in personIds],
+            j2ds=[
+                torch.from_numpy(
+                    convert_kps(_predictions[personId]['norm_joints2d'], src='staf', dst='spin')
+                ).float().to(self.device)
+                for personId in personIds
+            ],
+            device=self.device,
+            pose2aa=False,
+            window_size=self.vibeConfigs.get("smplify_window", None),
+            overlap=self.vibeConfigs.get("smplify_overlap", 20),
+            num_workers=self.vibeConfigs.get("smplify_workers", 4),
+        )
+        return dict(zip(personIds, results))
 
-            for batch in dataloader:
-                if has_keypoints:
-                    batch, nj2d = batch
-                    norm_joints2d.append(nj2d.numpy().reshape(-1, 21, 3))
+    '''
+        Runs VIBE on the tracklets, quantizes the model on the first call if "quantize" is enabled
+    '''
+    def runEngine(self, _trackingResults):
+        if self.vibeConfigs.get("quantize", False) and not self.quantized:
+            self.engine.quantize(self.frame_source, _trackingResults)
+            self.quantized = True
+        return self.engine(self.frame_source, _trackingResults)
 
-                batch = batch.unsqueeze(0)
-                batch = batch.to(self.device)
+    '''
+        Releases the decoded video, this removes the frame store file when "frame_store" is enabled
+    '''
+    def release(self):
+        self.frame_source.release()
 
-                batch_size, seqlen = batch.shape[:2]
-                output = self.model(batch)[-1]
+    '''
+        Tracklet in the format of the multi person tracker output
+    '''
+    def createTracklet(self, _bboxes, _joints2D, _frames):
+        tracklet = {'frames': np.asarray(_frames)}
+        if _joints2D is not None:
+            tracklet['joints2d'] = _joints2D
+        else:
+            tracklet['bbox'] = _bboxes
+        return tracklet
 
-                pred_cam.append(output['theta'][:, :, :3].reshape(batch_size * seqlen, -1))
-                pred_verts.append(output['verts'].reshape(batch_size * seqlen, -1, 3))
-                pred_pose.append(output['theta'][:,:,3:75].reshape(batch_size * seqlen, -1))
-                pred_betas.append(output['theta'][:, :,75:].reshape(batch_size * seqlen, -1))
-                pred_joints3d.append(output['kp_3d'].reshape(batch_size * seqlen, -1, 3))
-                smpl_joints2d.append(output['kp_2d'].reshape(batch_size * seqlen, -1, 2))
+    '''
+        Applies the optional SMPLify refinement (see runSmplify) to the VIBE predictions of one person
+        and converts them to the vibe_output.pkl format
+    '''
+    def postprocessPersonParams(self, _predictions, _joints2D, _smplifyResult=None):
+        bboxes = _predictions['bboxes']
+        frames = _predictions['frames']
+        has_keypoints = True if _joints2D is not None else False
 
-            pred_cam = torch.cat(pred_cam, dim=0)
-            pred_verts = torch.cat(pred_verts, dim=0)
-            pred_pose = torch.cat(pred_pose, dim=0)
-            pred_betas = torch.cat(pred_betas, dim=0)
-            pred_joints3d = torch.cat(pred_joints3d, dim=0)
-            smpl_joints2d = torch.cat(smpl_joints2d, dim=0)
-            del batch
+        pred_cam = _predictions['pred_cam']
+        pred_pose = _predictions['pose']
+        pred_betas = _predictions['betas']
+        # None if not selected by the "outputs" config
+        pred_verts = _predictions.get('verts')
+        pred_joints3d = _predictions.get('joints3d')
+        smpl_joints2d = _predictions.get('smpl_joints2d')
 
-        # ========= [Optional] run Temporal SMPLify to refine the results ========= #
+        # ========= [Optional] Temporal SMPLify results ========= #
         if self.vibeConfigs["runSimplify"] and has_keypoints:
-            norm_joints2d = np.concatenate(norm_joints2d, axis=0)
-            norm_joints2d = convert_kps(norm_joints2d, src='staf', dst='spin')
-            norm_joints2d = torch.from_numpy(norm_joints2d).float().to(self.device)
-
-            # Run Temporal SMPLify
             update, new_opt_vertices, new_opt_cam, new_opt_pose, new_opt_betas, \
-            new_opt_joints3d, new_opt_joint_loss, opt_joint_loss = smplify_runner(
-                pred_rotmat=pred_pose,
-                pred_betas=pred_betas,
-                pred_cam=pred_cam,
-                j2d=norm_joints2d,
-                device= self.device,
-                batch_size=norm_joints2d.shape[0],
-                pose2aa=False,
-            )
+            new_opt_joints3d, new_opt_joint_loss, opt_joint_loss = _smplifyResult
 
             # update the parameters after refinement
-            print(f'Update ratio after Temporal SMPLify: {update.sum()} / {norm_joints2d.shape[0]}')
-            if self.vibeConfigs["trackViaPose"]:
-                update = update.cpu()
+            print(f'Update ratio after Temporal SMPLify: {update.sum()} / {update.shape[0]}')
+            update = update.cpu()
 
-            pred_verts = pred_verts.cpu()
             pred_cam = pred_cam.cpu()
             pred_pose = pred_pose.cpu()
             pred_betas = pred_betas.cpu()
-            pred_joints3d = pred_joints3d.cpu()
-            pred_verts[update] = new_opt_vertices[update]
             pred_cam[update] = new_opt_cam[update]
             pred_pose[update] = new_opt_pose[update]
             pred_betas[update] = new_opt_betas[update]
-            pred_joints3d[update] = new_opt_joints3d[update]
+            if pred_verts is not None:
+                pred_verts = pred_verts.cpu()
+                pred_verts[update] = new_opt_vertices[update]
+            if pred_joints3d is not None:
+                pred_joints3d = pred_joints3d.cpu()
+                pred_joints3d[update] = new_opt_joints3d[update]
 
         elif self.vibeConfigs["runSimplify"] and not has_keypoints:
             print('[WARNING] You need to enable pose tracking to run Temporal SMPLify algorithm!')
@@ -178,22 +274,14 @@ class VidSMPLParamCreator:
 
         # ========= Save results to a pickle file ========= #
         pred_cam = pred_cam.cpu().numpy()
-        pred_verts = pred_verts.cpu().numpy()
         pred_pose = pred_pose.cpu().numpy()
         pred_betas = pred_betas.cpu().numpy()
-        pred_joints3d = pred_joints3d.cpu().numpy() # 300 frames, 49 bones, 3 floats each. Uses spin_joint_names.
-        smpl_joints2d = smpl_joints2d.cpu().numpy()
-
-        # Runs 1 Euro Filter to smooth out the results
-        if self.vibeConfigs["smooth_results"]:
-            min_cutoff = self.vibeConfigs["smooth_min_cutoff"] # 0.004
-            beta = self.vibeConfigs["smooth_beta"] # 1.5
-            print(f'Running smoothing on person min_cutoff: {min_cutoff}, beta: {beta}')
-
-        # [VIBE-Object]
-        # Over here, the joints are smoothed out.
-        pred_verts, pred_pose, pred_joints3d = smooth_pose(pred_pose, pred_betas,
-                                                               min_cutoff=min_cutoff, beta=beta)
+        if pred_verts is not None:
+            pred_verts = pred_verts.cpu().numpy()
+        if pred_joints3d is not None:
+            pred_joints3d = pred_joints3d.cpu().numpy() # 300 frames, 49 bones, 3 floats each. Uses spin_joint_names.
+        if smpl_joints2d is not None:
+            smpl_joints2d = smpl_joints2d.cpu().numpy()
 
         orig_cam = convert_crop_cam_to_orig_img(
             cam=pred_cam,
@@ -206,7 +294,7 @@ class VidSMPLParamCreator:
             bbox=bboxes,
             keypoints=smpl_joints2d,
             crop_size=224,
-        )
+        ) if smpl_joints2d is not None else None
 
         output_dict = {
             'pred_cam': pred_cam,